@@ -3,6 +3,7 @@ from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
 import os
+from .upload_stream import StreamingRequest
 
 # 加载环境变量
 load_dotenv()
@@ -10,14 +11,27 @@ load_dotenv()
 # 初始化数据库
 db = SQLAlchemy()
 
+# 未配置SECRET_KEY时使用的默认值（公开值，不能用于签名）
+DEFAULT_SECRET_KEY = 'photo-gallery-secret-key'
+
 def create_app():
     """创建Flask应用实例"""
     app = Flask(__name__)
+    app.request_class = StreamingRequest
     
     # 配置应用
-    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'photo-gallery-secret-key'
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or DEFAULT_SECRET_KEY
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///gallery.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # 接口SQL数量超出预算时直接报错（测试环境始终开启），否则只打印警告
+    app.config['QUERY_BUDGET_STRICT'] = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() in ('1', 'true', 'yes')
+    
+    # 存储后端：tos（默认）、local（本地文件系统）、memory（进程内存，用于测试和压测）
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'tos')
+    # 本地/内存存储的文件目录、访问URL前缀（由Flask提供访问）和浏览器缓存时间（秒）
+    app.config['LOCAL_STORAGE_ROOT'] = os.environ.get('LOCAL_STORAGE_ROOT', os.path.join(app.instance_path, 'storage'))
+    app.config['STORAGE_URL_PREFIX'] = os.environ.get('STORAGE_URL_PREFIX', '/storage')
+    app.config['STORAGE_MAX_AGE'] = int(os.environ.get('STORAGE_MAX_AGE', 365 * 24 * 3600))
     
     # 配置TOS
     app.config['TOS_REGION'] = os.environ.get('TOS_REGION', 'cn-beijing')
@@ -26,20 +40,108 @@ def create_app():
     app.config['TOS_BUCKET_NAME'] = os.environ.get('TOS_BUCKET_NAME', 'photo-gallery')
     app.config['TOS_ENDPOINT'] = os.environ.get('TOS_ENDPOINT', f'https://tos-s3-{app.config["TOS_REGION"]}.volc.com')
     app.config['TOS_CDN_DOMAIN'] = os.environ.get('TOS_CDN_DOMAIN', '')
+    # TOS连接池：每个进程共享的最大连接数、连接/请求超时（秒）、失败重试次数
+    app.config['TOS_MAX_CONNECTIONS'] = int(os.environ.get('TOS_MAX_CONNECTIONS', 64))
+    app.config['TOS_CONNECT_TIMEOUT'] = int(os.environ.get('TOS_CONNECT_TIMEOUT', 10))
+    app.config['TOS_REQUEST_TIMEOUT'] = int(os.environ.get('TOS_REQUEST_TIMEOUT', 30))
+    app.config['TOS_MAX_RETRIES'] = int(os.environ.get('TOS_MAX_RETRIES', 3))
+    # 大文件分片上传：超过阈值后按分片并发上传，分片失败单独重试
+    app.config['TOS_MULTIPART_THRESHOLD'] = int(os.environ.get('TOS_MULTIPART_THRESHOLD', 20 * 1024 * 1024))
+    app.config['TOS_MULTIPART_PART_SIZE'] = int(os.environ.get('TOS_MULTIPART_PART_SIZE', 8 * 1024 * 1024))
+    app.config['TOS_MULTIPART_CONCURRENCY'] = int(os.environ.get('TOS_MULTIPART_CONCURRENCY', 4))
+    app.config['TOS_MULTIPART_RETRIES'] = int(os.environ.get('TOS_MULTIPART_RETRIES', 3))
+    # 内容寻址存储：对象key由文件哈希决定（photos/ab/cd/<哈希>.<扩展名>），已存在的对象只做HEAD检查不再上传
+    app.config['TOS_CONTENT_ADDRESSED'] = os.environ.get('TOS_CONTENT_ADDRESSED', '').lower() in ('1', 'true', 'yes')
+    # 小文件（缩略图、衍生图）并发上传的线程数
+    app.config['TOS_UPLOAD_CONCURRENCY'] = int(os.environ.get('TOS_UPLOAD_CONCURRENCY', 8))
     
     # 上传限制
     app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
     app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
     
+    # ZIP压缩包上传：请求体大小上限（单独放宽，成员逐个解压，内存占用不随压缩包增大）、图片成员数量上限
+    app.config['ZIP_MAX_CONTENT_LENGTH'] = int(os.environ.get('ZIP_MAX_CONTENT_LENGTH', 4 * 1024 * 1024 * 1024))
+    app.config['ZIP_MAX_MEMBERS'] = int(os.environ.get('ZIP_MAX_MEMBERS', 10000))
+    
+    # 浏览器直传：预签名上传地址的有效期（秒）
+    app.config['DIRECT_UPLOAD_EXPIRES'] = int(os.environ.get('DIRECT_UPLOAD_EXPIRES', 15 * 60))
+    
+    # 多尺寸衍生图：宽度档位（逗号分隔）和输出格式（webp、jpeg）
+    app.config['RENDITION_WIDTHS'] = tuple(int(w) for w in os.environ.get('RENDITION_WIDTHS', '160,400,800,1600').split(',') if w.strip())
+    app.config['RENDITION_FORMATS'] = tuple(f.strip() for f in os.environ.get('RENDITION_FORMATS', 'webp,jpeg').split(',') if f.strip())
+    
+    # 按需缩放图片（/img/<ID>/<宽>x<高>.<格式>）：磁盘缓存目录、缓存总大小上限、允许的最大边长
+    app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'image_cache'))
+    app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    app.config['IMAGE_VARIANT_MAX_SIZE'] = int(os.environ.get('IMAGE_VARIANT_MAX_SIZE', 2048))
+    
+    # 媒体代理（/media/<key>）：开启后接口返回的图片URL指向本应用，对象经本地磁盘缓存返回
+    app.config['MEDIA_PROXY'] = os.environ.get('MEDIA_PROXY', 'false').lower() in ('1', 'true', 'yes')
+    app.config['MEDIA_URL_PREFIX'] = os.environ.get('MEDIA_URL_PREFIX', '/media')
+    app.config['MEDIA_CACHE_DIR'] = os.environ.get('MEDIA_CACHE_DIR', os.path.join(app.instance_path, 'media_cache'))
+    app.config['MEDIA_CACHE_MAX_BYTES'] = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+    
+    # 图片解码准入控制：所有线程共享的像素内存预算、排队等待超时（秒）、最大排队数
+    app.config['DECODE_MEMORY_BUDGET'] = int(os.environ.get('DECODE_MEMORY_BUDGET', 1024 * 1024 * 1024))
+    app.config['DECODE_QUEUE_TIMEOUT'] = float(os.environ.get('DECODE_QUEUE_TIMEOUT', 30))
+    app.config['DECODE_MAX_QUEUE'] = int(os.environ.get('DECODE_MAX_QUEUE', 64))
+    
+    # 批量上传并发数（缩略图生成与TOS上传并行执行）
+    app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', 8))
+    # 上传缓冲：超过该大小的文件写入临时文件；流式读取的块大小
+    app.config['UPLOAD_SPOOL_MAX_MEMORY'] = int(os.environ.get('UPLOAD_SPOOL_MAX_MEMORY', 1024 * 1024))
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+    # 异步入库：后台线程数、原始文件暂存目录、处理中状态的超时时间（超时后重新排队）
+    app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', 4))
+    app.config['INGEST_SPOOL_DIR'] = os.environ.get('INGEST_SPOOL_DIR', os.path.join(app.instance_path, 'ingest_spool'))
+    app.config['INGEST_STALE_SECONDS'] = int(os.environ.get('INGEST_STALE_SECONDS', 600))
+    # 启动时创建入库线程池并恢复未完成的文件（只在Web服务进程开启，见run.py）
+    app.config['INGEST_WORKER_ENABLED'] = os.environ.get('INGEST_WORKER_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    # 上传时拒绝相似图片：感知哈希汉明距离不超过该值视为重复（默认-1，不拒绝；相似图片可通过 /api/photos/<ID>/similar 查询）
+    app.config['PHASH_DUPLICATE_DISTANCE'] = int(os.environ.get('PHASH_DUPLICATE_DISTANCE', -1))
+    
     # 初始化扩展
     db.init_app(app)
     CORS(app)  # 启用CORS
     
     # 创建数据库表
     with app.app_context():
-        from .models import Photo, Tag, ImageGenerationTask, GenerationResult, GenerationParameter
+        from .models import Photo, Tag, ImageGenerationTask, GenerationResult, GenerationParameter, IngestJob, IngestJobItem
         db.create_all()
     
+    # 按配置创建存储后端（TOS后端创建进程内共享的连接池）
+    from .tos_client import tos_client
+    tos_client.init_app(app)
+    
+    # 配置图片解码调度器
+    from .tos_client import decode_scheduler
+    decode_scheduler.configure(app.config['DECODE_MEMORY_BUDGET'], app.config['DECODE_QUEUE_TIMEOUT'], app.config['DECODE_MAX_QUEUE'])
+    
+    # 加载相似图片索引
+    from .similarity import phash_index
+    phash_index.init_app(app)
+    
+    # 加载颜色直方图索引
+    from .colors import color_index
+    color_index.init_app(app)
+    
+    # 创建全文索引表并随ORM写入同步（SQLite FTS5 / MySQL ngram）
+    from .search_index import search_index
+    search_index.init_app(app)
+    
+    # 加载标签位图索引
+    from .tag_index import tag_index
+    tag_index.init_app(app)
+    
+    # 注册异步入库工作池
+    from .ingest import ingest_worker
+    ingest_worker.init_app(app)
+    
+    # 按需缩放图片的磁盘LRU缓存
+    from .disk_cache import DiskLRUCache
+    app.extensions['image_cache'] = DiskLRUCache(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+    app.extensions['media_cache'] = DiskLRUCache(app.config['MEDIA_CACHE_DIR'], app.config['MEDIA_CACHE_MAX_BYTES'])
+    
     # 注册路由
     from .routes import bp as api_bp
     app.register_blueprint(api_bp)
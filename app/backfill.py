@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
+from . import db
+from .models import Photo
+from .tos_client import tos_client
+
+
+def load_thumbnail(photo_id: int, filename: str, has_thumbnail: bool):
+    """下载缩略图（没有缩略图时下载原图并缩放），返回 (图片ID, 图片或None)"""
+    key = f"thumbnails/{filename}" if has_thumbnail else f"photos/{filename}"
+    try:
+        img = Image.open(BytesIO(tos_client.download_file(key)))
+        img.draft('RGB', (400, 400))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail((400, 400), Image.Resampling.LANCZOS)
+        return photo_id, img
+    except Exception as e:
+        print(f'图片 {photo_id} 读取失败: {e}')
+        return photo_id, None
+
+
+def backfill(app, missing, compute, batch_size: int, workers: int) -> int:
+    """按ID顺序分批为missing列为空的已入库图片回填字段，返回更新的图片数量
+
+    compute 接收一组缩略图，返回对应的Photo字段字典列表；每批图片并发下载后分成workers份并发计算。
+    """
+    last_id = 0
+    updated = 0
+    with app.app_context(), ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = db.session.query(Photo.id, Photo.filename, Photo.thumbnail_url).filter(
+                Photo.id > last_id,
+                missing.is_(None),
+                Photo.status == 'ready'
+            ).order_by(Photo.id).limit(batch_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            # 并发下载，需要应用上下文读取TOS配置
+            def load(row):
+                with app.app_context():
+                    return load_thumbnail(row.id, row.filename, bool(row.thumbnail_url))
+
+            loaded = [(photo_id, img) for photo_id, img in executor.map(load, rows) if img is not None]
+            if not loaded:
+                continue
+
+            chunk = -(-len(loaded) // workers)
+            images = [img for _, img in loaded]
+            fields = [item for part in executor.map(compute, [images[i:i + chunk] for i in range(0, len(images), chunk)])
+                      for item in part]
+            db.session.bulk_update_mappings(Photo, [
+                dict(values, id=photo_id) for (photo_id, _), values in zip(loaded, fields)
+            ])
+            db.session.commit()
+            updated += len(loaded)
+            print(f'已处理到图片ID {last_id}，累计更新 {updated} 张')
+
+    return updated
@@ -0,0 +1,160 @@
+import threading
+import numpy as np
+from PIL import Image
+from . import db
+
+# 颜色直方图：RGB每个通道分4档，共64个区间；每个区间的占比量化为0-255保存为64字节
+HISTOGRAM_LEVELS = 4
+HISTOGRAM_BINS = HISTOGRAM_LEVELS ** 3
+# 计算查询颜色与区间中心相似度的衰减距离（RGB欧氏距离）
+COLOR_SIGMA = 64.0
+# 检索时每次参与矩阵运算的行数，限制临时数组的内存
+SEARCH_CHUNK_ROWS = 65536
+# 主色之间的最小RGB距离，过近的颜色只保留占比较高的一个
+MIN_COLOR_DISTANCE = 48
+
+
+def _bin_centers() -> np.ndarray:
+    step = 256 // HISTOGRAM_LEVELS
+    levels = np.arange(HISTOGRAM_LEVELS) * step + step // 2
+    r, g, b = np.meshgrid(levels, levels, levels, indexing='ij')
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1).astype(np.float32)
+
+
+BIN_CENTERS = _bin_centers()
+
+
+def color_histogram(img: Image.Image) -> bytes:
+    """计算RGB图片的64区间颜色直方图"""
+    pixels = np.asarray(img.convert('RGB'), dtype=np.uint8).reshape(-1, 3)
+    shift = 8 - (HISTOGRAM_LEVELS.bit_length() - 1)
+    bins = ((pixels[:, 0] >> shift).astype(np.int32) * HISTOGRAM_LEVELS
+            + (pixels[:, 1] >> shift)) * HISTOGRAM_LEVELS + (pixels[:, 2] >> shift)
+    counts = np.bincount(bins, minlength=HISTOGRAM_BINS)
+    return np.round(counts * 255.0 / max(len(pixels), 1)).astype(np.uint8).tobytes()
+
+
+def dominant_colors(img: Image.Image, count: int = 5) -> list:
+    """用中位切分量化提取主色，合并相近颜色后按像素占比降序返回 #rrggbb 列表"""
+    small = img.convert('RGB')
+    small.thumbnail((100, 100))
+    quantized = small.quantize(colors=count * 2, method=Image.Quantize.MEDIANCUT)
+    palette = quantized.getpalette()
+    colors = []
+    for _, index in sorted(quantized.getcolors(), reverse=True):
+        rgb = np.array(palette[index * 3:index * 3 + 3], dtype=np.float32)
+        if all(np.linalg.norm(rgb - picked) >= MIN_COLOR_DISTANCE for picked in colors):
+            colors.append(rgb)
+        if len(colors) == count:
+            break
+    return ['#{:02x}{:02x}{:02x}'.format(*(int(v) for v in rgb)) for rgb in colors]
+
+
+def parse_color(value: str):
+    """解析 #RRGGBB 或 RRGGBB，格式错误时返回None"""
+    value = value.strip().lstrip('#')
+    if len(value) != 6:
+        return None
+    try:
+        return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        return None
+
+
+class ColorIndex:
+    """进程内的颜色直方图索引：所有图片的直方图保存在一个 N x 64 的uint8数组中，检索时向量化计算得分"""
+
+    def __init__(self):
+        self.app = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.histograms = np.zeros((0, HISTOGRAM_BINS), dtype=np.uint8)
+        self.pending = []  # 新增的 (图片ID, 直方图)，检索时再合并进数组
+        self.removed = set()
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def init_app(self, app):
+        """启动时加载索引，数据库尚未升级（缺少直方图列）时推迟到首次查询"""
+        self.app = app
+        app.extensions['color_index'] = self
+        with app.app_context():
+            try:
+                self.load()
+            except Exception as e:
+                db.session.rollback()
+                print(f"颜色索引加载失败，将在首次查询时重试: {e}")
+
+    def load(self):
+        """从数据库加载所有已入库图片的颜色直方图"""
+        from .models import Photo
+        ids = []
+        chunks = []
+        rows = db.session.query(Photo.id, Photo.color_histogram).filter(
+            Photo.color_histogram.isnot(None), Photo.status == 'ready'
+        ).yield_per(10000)
+        for photo_id, histogram in rows:
+            if len(histogram) == HISTOGRAM_BINS:
+                ids.append(photo_id)
+                chunks.append(histogram)
+        histograms = np.frombuffer(b''.join(chunks), dtype=np.uint8).reshape(-1, HISTOGRAM_BINS)
+        with self.lock:
+            self.ids = np.array(ids, dtype=np.int64)
+            self.histograms = histograms
+            self.pending = []
+            self.removed = set()
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+
+    def add(self, photo_id: int, histogram: bytes):
+        """添加一张图片"""
+        if not histogram or len(histogram) != HISTOGRAM_BINS:
+            return
+        self._ensure_loaded()
+        with self.lock:
+            self.removed.discard(photo_id)
+            self.pending.append((photo_id, histogram))
+
+    def remove(self, photo_id: int):
+        """标记图片已删除"""
+        with self.lock:
+            self.removed.add(photo_id)
+
+    def _merge_pending(self):
+        """将新增的直方图合并进数组（需持有锁）"""
+        if self.pending:
+            self.ids = np.concatenate([self.ids, np.array([p[0] for p in self.pending], dtype=np.int64)])
+            added = np.frombuffer(b''.join(p[1] for p in self.pending), dtype=np.uint8).reshape(-1, HISTOGRAM_BINS)
+            self.histograms = np.concatenate([self.histograms, added])
+            self.pending = []
+
+    def search(self, rgb: tuple, limit: int, min_score: float = 0.05) -> list:
+        """按与查询颜色相近的像素占比打分，返回得分降序的 (得分, 图片ID) 列表"""
+        self._ensure_loaded()
+        distances = np.linalg.norm(BIN_CENTERS - np.array(rgb, dtype=np.float32), axis=1)
+        weights = np.exp(-(distances / COLOR_SIGMA) ** 2) / 255.0
+
+        with self.lock:
+            self._merge_pending()
+            ids, histograms, removed = self.ids, self.histograms, set(self.removed)
+
+        scores = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), SEARCH_CHUNK_ROWS):
+            chunk = histograms[start:start + SEARCH_CHUNK_ROWS]
+            scores[start:start + len(chunk)] = chunk.astype(np.float32) @ weights
+        if removed:
+            scores[np.isin(ids, list(removed))] = 0
+
+        candidates = np.flatnonzero(scores >= min_score)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(float(scores[i]), int(ids[i])) for i in candidates]
+
+
+# 全局颜色索引
+color_index = ColorIndex()
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class DiskLRUCache:
+    """按总大小限制的磁盘LRU缓存：写入先落临时文件再原子替换，超出上限时淘汰最久未访问的条目"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # 缓存文件路径 -> 大小，按访问顺序排列
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """启动时扫描缓存目录，按文件修改时间恢复访问顺序并清理残留的临时文件"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if name.startswith('.tmp'):
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        """key经哈希后分两级目录存放，避免单个目录文件过多"""
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def get_path(self, key: str) -> str:
+        """命中时返回缓存文件路径（更新访问顺序），未命中时返回None；大文件由调用方直接从磁盘读取"""
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            with self.lock:
+                size = self.entries.pop(path, None)
+                if size is not None:
+                    self.total_bytes -= size
+            return None
+
+        with self.lock:
+            if path not in self.entries:
+                self.entries[path] = size
+                self.total_bytes += size
+            self.entries.move_to_end(path)
+        # 更新修改时间，重启后仍能按访问顺序淘汰
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def get(self, key: str) -> bytes:
+        """读取缓存内容，未命中时返回None"""
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        """写入缓存（临时文件 + os.replace，读取方不会看到写了一半的文件）"""
+        if len(data) <= self.max_bytes:
+            self.put_chunks(key, [data])
+
+    def put_chunks(self, key: str, chunks) -> str:
+        """分块写入缓存并返回缓存文件路径；总大小超过缓存上限时放弃写入，返回None"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        break
+                    f.write(chunk)
+            if size > self.max_bytes:
+                os.remove(tmp_path)
+                return None
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            self._evict()
+        return path
+
+    def _evict(self):
+        """淘汰最久未访问的条目直到总大小不超过上限（需持有锁）"""
+        while self.total_bytes > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """合并同一key的并发调用：只有第一个调用方真正执行，其余调用方等待并共享结果"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
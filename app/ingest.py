@@ -0,0 +1,617 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import mimetypes
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+from . import db
+from .models import Photo, IngestJob, IngestJobItem, storage_keys
+from .tos_client import tos_client, encode_renditions, DecodeRejected
+from .upload_stream import spool_upload, HashingSpooledFile
+from .similarity import phash_index, informative_hash, BKTree
+from .colors import color_index
+from .tag_index import tag_index
+from .photos import delete_photo_rows
+
+_executor_lock = threading.Lock()
+
+# 解码准入被拒绝（排队过多或等待超时）时的错误信息和建议的重试间隔（秒）
+BUSY_ERROR = '服务器繁忙，请稍后重试'
+BUSY_RETRY_SECONDS = 5
+
+
+def get_executor(app):
+    """获取进程内共享的入库线程池（并发上限由UPLOAD_WORKERS控制）"""
+    executor = app.extensions.get('ingest_executor')
+    if executor is None:
+        with _executor_lock:
+            executor = app.extensions.get('ingest_executor')
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=app.config['UPLOAD_WORKERS'],
+                    thread_name_prefix='ingest'
+                )
+                app.extensions['ingest_executor'] = executor
+    return executor
+
+
+def all_busy(photos: list, errors: list) -> bool:
+    """一批文件全部因服务器繁忙未能处理（调用方应返回503并提示重试）"""
+    return not photos and bool(errors) and all(e.endswith(f': {BUSY_ERROR}') for e in errors)
+
+
+class SimilarPhotoExists(Exception):
+    """已存在感知哈希相近的图片"""
+
+    def __init__(self, photo_id: int):
+        super().__init__(f'相似图片已存在 (ID: {photo_id})')
+        self.photo_id = photo_id
+
+
+def upload_and_analyze(stream, file_size: int, filename: str, content_type: str) -> dict:
+    """一次解码生成缩略图和衍生图并检查相似图片，然后上传，返回存储和尺寸相关的Photo字段（需在应用上下文中调用）"""
+    analysis = tos_client.analyze_image(
+        stream,
+        rendition_widths=current_app.config['RENDITION_WIDTHS'],
+        rendition_formats=current_app.config['RENDITION_FORMATS']
+    )
+    return upload_analyzed(analysis, stream, file_size, filename, content_type)
+
+
+def upload_analyzed(analysis, stream, file_size: int, filename: str, content_type: str) -> dict:
+    """检查相似图片后上传原图、缩略图和衍生图（analysis为已完成的图片分析结果）"""
+    # 开启拒绝时（PHASH_DUPLICATE_DISTANCE不小于0），缩放、重新编码后的相似图片不再重复入库
+    max_distance = current_app.config['PHASH_DUPLICATE_DISTANCE']
+    if analysis.phash and max_distance >= 0:
+        matches = phash_index.find(analysis.phash, max_distance)
+        if matches:
+            raise SimilarPhotoExists(matches[0][1])
+
+    tos_url = tos_client.upload_file(stream, filename, content_type, content_length=file_size)
+    thumbnail_url = None
+    if analysis.thumbnail:
+        thumbnail_url = tos_client.upload_thumbnail(analysis.thumbnail, filename)
+    tos_client.upload_renditions(analysis.renditions, filename)
+
+    return {
+        'tos_url': tos_url,
+        'thumbnail_url': thumbnail_url,
+        'width': analysis.width,
+        'height': analysis.height,
+        'phash': analysis.phash,
+        'colors': analysis.colors,
+        'color_histogram': analysis.color_histogram,
+        'placeholder': analysis.placeholder,
+        'renditions': encode_renditions(analysis.renditions)
+    }
+
+
+def process_file(app, stream, file_size: int, original_filename: str, content_type: str, file_hash: str) -> dict:
+    """处理单个文件：上传原图、生成并上传缩略图、读取图片信息，返回Photo字段（不写数据库）
+
+    stream 为可seek的文件对象，原图直接从中流式上传，不会整体读入内存。
+    """
+    with app.app_context():
+        filename = tos_client.generate_filename(original_filename, file_hash)
+        fields = upload_and_analyze(stream, file_size, filename, content_type)
+        fields.update({
+            'title': secure_filename(original_filename).rsplit('.', 1)[0],
+            'filename': filename,
+            'original_filename': original_filename,
+            'file_size': file_size,
+            'mime_type': content_type,
+            'hash_value': file_hash
+        })
+        return fields
+
+
+def drop_similar_in_batch(results: list, errors: list) -> list:
+    """开启相似图片拒绝时，同一批中与前面的文件相似的文件不入库并删除已上传的对象（索引要到写入后才更新）"""
+    max_distance = current_app.config['PHASH_DUPLICATE_DISTANCE']
+    if max_distance < 0:
+        return results
+    tree = BKTree()
+    kept = []
+    for name, fields in results:
+        phash = fields.get('phash')
+        if informative_hash(phash):
+            matches = tree.search(int(phash, 16), max_distance)
+            if matches:
+                errors.append(f'{name}: 与同批文件 {min(matches)[1]} 相似')
+                tos_client.delete_objects(storage_keys(fields['filename'], fields.get('renditions')))
+                continue
+            tree.add(int(phash, 16), name)
+        kept.append((name, fields))
+    return kept
+
+
+def save_photos(results: list, errors: list) -> list:
+    """在一个事务中写入所有Photo记录；批量提交失败时逐条重试以定位出错的文件"""
+    results = drop_similar_in_batch(results, errors)
+    photos = [(name, Photo(**fields)) for name, fields in results]
+    if not photos:
+        return []
+
+    try:
+        db.session.add_all([photo for _, photo in photos])
+        db.session.commit()
+        saved = [photo for _, photo in photos]
+    except Exception:
+        db.session.rollback()
+        saved = []
+        for name, fields in results:
+            try:
+                photo = Photo(**fields)
+                db.session.add(photo)
+                db.session.commit()
+                saved.append(photo)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(f'{name}: 上传失败 - {str(e)}')
+
+    for photo in saved:
+        phash_index.add(photo.id, photo.phash)
+        color_index.add(photo.id, photo.color_histogram)
+    return saved
+
+
+def prepare_files(app, files, max_size: int, errors: list) -> list:
+    """检查大小并去重（批次内 + 一次查询数据库），返回待处理的 (文件名, 类型, 流, 大小, 哈希)"""
+    pending = []
+    seen_hashes = set()
+
+    for file in files:
+        if not (file and file.filename):
+            continue
+        try:
+            # 文件在接收时已写入缓冲并计算哈希，这里只取大小和哈希值
+            file_size, file_hash = spool_upload(file.stream, app.config['UPLOAD_CHUNK_SIZE'])
+
+            # 检查文件大小
+            if file_size > max_size:
+                errors.append(f'{file.filename}: 文件大小超过限制')
+                continue
+
+            # 同一批次内的重复文件只处理一次
+            if file_hash in seen_hashes:
+                errors.append(f'{file.filename}: 文件已存在')
+                continue
+            seen_hashes.add(file_hash)
+            pending.append((file.filename, file.content_type, file.stream, file_size, file_hash))
+        except Exception as e:
+            errors.append(f'{file.filename}: 上传失败 - {str(e)}')
+
+    # 一次查询检查数据库中已存在的文件
+    if pending:
+        existing = {
+            row.hash_value for row in
+            db.session.query(Photo.hash_value).filter(Photo.hash_value.in_(list(seen_hashes)))
+        }
+        duplicates = [item for item in pending if item[4] in existing]
+        for item in duplicates:
+            errors.append(f'{item[0]}: 文件已存在')
+        pending = [item for item in pending if item[4] not in existing]
+
+    return pending
+
+
+def ingest_files(app, files, max_size: int) -> tuple:
+    """并发处理一批上传文件：逐个去重，CPU与TOS工作并行执行，最后一次性写入数据库
+
+    返回 (保存成功的Photo列表, 错误信息列表)，错误信息格式与逐个上传时一致。
+    """
+    errors = []
+    pending = prepare_files(app, files, max_size, errors)
+
+    # 并发执行缩略图生成与TOS上传
+    executor = get_executor(app)
+    futures = [
+        (name, executor.submit(process_file, app, stream, file_size, name, content_type, file_hash))
+        for name, content_type, stream, file_size, file_hash in pending
+    ]
+
+    results = []
+    for name, future in futures:
+        try:
+            results.append((name, future.result()))
+        except SimilarPhotoExists as e:
+            errors.append(f'{name}: {str(e)}')
+        except DecodeRejected:
+            errors.append(f'{name}: {BUSY_ERROR}')
+        except Exception as e:
+            errors.append(f'{name}: 上传失败 - {str(e)}')
+
+    return save_photos(results, errors), errors
+
+
+class DirectUploadInvalid(Exception):
+    """浏览器直传的对象不存在或与声明的内容不一致"""
+
+
+def fetch_direct_upload(app, key: str, file_hash: str, max_size: int) -> HashingSpooledFile:
+    """分块下载浏览器直传的原图到上传缓冲并校验大小和MD5，内容不符时删除该对象"""
+    spool = HashingSpooledFile(app.config['UPLOAD_SPOOL_MAX_MEMORY'])
+    try:
+        for chunk in tos_client.download_chunks(key, app.config['UPLOAD_CHUNK_SIZE']):
+            spool.write(chunk)
+            if spool.size > max_size:
+                raise DirectUploadInvalid('文件大小超过限制')
+        if spool.hexdigest() != file_hash:
+            raise DirectUploadInvalid('文件内容与哈希不一致')
+    except KeyError:
+        spool.close()
+        raise DirectUploadInvalid('文件尚未上传')
+    except DirectUploadInvalid:
+        spool.close()
+        tos_client.delete_objects([key])
+        raise
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def finalize_file(app, original_filename: str, content_type: str, file_hash: str, max_size: int) -> dict:
+    """校验浏览器直传的原图，生成并上传缩略图和衍生图，返回Photo字段（不写数据库）"""
+    with app.app_context():
+        filename = tos_client.generate_filename(original_filename, file_hash, content_addressed=True)
+        key = f"photos/{filename}"
+        with fetch_direct_upload(app, key, file_hash, max_size) as stream:
+            file_size = stream.size
+            try:
+                # 原图已在存储中，upload_file只做HEAD检查，不会重复上传
+                fields = upload_and_analyze(stream, file_size, filename, content_type)
+            except SimilarPhotoExists:
+                tos_client.delete_objects([key])
+                raise
+        fields.update({
+            'title': secure_filename(original_filename).rsplit('.', 1)[0],
+            'filename': filename,
+            'original_filename': original_filename,
+            'file_size': file_size,
+            'mime_type': content_type,
+            'hash_value': file_hash
+        })
+        return fields
+
+
+def finalize_uploads(app, items: list, max_size: int) -> tuple:
+    """并发校验并入库一批浏览器直传的文件，items为 (原文件名, 类型, 哈希) 列表
+
+    返回 (保存成功的Photo列表, 错误信息列表)，与ingest_files一致。
+    """
+    errors = []
+    pending = []
+    seen_hashes = set()
+    for name, content_type, file_hash in items:
+        if file_hash in seen_hashes:
+            errors.append(f'{name}: 文件已存在')
+            continue
+        seen_hashes.add(file_hash)
+        pending.append((name, content_type, file_hash))
+
+    # 一次查询检查数据库中已存在的文件（对象属于已有图片，不能删除）
+    if pending:
+        existing = {
+            row.hash_value for row in
+            db.session.query(Photo.hash_value).filter(Photo.hash_value.in_(list(seen_hashes)))
+        }
+        errors.extend(f'{item[0]}: 文件已存在' for item in pending if item[2] in existing)
+        pending = [item for item in pending if item[2] not in existing]
+
+    executor = get_executor(app)
+    futures = [
+        (name, executor.submit(finalize_file, app, name, content_type, file_hash, max_size))
+        for name, content_type, file_hash in pending
+    ]
+
+    results = []
+    for name, future in futures:
+        try:
+            results.append((name, future.result()))
+        except (SimilarPhotoExists, DirectUploadInvalid) as e:
+            errors.append(f'{name}: {str(e)}')
+        except DecodeRejected:
+            errors.append(f'{name}: {BUSY_ERROR}')
+        except Exception as e:
+            errors.append(f'{name}: 上传失败 - {str(e)}')
+
+    return save_photos(results, errors), errors
+
+
+class MemberTooLarge(Exception):
+    """压缩包成员解压后超过大小限制"""
+
+
+def extract_member(app, archive, info, max_size: int) -> HashingSpooledFile:
+    """按块解压单个成员到上传缓冲并计算哈希；按实际解压字节数限制大小，不信任文件头中记录的大小"""
+    if info.file_size > max_size:
+        raise MemberTooLarge()
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    spool = HashingSpooledFile(app.config['UPLOAD_SPOOL_MAX_MEMORY'])
+    try:
+        with archive.open(info) as member:
+            while True:
+                chunk = member.read(chunk_size)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                if spool.size > max_size:
+                    raise MemberTooLarge()
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def zip_image_members(app, archive) -> tuple:
+    """列出压缩包中的图片成员，返回 (图片成员列表, 跳过的成员名列表)"""
+    images = []
+    skipped = []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        basename = info.filename.rsplit('/', 1)[-1]
+        extension = basename.rsplit('.', 1)[-1].lower() if '.' in basename else ''
+        # 跳过macOS生成的资源文件、隐藏文件和非图片文件
+        if (info.filename.startswith('__MACOSX/') or basename.startswith('.')
+                or extension not in app.config['ALLOWED_EXTENSIONS']):
+            skipped.append(info.filename)
+        else:
+            images.append(info)
+    return images, skipped
+
+
+def ingest_zip(app, stream, max_size: int) -> tuple:
+    """逐个解压ZIP成员并按批次走普通上传的去重、缩略图和TOS上传流程
+
+    同一时间只有一个批次（UPLOAD_WORKERS的两倍）的成员处于解压状态，内存占用与压缩包大小无关。
+    返回 (保存成功的Photo列表, 错误信息列表, 每个成员的处理结果列表)。
+    """
+    photos = []
+    errors = []
+    members = []
+
+    with zipfile.ZipFile(stream) as archive:
+        images, skipped = zip_image_members(app, archive)
+        members.extend({'name': name, 'status': 'skipped'} for name in skipped)
+
+        max_members = app.config['ZIP_MAX_MEMBERS']
+        for info in images[max_members:]:
+            errors.append(f'{info.filename}: 压缩包内图片数量超过限制')
+            members.append({'name': info.filename, 'status': 'failed', 'error': '压缩包内图片数量超过限制'})
+        images = images[:max_members]
+
+        window = app.config['UPLOAD_WORKERS'] * 2
+        for start in range(0, len(images), window):
+            files = []
+            try:
+                for info in images[start:start + window]:
+                    try:
+                        spool = extract_member(app, archive, info, max_size)
+                    except MemberTooLarge:
+                        error = '文件大小超过限制'
+                    except Exception as e:
+                        error = f'解压失败 - {str(e)}'
+                    else:
+                        files.append(FileStorage(
+                            stream=spool,
+                            filename=info.filename,
+                            content_type=mimetypes.guess_type(info.filename)[0] or 'application/octet-stream'
+                        ))
+                        continue
+                    errors.append(f'{info.filename}: {error}')
+                    members.append({'name': info.filename, 'status': 'failed', 'error': error})
+
+                saved, batch_errors = ingest_files(app, files, max_size)
+            finally:
+                for file in files:
+                    file.stream.close()
+
+            photos.extend(saved)
+            errors.extend(batch_errors)
+            saved_ids = {photo.original_filename: photo.id for photo in saved}
+            for file in files:
+                if file.filename in saved_ids:
+                    members.append({'name': file.filename, 'status': 'uploaded', 'id': saved_ids[file.filename]})
+                    continue
+                prefix = f'{file.filename}: '
+                error = next((e[len(prefix):] for e in batch_errors if e.startswith(prefix)), '上传失败')
+                members.append({'name': file.filename, 'status': 'failed', 'error': error})
+
+    return photos, errors, members
+
+
+def create_ingest_job(app, files, max_size: int) -> tuple:
+    """暂存原始文件并创建pending状态的Photo记录和入库任务，返回 (任务, 错误信息列表)
+
+    没有需要处理的文件时任务为None。缩略图、图片信息和TOS上传由IngestWorker在后台完成。
+    """
+    errors = []
+    pending = prepare_files(app, files, max_size, errors)
+    if not pending:
+        return None, errors
+
+    job = IngestJob(job_id=uuid.uuid4().hex, status='pending', total=len(pending))
+    spool_dir = os.path.join(app.config['INGEST_SPOOL_DIR'], job.job_id)
+    os.makedirs(spool_dir, exist_ok=True)
+
+    try:
+        for index, (name, content_type, stream, file_size, file_hash) in enumerate(pending):
+            # 按块复制到暂存目录，请求结束后由后台线程读取
+            spool_path = os.path.join(spool_dir, str(index))
+            stream.seek(0)
+            with open(spool_path, 'wb') as spool_file:
+                shutil.copyfileobj(stream, spool_file, app.config['UPLOAD_CHUNK_SIZE'])
+
+            photo = Photo(
+                title=secure_filename(name).rsplit('.', 1)[0],
+                filename=tos_client.generate_filename(name, file_hash),
+                original_filename=name,
+                tos_url='',
+                file_size=file_size,
+                mime_type=content_type,
+                hash_value=file_hash,
+                status='pending'
+            )
+            db.session.add(photo)
+            db.session.flush()
+            job.items.append(IngestJobItem(
+                photo_id=photo.id,
+                original_filename=name,
+                spool_path=spool_path,
+                status='pending'
+            ))
+
+        db.session.add(job)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        raise
+
+    return job, errors
+
+
+class IngestWorker:
+    """进程内的异步入库工作池，任务状态保存在数据库中"""
+
+    def __init__(self):
+        self.app = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """注册工作池；开启INGEST_WORKER_ENABLED的服务进程立即启动并恢复未完成的文件，其他进程（命令行脚本、测试）在首次异步上传时才创建线程池"""
+        self.app = app
+        self.executor = None
+        app.extensions['ingest_worker'] = self
+        if app.config['INGEST_WORKER_ENABLED']:
+            self._start()
+            self.resume()
+
+    def _start(self):
+        """创建线程池（只创建一次）"""
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    os.makedirs(self.app.config['INGEST_SPOOL_DIR'], exist_ok=True)
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.app.config['INGEST_WORKERS'],
+                        thread_name_prefix='ingest-job'
+                    )
+
+    def resume(self):
+        """重新提交上次进程退出时未完成的文件"""
+        app = self.app
+        with app.app_context():
+            # 长时间停留在processing的文件视为处理进程已退出，重新排队
+            stale_before = datetime.utcnow() - timedelta(seconds=app.config['INGEST_STALE_SECONDS'])
+            IngestJobItem.query.filter(
+                IngestJobItem.status == 'processing',
+                IngestJobItem.updated_at < stale_before
+            ).update({'status': 'pending'}, synchronize_session=False)
+            db.session.commit()
+
+            item_ids = [row.id for row in db.session.query(IngestJobItem.id).filter_by(status='pending')]
+        for item_id in item_ids:
+            self.submit(item_id)
+
+    def submit_job(self, job):
+        """提交任务中的所有文件"""
+        for item in job.items:
+            self.submit(item.id)
+
+    def submit(self, item_id: int):
+        """提交单个文件到线程池"""
+        self._start()
+        self.executor.submit(self._run_item, item_id)
+
+    def _run_item(self, item_id: int):
+        with self.app.app_context():
+            # 原子地认领文件，避免同一文件被重复处理
+            claimed = IngestJobItem.query.filter_by(id=item_id, status='pending').update(
+                {'status': 'processing', 'updated_at': datetime.utcnow()}, synchronize_session=False
+            )
+            db.session.commit()
+            if not claimed:
+                return
+
+            item = IngestJobItem.query.get(item_id)
+            job = item.job
+            if job.status == 'pending':
+                job.status = 'processing'
+                db.session.commit()
+
+            try:
+                photo = Photo.query.get(item.photo_id)
+                with open(item.spool_path, 'rb') as stream:
+                    fields = upload_and_analyze(stream, photo.file_size, photo.filename, photo.mime_type)
+                for name, value in fields.items():
+                    setattr(photo, name, value)
+                photo.status = 'ready'
+                item.status = 'completed'
+                item.error_message = None
+                db.session.commit()
+                phash_index.add(photo.id, photo.phash)
+                color_index.add(photo.id, photo.color_histogram)
+                tag_index.set_visible(photo.id, bool(photo.is_public))
+            except DecodeRejected:
+                # 服务器繁忙不算失败：保留暂存文件和pending记录，稍后重新排队
+                db.session.rollback()
+                item.status = 'pending'
+                item.error_message = BUSY_ERROR
+                db.session.commit()
+                self.retry_later(item_id)
+                return
+            except Exception as e:
+                db.session.rollback()
+                print(f"异步入库失败 ({item.original_filename}): {e}")
+                # 删除pending记录，释放hash_value以便重新上传（同时清理标签、全文索引等关联）
+                pending_ids = [row.id for row in db.session.query(Photo.id).filter_by(id=item.photo_id, status='pending')]
+                if pending_ids:
+                    delete_photo_rows(pending_ids)
+                item.photo_id = None
+                item.status = 'failed'
+                item.error_message = str(e) if isinstance(e, SimilarPhotoExists) else f'上传失败 - {str(e)}'
+                db.session.commit()
+                tag_index.remove_photos(pending_ids)
+
+            self._remove_spool_file(item.spool_path)
+            self._finish_job_if_done(job)
+
+    def retry_later(self, item_id: int):
+        """BUSY_RETRY_SECONDS秒后重新提交文件"""
+        timer = threading.Timer(BUSY_RETRY_SECONDS, self.submit, [item_id])
+        timer.daemon = True
+        timer.start()
+
+    def _remove_spool_file(self, spool_path: str):
+        """删除暂存文件，目录为空时一并删除"""
+        try:
+            os.remove(spool_path)
+            os.rmdir(os.path.dirname(spool_path))
+        except OSError:
+            pass
+
+    def _finish_job_if_done(self, job):
+        """所有文件处理结束后将任务标记为完成"""
+        remaining = IngestJobItem.query.filter(
+            IngestJobItem.job_id == job.id,
+            IngestJobItem.status.in_(['pending', 'processing'])
+        ).count()
+        if remaining == 0 and job.status != 'completed':
+            job.status = 'completed'
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+
+
+# 全局异步入库工作池
+ingest_worker = IngestWorker()
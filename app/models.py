@@ -1,5 +1,7 @@
+import json
 from datetime import datetime
 from . import db
+from .tos_client import tos_client, rendition_key
 
 # 关联表
 photo_tag = db.Table('photo_tag',
@@ -8,6 +10,14 @@ photo_tag = db.Table('photo_tag',
     db.Column('created_at', db.DateTime, default=datetime.utcnow)
 )
 
+def storage_keys(filename: str, renditions: str = None) -> list:
+    """图片在TOS中的所有key：原图、缩略图和各尺寸衍生图"""
+    keys = [f"photos/{filename}", f"thumbnails/{filename}"]
+    if renditions:
+        data = json.loads(renditions)
+        keys.extend(rendition_key(filename, width, fmt) for width, _ in data['s'] for fmt in data['f'])
+    return keys
+
 class Photo(db.Model):
     """图片模型"""
     __tablename__ = 'photo'
@@ -21,6 +31,8 @@ class Photo(db.Model):
     # TOS存储相关
     tos_url = db.Column(db.String(500), nullable=False)  # 原图TOS URL
     thumbnail_url = db.Column(db.String(500))  # 缩略图TOS URL
+    renditions = db.Column(db.Text)  # 多尺寸衍生图，JSON：{"s": [[宽, 高], ...], "f": [格式, ...]}
+    placeholder = db.Column(db.String(512))  # 加载前显示的模糊占位图（WebP data URI）
     
     # 文件信息
     file_size = db.Column(db.Integer)
@@ -28,6 +40,9 @@ class Photo(db.Model):
     height = db.Column(db.Integer)
     mime_type = db.Column(db.String(50))
     hash_value = db.Column(db.String(64), unique=True, index=True)  # 防重复上传
+    phash = db.Column(db.String(16), index=True)  # 感知哈希（dHash），用于检测缩放、重新编码后的相似图片
+    colors = db.Column(db.String(64))  # 主色，逗号分隔的 #rrggbb，按占比降序
+    color_histogram = db.Column(db.LargeBinary(64))  # 64区间颜色直方图，用于按颜色搜索
     
     # 时间戳
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -36,29 +51,62 @@ class Photo(db.Model):
     # 状态
     is_public = db.Column(db.Boolean, default=True, index=True)
     view_count = db.Column(db.Integer, default=0)
+    # 入库状态：pending（异步处理中）、ready（可用）
+    status = db.Column(db.String(20), default='ready', server_default='ready', nullable=False, index=True)
     
     # 关系
     tags = db.relationship('Tag', secondary='photo_tag', back_populates='photos')
     
+    # 列表按 (排序字段, ID) 游标分页时使用的复合索引
+    __table_args__ = (
+        db.Index('ix_photo_created_at_id', 'created_at', 'id'),
+        db.Index('ix_photo_view_count_id', 'view_count', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Photo {self.title}>'
     
+    def get_renditions(self) -> list:
+        """展开衍生图片列表，按宽度升序"""
+        if not self.renditions:
+            return []
+        data = json.loads(self.renditions)
+        return [
+            {'width': width, 'height': height, 'format': fmt,
+             'url': tos_client.media_url(rendition_key(self.filename, width, fmt))}
+            for width, height in data['s'] for fmt in data['f']
+        ]
+    
+    def rendition_keys(self) -> list:
+        """衍生图片在TOS中的key，删除图片时使用"""
+        return storage_keys(self.filename, self.renditions)[2:]
+    
     def to_dict(self):
         """转换为字典格式"""
+        renditions = self.get_renditions()
         return {
             'id': self.id,
             'title': self.title,
             'description': self.description,
             'filename': self.filename,
             'original_filename': self.original_filename,
-            'tos_url': self.tos_url,
-            'thumbnail_url': self.thumbnail_url,
+            'tos_url': tos_client.media_url(f"photos/{self.filename}", self.tos_url),
+            'thumbnail_url': tos_client.media_url(f"thumbnails/{self.filename}", self.thumbnail_url) if self.thumbnail_url else None,
+            'placeholder': self.placeholder,
+            'renditions': renditions,
+            # 可直接用于<img srcset>/<source srcset>的字符串，按格式分组
+            'srcset': {
+                fmt: ', '.join(f"{r['url']} {r['width']}w" for r in renditions if r['format'] == fmt)
+                for fmt in dict.fromkeys(r['format'] for r in renditions)
+            },
             'file_size': self.file_size,
             'width': self.width,
             'height': self.height,
             'mime_type': self.mime_type,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'view_count': self.view_count,
+            'status': self.status,
+            'colors': self.colors.split(',') if self.colors else [],
             'tags': [{'id': tag.id, 'name': tag.name, 'color': tag.color} for tag in self.tags]
         }
 
@@ -212,4 +260,63 @@ class Favorite(db.Model):
             'session_id': self.session_id,
             'generation_result_id': self.generation_result_id,
             'created_at': self.created_at.isoformat() if self.created_at else None
-        }
\ No newline at end of file
+        }
+
+
+class IngestJob(db.Model):
+    """异步入库任务模型"""
+    __tablename__ = 'ingest_job'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    job_id = db.Column(db.String(36), unique=True, nullable=False, index=True)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending、processing、completed
+    total = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    # 关系
+    items = db.relationship('IngestJobItem', back_populates='job', cascade='all, delete-orphan',
+                            order_by='IngestJobItem.id')
+    
+    def to_dict(self):
+        """转换为字典格式"""
+        counts = {'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0}
+        for item in self.items:
+            counts[item.status] = counts.get(item.status, 0) + 1
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'total': self.total,
+            'progress': counts,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'items': [item.to_dict() for item in self.items]
+        }
+
+
+class IngestJobItem(db.Model):
+    """异步入库任务中的单个文件"""
+    __tablename__ = 'ingest_job_item'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('ingest_job.id'), nullable=False, index=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id', ondelete='SET NULL'))
+    original_filename = db.Column(db.String(255), nullable=False)
+    spool_path = db.Column(db.String(500))  # 原始文件在本地暂存的路径，处理完成后删除
+    status = db.Column(db.String(20), default='pending', index=True)  # pending、processing、completed、failed
+    error_message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # 关系
+    job = db.relationship('IngestJob', back_populates='items')
+    
+    def to_dict(self):
+        """转换为字典格式"""
+        return {
+            'id': self.id,
+            'photo_id': self.photo_id,
+            'original_filename': self.original_filename,
+            'status': self.status,
+            'error_message': self.error_message
+        }
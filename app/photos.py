@@ -0,0 +1,32 @@
+from sqlalchemy import case, func, select, update
+from . import db
+from .models import Photo, Tag, ImageGenerationTask, GenerationResult, IngestJobItem, photo_tag
+from .search_index import search_index
+
+
+def delete_photo_rows(photo_ids: list):
+    """用集合操作删除图片及其关联（不提交）：标签使用次数、标签关联、外键引用和图片记录"""
+    # 按每个标签被删除的关联数量一次性扣减使用次数
+    removed_links = select(func.count()).select_from(photo_tag).where(
+        photo_tag.c.tag_id == Tag.id,
+        photo_tag.c.photo_id.in_(photo_ids)
+    ).scalar_subquery()
+    db.session.execute(
+        update(Tag)
+        .where(Tag.id.in_(select(photo_tag.c.tag_id).where(photo_tag.c.photo_id.in_(photo_ids))))
+        .values(usage_count=case((Tag.usage_count > removed_links, Tag.usage_count - removed_links), else_=0))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(photo_tag.delete().where(photo_tag.c.photo_id.in_(photo_ids)))
+
+    # 解除其他表对图片的引用
+    for column in (ImageGenerationTask.input_image_id, GenerationResult.generated_image_id, IngestJobItem.photo_id):
+        db.session.execute(
+            update(column.class_).where(column.in_(photo_ids)).values({column.key: None})
+            .execution_options(synchronize_session=False)
+        )
+
+    db.session.execute(
+        Photo.__table__.delete().where(Photo.id.in_(photo_ids))
+    )
+    search_index.remove(photo_ids)
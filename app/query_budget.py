@@ -0,0 +1,59 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, make_response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    """请求执行的SQL数量超过预算"""
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """所有引擎执行SQL前调用：累加当前线程上所有计数器"""
+    for counter in getattr(_local, 'counters', ()):
+        counter.count += 1
+        counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    """统计代码块内当前线程执行的SQL数量，可嵌套使用"""
+    counter = QueryCounter()
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+def query_budget(limit: int):
+    """限制视图执行的SQL数量：响应头X-Query-Count返回实际数量，超出预算时测试环境抛出异常、生产环境打印警告"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with count_queries() as counter:
+                response = make_response(view(*args, **kwargs))
+            response.headers['X-Query-Count'] = str(counter.count)
+            if counter.count > limit:
+                message = f'{request.endpoint} 执行了 {counter.count} 条SQL，超过预算 {limit}'
+                if current_app.testing or current_app.config['QUERY_BUDGET_STRICT']:
+                    raise QueryBudgetExceeded(message + ':\n' + '\n'.join(counter.statements))
+                print(message)
+            return response
+        wrapper.query_budget = limit
+        return wrapper
+    return decorator
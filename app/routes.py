@@ -1,13 +1,33 @@
-from flask import Blueprint, request, jsonify, render_template
-from sqlalchemy import or_
+from flask import Blueprint, request, jsonify, render_template, current_app, url_for, send_file
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import selectinload
 import random
+import requests
 import time
 import os
 import json
+import re
+from datetime import datetime
+import hashlib
+import base64
+import mimetypes
+import zipfile
+from itertools import islice
 from . import db
-from .models import Photo, Tag, ImageGenerationTask, GenerationResult, GenerationParameter, Favorite
-from .tos_client import tos_client
-from werkzeug.utils import secure_filename
+from .models import Photo, Tag, ImageGenerationTask, GenerationResult, GenerationParameter, Favorite, IngestJob, storage_keys
+from .tos_client import tos_client, decode_scheduler, DecodeRejected, RENDITION_FORMATS
+from .ingest import (ingest_files, ingest_zip, finalize_uploads, create_ingest_job, ingest_worker, upload_and_analyze,
+                     SimilarPhotoExists, all_busy, BUSY_ERROR, BUSY_RETRY_SECONDS)
+from .storage import verify_upload_signature, upload_signing_key
+from .upload_stream import HashingSpooledFile
+from .similarity import phash_index
+from .colors import color_index, parse_color
+from .search_index import search_index
+from .photos import delete_photo_rows
+from .tag_index import tag_index, TagExpressionError
+from .disk_cache import SingleFlight
+from .query_budget import query_budget
+from io import BytesIO
 # 导入图生图功能
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -24,6 +44,36 @@ def generate_random_color():
     ]
     return random.choice(colors)
 
+# 单次哈希预检查的最大数量
+MAX_HASH_CHECK = 1000
+
+# 浏览器直传每次请求最多包含的文件数量
+MAX_DIRECT_UPLOADS = 100
+MD5_HEX_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# 媒体代理：允许访问的key前缀，对象key不变则内容不变，可长期缓存
+MEDIA_PREFIXES = ('photos/', 'thumbnails/', 'renditions/')
+media_flight = SingleFlight()
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+# 图片列表支持的排序字段（游标分页时与ID组成排序键）
+PHOTO_SORT_COLUMNS = {
+    'created_at': Photo.created_at,
+    'views': Photo.view_count
+}
+# 游标分页每页最多返回的图片数量
+MAX_PAGE_SIZE = 200
+
+# 按颜色搜索时最多取回的候选图片数量
+COLOR_SEARCH_CANDIDATES = 1000
+
+# 批量删除每次请求最多删除的图片数量
+MAX_BULK_DELETE = 1000
+
+# 按需缩放图片：同一尺寸的并发请求只渲染一次
+variant_flight = SingleFlight()
+VARIANT_MAX_AGE = 365 * 24 * 3600
+
 # 定义蓝图
 bp = Blueprint('api', __name__, template_folder='templates')
 
@@ -48,6 +98,7 @@ def gallery():
     return render_template('gallery.html')
 
 @bp.route('/ai_create')
+@query_budget(1)
 def ai_create():
     """AI二创页面"""
     # 从数据库获取最近生成的图片，最多获取10张
@@ -62,36 +113,86 @@ def creative():
     return render_template('creative.html')
 
 @bp.route('/api/photos', methods=['GET'])
+@query_budget(3)
 def get_photos():
-    """获取图片列表"""
+    """获取图片列表：校验参数后交给photo_page按筛选和排序方式选择分页函数"""
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 20, type=int)
     # 同时支持tag和tag_id参数以兼容前端
     tag_id = request.args.get('tag_id', type=int) or request.args.get('tag', type=int)
+    # 标签表达式，如 猫 AND (户外 OR 草地)
+    tags_expression = request.args.get('tags', '').strip()
     search = request.args.get('search', '').strip()
+    color = request.args.get('color', '').strip()
+    order_by = request.args.get('order_by', 'created_at')
+    order_dir = request.args.get('order_dir', 'desc')
+    if order_by == 'relevance' and (not search or 'cursor' in request.args):
+        return jsonify({'error': '按相关度排序需要搜索词，且不支持游标分页'}), 400
+    if (order_by not in PHOTO_SORT_COLUMNS and order_by != 'relevance') or order_dir not in ('asc', 'desc'):
+        return jsonify({'error': '不支持的排序方式'}), 400
+    rgb = None
+    if color:
+        rgb = parse_color(color)
+        if rgb is None:
+            return jsonify({'error': '颜色格式应为 #RRGGBB'}), 400
     
-    # 构建查询
-    query = Photo.query.filter_by(is_public=True)
+    try:
+        return jsonify(photo_page(tag_id, tags_expression, search, rgb, order_by, order_dir, page, per_page))
+    except TagExpressionError as e:
+        return jsonify({'error': str(e)}), 400
+    except CursorInvalid as e:
+        return jsonify({'error': str(e)}), 400
+
+def photo_page(tag_id, tags_expression: str, search: str, rgb, order_by: str, order_dir: str, page: int, per_page: int) -> dict:
+    """按筛选和排序方式选择一种分页：标签位图、相关度、颜色得分、游标或页码"""
+    # 只按上传时间排序时标签表达式在内存位图索引中求交并，按ID顺序取出一页，再按主键取回
+    if tags_expression and order_by == 'created_at' and not (tag_id or search or rgb):
+        return tag_expression_page(tag_index.evaluate(tags_expression), order_dir, page, per_page)
     
-    # 按标签筛选
-    if tag_id:
-        query = query.join(Photo.tags).filter(Tag.id == tag_id)
+    query = filtered_photos(tag_id, tags_expression)
+    
+    # 按相关度搜索：连接全文索引的相关度，在筛选后的查询上排序分页
+    if search and order_by == 'relevance' and rgb is None:
+        scores = search_index.scores(search)
+        if scores is not None:
+            return relevance_page(query.join(scores, scores.c.photo_id == Photo.id), scores.c.score, page, per_page)
+        # 全文索引不可用，按创建时间排序
+        order_by = 'created_at'
     
-    # 搜索
+    # 搜索：使用标题、描述和标签名的全文索引
     if search:
-        query = query.filter(
-            or_(
-                Photo.title.contains(search),
-                Photo.description.contains(search)
-            )
-        )
+        query = search_index.filter(query, search, ordered_scan='cursor' in request.args)
+    
+    # 按颜色搜索：从内存索引取出得分最高的候选，再按其他条件筛选，结果按得分排序
+    if rgb is not None:
+        return color_search_page(query, rgb, page, per_page)
+    
+    # 游标分页：带cursor参数（首页为空字符串）时按 (排序字段, ID) 键集分页，不再统计总数
+    if 'cursor' in request.args:
+        per_page = min(max(per_page, 1), MAX_PAGE_SIZE)
+        with_total = request.args.get('with_total', '').lower() in ('1', 'true')
+        return cursor_page(query, order_by, order_dir, request.args['cursor'], per_page, with_total)
     
-    # 分页
-    photos = query.order_by(Photo.created_at.desc()).paginate(
+    return offset_page(query, order_by, order_dir, page, per_page)
+
+def filtered_photos(tag_id, tags_expression: str):
+    """公开且已入库的图片查询，按标签ID和标签表达式（转为SQL条件）筛选"""
+    query = Photo.query.filter_by(is_public=True, status='ready')
+    if tag_id:
+        query = query.join(Photo.tags).filter(Tag.id == tag_id)
+    if tags_expression:
+        query = tag_index.filter(query, tags_expression)
+    return query
+
+def offset_page(query, order_by: str, order_dir: str, page: int, per_page: int) -> dict:
+    """按页码分页（标签用一次IN查询批量加载，避免逐张图片懒加载）"""
+    column = PHOTO_SORT_COLUMNS.get(order_by, Photo.created_at)
+    ordering = (column.desc(), Photo.id.desc()) if order_dir == 'desc' else (column.asc(), Photo.id.asc())
+    photos = query.options(selectinload(Photo.tags)).order_by(*ordering).paginate(
         page=page, per_page=per_page, error_out=False
     )
     
-    return jsonify({
+    return {
         'photos': [photo.to_dict() for photo in photos.items],
         'pagination': {
             'page': photos.page,
@@ -101,9 +202,160 @@ def get_photos():
             'has_prev': photos.has_prev,
             'has_next': photos.has_next
         }
-    })
+    }
+
+class CursorInvalid(ValueError):
+    """分页游标无效或与当前排序方式不一致"""
+
+def encode_cursor(order_by: str, order_dir: str, value, photo_id: int) -> str:
+    """把当前页最后一张图片的排序值和ID编码为不透明的游标"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([order_by, order_dir, value, photo_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, order_by: str, order_dir: str) -> tuple:
+    """解析游标，返回 (排序值, 图片ID)；游标无效或与当前排序方式不一致时抛出CursorInvalid"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_order, cursor_dir, value, photo_id = json.loads(raw)
+        if order_by == 'created_at':
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise CursorInvalid('分页游标无效')
+    if (cursor_order, cursor_dir) != (order_by, order_dir) or not isinstance(photo_id, int):
+        raise CursorInvalid('分页游标无效')
+    return value, photo_id
+
+def cursor_page(query, order_by: str, order_dir: str, cursor: str, per_page: int, with_total: bool) -> dict:
+    """键集分页：以上一页最后一张图片的 (排序值, ID) 为起点，查询耗时与翻页深度无关"""
+    column = PHOTO_SORT_COLUMNS[order_by]
+    descending = order_dir == 'desc'
+    total = query.order_by(None).count() if with_total else None
+    
+    if cursor:
+        value, last_id = decode_cursor(cursor, order_by, order_dir)
+        if descending:
+            query = query.filter(or_(column < value, and_(column == value, Photo.id < last_id)))
+        else:
+            query = query.filter(or_(column > value, and_(column == value, Photo.id > last_id)))
+    
+    # 多取一条判断是否还有下一页
+    ordering = (column.desc(), Photo.id.desc()) if descending else (column.asc(), Photo.id.asc())
+    photos = query.options(selectinload(Photo.tags)).order_by(*ordering).limit(per_page + 1).all()
+    has_next = len(photos) > per_page
+    photos = photos[:per_page]
+    
+    pagination = {
+        'per_page': per_page,
+        'has_next': has_next,
+        'next_cursor': encode_cursor(order_by, order_dir, getattr(photos[-1], column.key), photos[-1].id) if has_next else None
+    }
+    if total is not None:
+        pagination['total'] = total
+    return {'photos': [photo.to_dict() for photo in photos], 'pagination': pagination}
+
+def tag_expression_page(matched, order_dir: str, page: int, per_page: int) -> dict:
+    """标签表达式结果分页：按图片ID排序（即上传顺序，导入或修改过上传时间的图片可能与created_at不一致），
+    在位图中按ID顺序取出一页，再按主键取回图片"""
+    descending = order_dir == 'desc'
+    
+    if 'cursor' in request.args:
+        # 游标只按图片ID定位，不能与按created_at排序的游标混用
+        per_page = min(max(per_page, 1), MAX_PAGE_SIZE)
+        cursor = request.args['cursor']
+        after = decode_cursor(cursor, 'id', order_dir)[1] if cursor else None
+        page_ids = list(islice(matched.ids(descending, after), per_page + 1))
+        has_next = len(page_ids) > per_page
+        page_ids = page_ids[:per_page]
+        photos = photos_by_ids(page_ids)
+        pagination = {
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': encode_cursor('id', order_dir, page_ids[-1], page_ids[-1]) if has_next else None
+        }
+        if request.args.get('with_total', '').lower() in ('1', 'true'):
+            pagination['total'] = len(matched)
+        return {'photos': [photo.to_dict() for photo in photos], 'pagination': pagination}
+    
+    page = max(page, 1)
+    total = len(matched)
+    pages = (total + per_page - 1) // per_page if per_page > 0 else 0
+    page_ids = list(islice(matched.ids(descending), (page - 1) * per_page, page * per_page))
+    return {
+        'photos': [photo.to_dict() for photo in photos_by_ids(page_ids)],
+        'pagination': {
+            'page': page,
+            'pages': pages,
+            'per_page': per_page,
+            'total': total,
+            'has_prev': page > 1,
+            'has_next': page < pages
+        }
+    }
+
+def photos_by_ids(photo_ids: list) -> list:
+    """按主键取回公开且已入库的图片（连同标签），保持传入的顺序"""
+    if not photo_ids:
+        return []
+    photos = {
+        photo.id: photo for photo in
+        Photo.query.options(selectinload(Photo.tags)).filter(
+            Photo.id.in_(photo_ids), Photo.is_public == True, Photo.status == 'ready'
+        )
+    }
+    return [photos[photo_id] for photo_id in photo_ids if photo_id in photos]
+
+def relevance_page(query, score, page: int, per_page: int) -> dict:
+    """按相关度排序分页，相关度写入relevance字段"""
+    photos = query.add_columns(score).options(selectinload(Photo.tags)).order_by(score.desc(), Photo.id.desc()).paginate(
+        page=page, per_page=per_page, error_out=False
+    )
+    return {
+        'photos': [dict(photo.to_dict(), relevance=round(value, 4)) for photo, value in photos.items],
+        'pagination': {
+            'page': photos.page,
+            'pages': photos.pages,
+            'per_page': photos.per_page,
+            'total': photos.total,
+            'has_prev': photos.has_prev,
+            'has_next': photos.has_next
+        }
+    }
+
+def color_search_page(query, rgb: tuple, page: int, per_page: int) -> dict:
+    """按颜色得分排序并分页"""
+    scores = {photo_id: score for score, photo_id in color_index.search(rgb, COLOR_SEARCH_CANDIDATES)}
+    matched_ids = [row.id for row in query.filter(Photo.id.in_(list(scores))).with_entities(Photo.id)] if scores else []
+    matched_ids.sort(key=lambda photo_id: -scores[photo_id])
+    return scored_page(matched_ids, scores, 'color_score', page, per_page)
+
+def scored_page(matched_ids: list, scores: dict, score_key: str, page: int, per_page: int) -> dict:
+    """对已按得分排序的图片ID分页，得分写入score_key字段"""
+    page = max(page, 1)
+    total = len(matched_ids)
+    pages = (total + per_page - 1) // per_page if per_page > 0 else 0
+    page_ids = matched_ids[(page - 1) * per_page:page * per_page]
+    photos = {
+        photo.id: photo for photo in
+        Photo.query.options(selectinload(Photo.tags)).filter(Photo.id.in_(page_ids))
+    } if page_ids else {}
+    
+    return {
+        'photos': [dict(photos[photo_id].to_dict(), **{score_key: round(scores[photo_id], 4)})
+                   for photo_id in page_ids if photo_id in photos],
+        'pagination': {
+            'page': page,
+            'pages': pages,
+            'per_page': per_page,
+            'total': total,
+            'has_prev': page > 1,
+            'has_next': page < pages
+        }
+    }
 
 @bp.route('/api/photos/<int:photo_id>', methods=['GET'])
+@query_budget(4)
 def get_photo(photo_id):
     """获取单张图片详情"""
     photo = Photo.query.get_or_404(photo_id)
@@ -114,6 +366,217 @@ def get_photo(photo_id):
     
     return jsonify(photo.to_dict())
 
+@bp.route('/api/photos/<int:photo_id>/similar', methods=['GET'])
+@query_budget(3)
+def get_similar_photos(photo_id):
+    """查找相似图片（基于感知哈希的BK树索引）"""
+    photo = Photo.query.get_or_404(photo_id)
+    distance = min(max(request.args.get('distance', 10, type=int), 0), 32)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    
+    if not photo.phash:
+        return jsonify({'photos': [], 'message': '该图片尚未计算感知哈希'})
+    
+    matches = phash_index.find(photo.phash, distance, exclude_id=photo.id)
+    distances = {}
+    for match_distance, match_id in matches:
+        distances.setdefault(match_id, match_distance)
+    
+    # 一次查询取回候选图片，按距离排序后截取
+    candidates = Photo.query.options(selectinload(Photo.tags)).filter(
+        Photo.id.in_(list(distances)),
+        Photo.is_public == True,
+        Photo.status == 'ready'
+    ).all() if distances else []
+    candidates.sort(key=lambda p: (distances[p.id], p.id))
+    
+    return jsonify({
+        'photos': [dict(p.to_dict(), distance=distances[p.id]) for p in candidates[:limit]]
+    })
+
+@bp.route('/img/<int:photo_id>/<int:width>x<int:height>.<fmt>', methods=['GET'])
+def get_image_variant(photo_id, width, height, fmt):
+    """按需生成指定尺寸的图片（等比缩放到宽高以内），结果写入磁盘缓存"""
+    fmt = 'jpeg' if fmt == 'jpg' else fmt
+    max_size = current_app.config['IMAGE_VARIANT_MAX_SIZE']
+    if fmt not in RENDITION_FORMATS or not (0 < width <= max_size and 0 < height <= max_size):
+        return jsonify({'error': '不支持的图片尺寸或格式'}), 400
+    
+    photo = Photo.query.filter_by(id=photo_id, status='ready').first_or_404()
+    
+    # 原图内容不变时同一尺寸的结果不变，ETag由文件哈希和尺寸决定，无需渲染即可判断304
+    etag = f'{photo.hash_value}-{width}x{height}.{fmt}'
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        cache = current_app.extensions['image_cache']
+        key = f'{photo.filename}/{width}x{height}.{fmt}'
+        
+        def render():
+            # 等待期间可能已由其他请求写入缓存
+            data = cache.get(key)
+            if data is None:
+                original = tos_client.download_file(f"photos/{photo.filename}")
+                data = tos_client.render_variant(original, (width, height), fmt)
+                cache.put(key, data)
+            return data
+        
+        data = cache.get(key)
+        if data is None:
+            try:
+                data = variant_flight.do(key, render)
+            except DecodeRejected as e:
+                return busy_response({'error': str(e)})
+            except Exception as e:
+                print(f"生成图片失败: {e}")
+                return jsonify({'error': '生成图片失败'}), 500
+        response = send_file(BytesIO(data), mimetype=RENDITION_FORMATS[fmt][2], conditional=False, max_age=VARIANT_MAX_AGE)
+    
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = VARIANT_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+def negotiate_media(key: str) -> tuple:
+    """按Accept选择返回的内容，返回 (存储key, 是否转码为WebP, 是否参与协商)
+
+    衍生图优先返回同尺寸的WebP版本，缩略图转码为WebP，原图和GIF保持原样。
+    """
+    stem, _, ext = key.rpartition('.')
+    if key.startswith('photos/') or ext.lower() not in ('jpg', 'jpeg', 'png'):
+        return key, False, False
+    if 'image/webp' not in request.accept_mimetypes.values():
+        return key, False, True
+    if key.startswith('renditions/'):
+        return f'{stem}.webp', False, True
+    return key, True, True
+
+def load_media(cache_key: str, key: str, transcode: bool) -> str:
+    """读穿磁盘缓存：未命中时从存储分块下载（或转码）写入缓存，返回缓存文件路径；对象超过缓存上限时返回None"""
+    cache = current_app.extensions['media_cache']
+    path = cache.get_path(cache_key)
+    if path is not None:
+        return path
+    if transcode:
+        size = current_app.config['IMAGE_VARIANT_MAX_SIZE']
+        data = tos_client.render_variant(tos_client.download_file(key), (size, size), 'webp')
+        return cache.put_chunks(cache_key, [data])
+    return cache.put_chunks(cache_key, tos_client.download_chunks(key, current_app.config['UPLOAD_CHUNK_SIZE']))
+
+@bp.route('/media/<path:key>', methods=['GET'])
+def get_media(key):
+    """读穿式媒体代理：对象经本地磁盘缓存返回，支持Range、条件请求和WebP协商"""
+    if not key.startswith(MEDIA_PREFIXES) or '..' in key.split('/'):
+        return jsonify({'error': '文件不存在'}), 404
+    
+    source_key, transcode, negotiated = negotiate_media(key)
+    served = f'{source_key}.webp' if transcode else source_key
+    # key对应的内容不会变化，ETag由实际返回的内容决定，无需读取缓存即可判断304
+    etag = hashlib.sha1(served.encode('utf-8')).hexdigest()
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        try:
+            try:
+                path = media_flight.do(served, lambda: load_media(served, source_key, transcode))
+            except KeyError:
+                if source_key == key:
+                    raise
+                # 旧图片可能没有WebP衍生图，退回请求的原格式
+                served = source_key = key
+                etag = hashlib.sha1(served.encode('utf-8')).hexdigest()
+                path = media_flight.do(served, lambda: load_media(served, key, False))
+        except KeyError:
+            return jsonify({'error': '文件不存在'}), 404
+        except DecodeRejected as e:
+            return busy_response({'error': str(e)})
+        except Exception as e:
+            print(f"读取媒体文件失败: {e}")
+            return jsonify({'error': '读取文件失败'}), 502
+        
+        mimetype = 'image/webp' if transcode else mimetypes.guess_type(served)[0] or 'application/octet-stream'
+        response = None
+        if path is not None:
+            try:
+                # 从缓存文件返回，由send_file处理Range和If-None-Match
+                response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=MEDIA_MAX_AGE)
+            except OSError:
+                pass  # 刚被淘汰
+        if response is None:
+            # 超过缓存上限的对象直接从存储读取
+            data = tos_client.download_file(source_key)
+            if transcode:
+                size = current_app.config['IMAGE_VARIANT_MAX_SIZE']
+                data = tos_client.render_variant(data, (size, size), 'webp')
+            response = send_file(BytesIO(data), mimetype=mimetype, etag=etag, conditional=True, max_age=MEDIA_MAX_AGE)
+    
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+@bp.route('/api/metrics/decode', methods=['GET'])
+def get_decode_metrics():
+    """图片解码调度器的内存占用、排队和等待时间统计"""
+    return jsonify(decode_scheduler.metrics())
+
+@bp.route('/api/metrics/storage', methods=['GET'])
+def get_storage_metrics():
+    """存储后端使用情况（TOS为连接池统计）"""
+    return jsonify(tos_client.storage_stats())
+
+@bp.route('/storage/<path:key>', methods=['GET'])
+def get_stored_object(key):
+    """本地文件系统或内存存储的对象访问入口（支持Range请求）"""
+    return tos_client.storage.serve(key)
+
+def put_stored_object(key):
+    """浏览器直传到本地或内存存储：校验签名、大小和MD5后写入（只接受预签名生成的内容寻址原图key，且不覆盖已有对象）"""
+    try:
+        expires_at = int(request.args['expires'])
+        size = int(request.args['size'])
+    except (KeyError, ValueError):
+        return jsonify({'error': '上传地址无效'}), 403
+    content_md5 = request.headers.get('Content-MD5', '')
+    if not verify_upload_signature(upload_signing_key(current_app.config), key, expires_at, content_md5,
+                                   size, request.args.get('signature', '')):
+        return jsonify({'error': '上传地址无效或已过期'}), 403
+    # key必须是由签名中的内容MD5生成的原图文件名，即 photos/ab/cd/<MD5>.<扩展名>
+    try:
+        file_hash = base64.b64decode(content_md5, validate=True).hex()
+    except ValueError:
+        return jsonify({'error': '上传地址无效'}), 403
+    extension = key.rsplit('.', 1)[-1]
+    if (extension not in current_app.config['ALLOWED_EXTENSIONS'] or
+            key != 'photos/' + tos_client.generate_filename(key, file_hash, content_addressed=True)):
+        return jsonify({'error': '上传地址无效'}), 403
+    if Photo.query.filter_by(hash_value=file_hash).first() or tos_client.storage.exists(key):
+        return jsonify({'error': '文件已存在'}), 409
+    if request.content_length != size:
+        return jsonify({'error': '文件大小与签名不一致'}), 400
+    
+    request.max_content_length = size
+    chunk_size = current_app.config['UPLOAD_CHUNK_SIZE']
+    with HashingSpooledFile(current_app.config['UPLOAD_SPOOL_MAX_MEMORY']) as spool:
+        for chunk in iter(lambda: request.stream.read(chunk_size), b''):
+            spool.write(chunk)
+        digest = base64.b64encode(bytes.fromhex(spool.hexdigest())).decode('ascii')
+        if spool.size != size or digest != content_md5:
+            return jsonify({'error': '文件内容校验失败'}), 400
+        spool.seek(0)
+        tos_client.storage.put(key, spool, size, request.content_type or 'application/octet-stream')
+    return '', 200
+
+@bp.record_once
+def register_direct_upload(state):
+    """浏览器直传的写入入口只在本地和内存存储时注册（TOS存储由浏览器直接上传到TOS）"""
+    if state.app.config['STORAGE_BACKEND'] in ('local', 'memory'):
+        state.add_url_rule('/storage/<path:key>', 'put_stored_object', put_stored_object, methods=['PUT'])
+
 @bp.route('/api/upload', methods=['POST'])
 def upload_photos():
     """上传图片"""
@@ -124,68 +587,203 @@ def upload_photos():
     if not files or all(f.filename == '' for f in files):
         return jsonify({'error': '没有选择文件'}), 400
     
-    uploaded_photos = []
+    app = current_app._get_current_object()
+    
+    # 异步模式：暂存文件后立即返回202，由后台工作池完成处理
+    if request.args.get('async', '').lower() in ('1', 'true'):
+        try:
+            job, errors = create_ingest_job(app, files, 100 * 1024 * 1024)  # 100MB
+        except Exception as e:
+            return jsonify({'error': f'创建入库任务失败: {str(e)}', 'success': False}), 500
+        if job is None:
+            return jsonify({'success': False, 'count': 0, 'errors': errors})
+        
+        ingest_worker.submit_job(job)
+        return jsonify({
+            'success': True,
+            'job_id': job.job_id,
+            'count': job.total,
+            'status_url': url_for('api.get_ingest_job', job_id=job.job_id),
+            'errors': errors
+        }), 202
+    
+    # 并发处理文件，所有记录在一个事务中写入
+    photos, errors = ingest_files(app, files, 100 * 1024 * 1024)  # 100MB
+    
+    body = {
+        'success': len(photos) > 0,
+        'count': len(photos),
+        'errors': errors
+    }
+    if all_busy(photos, errors):
+        return busy_response(body)
+    return jsonify(body)
+
+def busy_response(body: dict):
+    """服务器繁忙时返回503，并通过Retry-After告知客户端重试间隔"""
+    body.setdefault('error', BUSY_ERROR)
+    return jsonify(body), 503, {'Retry-After': str(BUSY_RETRY_SECONDS)}
+
+def parse_direct_upload(item, errors: list):
+    """校验直传文件的描述 {name, type, hash, size}，返回 (文件名, 类型, 小写哈希, 大小)，无效时记录错误并返回None"""
+    if not isinstance(item, dict) or not isinstance(item.get('name'), str) or not item['name']:
+        errors.append('文件信息无效')
+        return None
+    name = item['name']
+    file_hash = str(item.get('hash', '')).strip().lower()
+    extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    if extension not in current_app.config['ALLOWED_EXTENSIONS']:
+        errors.append(f'{name}: 不支持的文件类型')
+        return None
+    if not MD5_HEX_RE.match(file_hash):
+        errors.append(f'{name}: 文件哈希无效')
+        return None
+    content_type = item.get('type') or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    try:
+        size = int(item.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    return name, content_type, file_hash, size
+
+@bp.route('/api/upload/presign', methods=['POST'])
+def presign_uploads():
+    """浏览器直传第一步：为每个文件生成内容寻址key的预签名PUT地址，已存在的文件直接跳过"""
+    data = request.get_json(silent=True) or {}
+    files = data.get('files') if isinstance(data, dict) else None
+    if not isinstance(files, list) or not files:
+        return jsonify({'error': '没有选择文件'}), 400
+    if len(files) > MAX_DIRECT_UPLOADS:
+        return jsonify({'error': f'单次最多上传{MAX_DIRECT_UPLOADS}个文件'}), 400
+    
     errors = []
+    items = []
+    for item in files:
+        parsed = parse_direct_upload(item, errors)
+        if parsed is None:
+            continue
+        name, _, _, size = parsed
+        if size <= 0:
+            errors.append(f'{name}: 文件大小无效')
+        elif size > current_app.config['MAX_CONTENT_LENGTH']:
+            errors.append(f'{name}: 文件大小超过限制')
+        else:
+            items.append(parsed)
     
-    for file in files:
-        if file and file.filename:
-            try:
-                # 读取文件内容
-                file_content = file.read()
-                file_size = len(file_content)
-                
-                # 检查文件大小
-                if file_size > 100 * 1024 * 1024:  # 100MB
-                    errors.append(f'{file.filename}: 文件大小超过限制')
-                    continue
-                
-                # 计算文件哈希值，检查重复
-                file_hash = tos_client.calculate_file_hash(file_content)
-                existing_photo = Photo.query.filter_by(hash_value=file_hash).first()
-                if existing_photo:
-                    errors.append(f'{file.filename}: 文件已存在')
-                    continue
-                
-                # 生成文件名并上传到TOS
-                filename = tos_client.generate_filename(file.filename)
-                tos_url = tos_client.upload_file(file_content, filename, file.content_type)
-                
-                # 创建并上传缩略图
-                thumbnail_content = tos_client.create_thumbnail(file_content)
-                thumbnail_url = None
-                if thumbnail_content:
-                    thumbnail_url = tos_client.upload_thumbnail(thumbnail_content, filename)
-                
-                # 获取图片信息
-                img_info = tos_client.get_image_info(file_content)
-                
-                # 保存到数据库
-                photo = Photo(
-                    title=secure_filename(file.filename).rsplit('.', 1)[0],
-                    filename=filename,
-                    original_filename=file.filename,
-                    tos_url=tos_url,
-                    thumbnail_url=thumbnail_url,
-                    file_size=file_size,
-                    width=img_info.get('width', 0),
-                    height=img_info.get('height', 0),
-                    mime_type=file.content_type,
-                    hash_value=file_hash
-                )
-                
-                db.session.add(photo)
-                db.session.commit()
-                
-                uploaded_photos.append(photo.to_dict())
-                
-            except Exception as e:
-                db.session.rollback()
-                errors.append(f'{file.filename}: 上传失败 - {str(e)}')
+    # 一次查询跳过已存在的文件
+    hashes = list({item[2] for item in items})
+    existing = set()
+    if hashes:
+        existing = {
+            row.hash_value for row in
+            db.session.query(Photo.hash_value).filter(Photo.hash_value.in_(hashes))
+        }
+    
+    expires = current_app.config['DIRECT_UPLOAD_EXPIRES']
+    uploads = []
+    skipped = []
+    for name, content_type, file_hash, size in items:
+        if file_hash in existing:
+            skipped.append(name)
+            continue
+        filename = tos_client.generate_filename(name, file_hash, content_addressed=True)
+        try:
+            signed = tos_client.presign_upload(filename, content_type, file_hash, size, expires)
+        except Exception as e:
+            errors.append(f'{name}: 生成上传地址失败 - {str(e)}')
+            continue
+        uploads.append({'name': name, 'hash': file_hash, 'method': 'PUT', **signed})
     
     return jsonify({
-        'success': len(uploaded_photos) > 0,
-        'count': len(uploaded_photos),
+        'uploads': uploads,
+        'existing': skipped,
+        'errors': errors,
+        'expires_in': expires
+    })
+
+@bp.route('/api/upload/finalize', methods=['POST'])
+def finalize_direct_uploads():
+    """浏览器直传第二步：服务端读取已上传的原图，校验后生成缩略图并写入图片记录"""
+    data = request.get_json(silent=True) or {}
+    files = data.get('files') if isinstance(data, dict) else None
+    if not isinstance(files, list) or not files:
+        return jsonify({'error': '没有选择文件'}), 400
+    if len(files) > MAX_DIRECT_UPLOADS:
+        return jsonify({'error': f'单次最多上传{MAX_DIRECT_UPLOADS}个文件'}), 400
+    
+    errors = []
+    items = []
+    for item in files:
+        parsed = parse_direct_upload(item, errors)
+        if parsed is not None:
+            items.append(parsed[:3])
+    
+    app = current_app._get_current_object()
+    photos, finalize_errors = finalize_uploads(app, items, app.config['MAX_CONTENT_LENGTH'])
+    errors.extend(finalize_errors)
+    
+    body = {
+        'success': len(photos) > 0,
+        'count': len(photos),
+        'errors': errors
+    }
+    if all_busy(photos, errors):
+        return busy_response(body)
+    return jsonify(body)
+
+@bp.route('/api/upload/zip', methods=['POST'])
+def upload_zip():
+    """上传ZIP压缩包，逐个解压其中的图片并入库"""
+    # 压缩包单独放宽请求体大小限制；请求体边接收边写入临时文件，不会整体读入内存
+    request.max_content_length = current_app.config['ZIP_MAX_CONTENT_LENGTH']
+    archive = request.files.get('archive')
+    if not archive or archive.filename == '':
+        return jsonify({'error': '没有选择压缩包'}), 400
+    
+    try:
+        photos, errors, members = ingest_zip(current_app._get_current_object(), archive.stream, 100 * 1024 * 1024)  # 100MB
+    except zipfile.BadZipFile:
+        return jsonify({'error': '不是有效的ZIP文件'}), 400
+    
+    body = {
+        'success': len(photos) > 0,
+        'count': len(photos),
+        'members': members,
         'errors': errors
+    }
+    if all_busy(photos, errors):
+        return busy_response(body)
+    return jsonify(body)
+
+@bp.route('/api/upload/jobs/<job_id>', methods=['GET'])
+@query_budget(2)
+def get_ingest_job(job_id):
+    """查询异步入库任务进度"""
+    job = IngestJob.query.filter_by(job_id=job_id).first_or_404()
+    return jsonify(job.to_dict())
+
+@bp.route('/api/photos/check-hashes', methods=['POST'])
+def check_photo_hashes():
+    """批量检查文件哈希是否已存在，客户端据此跳过重复文件的上传"""
+    data = request.get_json(silent=True) or {}
+    hashes = data.get('hashes') if isinstance(data, dict) else data
+    
+    if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):
+        return jsonify({'error': 'hashes必须是字符串数组'}), 400
+    if len(hashes) > MAX_HASH_CHECK:
+        return jsonify({'error': f'单次最多检查{MAX_HASH_CHECK}个哈希值'}), 400
+    
+    # 统一为小写并去重，借助hash_value索引一次IN查询
+    hashes = list(dict.fromkeys(h.strip().lower() for h in hashes if h.strip()))
+    existing = set()
+    if hashes:
+        existing = {
+            row.hash_value for row in
+            db.session.query(Photo.hash_value).filter(Photo.hash_value.in_(hashes))
+        }
+    
+    return jsonify({
+        'existing': [h for h in hashes if h in existing],
+        'missing': [h for h in hashes if h not in existing]
     })
 
 @bp.route('/api/photos/<int:photo_id>/tags', methods=['POST'])
@@ -201,6 +799,7 @@ def add_photo_tags(photo_id):
         return jsonify({'error': '标签必须是数组格式'}), 400
     
     added_tags = []
+    linked_tags = []
     for tag_name in tag_names:
         tag_name = tag_name.strip()
         if not tag_name:
@@ -209,7 +808,7 @@ def add_photo_tags(photo_id):
         # 查找或创建标签
         tag = Tag.query.filter_by(name=tag_name).first()
         if not tag:
-            tag = Tag(name=tag_name, color=generate_random_color())
+            tag = Tag(name=tag_name, color=generate_random_color(), usage_count=0)
             db.session.add(tag)
         
         # 添加标签到图片
@@ -217,11 +816,16 @@ def add_photo_tags(photo_id):
             photo.tags.append(tag)
             tag.usage_count += 1
             added_tags.append(tag.to_dict())
+            linked_tags.append(tag)
     
     db.session.commit()
+    visible = photo.is_public and photo.status == 'ready'
+    for tag in linked_tags:
+        tag_index.add(photo.id, tag.id, tag.name, visible)
     return jsonify({'added_tags': added_tags, 'photo': photo.to_dict()})
 
 @bp.route('/api/tags', methods=['GET'])
+@query_budget(1)
 def get_tags():
     """获取标签列表"""
     tags = Tag.query.order_by(Tag.usage_count.desc()).limit(50).all()
@@ -240,6 +844,7 @@ def remove_photo_tag(photo_id, tag_id):
         if tag.usage_count > 0:
             tag.usage_count -= 1
         db.session.commit()
+        tag_index.remove(photo_id, tag_id)
         return jsonify({'message': '标签移除成功'})
     else:
         return jsonify({'error': '标签不存在于该图片上'}), 404
@@ -251,17 +856,72 @@ def delete_photo(photo_id):
     
     try:
         # 删除TOS文件
-        tos_client.delete_file(photo.filename)
+        tos_client.delete_file(photo.filename, photo.rendition_keys())
         
         # 删除数据库记录
         db.session.delete(photo)
         db.session.commit()
+        phash_index.remove(photo_id)
+        color_index.remove(photo_id)
+        tag_index.remove_photos([photo_id])
         
         return jsonify({'message': '图片删除成功'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'删除失败: {str(e)}'}), 500
 
+@bp.route('/api/photos/bulk-delete', methods=['POST'])
+def bulk_delete_photos():
+    """批量删除图片：按ID列表或筛选条件（tag_id、search）删除，每次最多MAX_BULK_DELETE张"""
+    data = request.get_json() or {}
+    ids = data.get('ids')
+    filters = data.get('filter')
+    
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            return jsonify({'error': 'ids必须是整数数组'}), 400
+        if len(ids) > MAX_BULK_DELETE:
+            return jsonify({'error': f'一次最多删除{MAX_BULK_DELETE}张图片'}), 400
+        query = Photo.query.filter(Photo.id.in_(ids))
+    elif isinstance(filters, dict) and (filters.get('tag_id') or filters.get('search')):
+        query = Photo.query
+        if filters.get('tag_id'):
+            query = query.join(Photo.tags).filter(Tag.id == filters['tag_id'])
+        if filters.get('search'):
+            query = search_index.filter(query, filters['search'])
+    else:
+        return jsonify({'error': '请提供ids或筛选条件'}), 400
+    
+    rows = query.with_entities(Photo.id, Photo.filename, Photo.renditions).order_by(Photo.id).limit(MAX_BULK_DELETE + 1).all()
+    has_more = len(rows) > MAX_BULK_DELETE
+    rows = rows[:MAX_BULK_DELETE]
+    if not rows:
+        return jsonify({'success': True, 'deleted': 0, 'has_more': False, 'storage_errors': []})
+    photo_ids = [row.id for row in rows]
+    
+    try:
+        delete_photo_rows(photo_ids)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'删除失败: {str(e)}'}), 500
+    
+    for photo_id in photo_ids:
+        phash_index.remove(photo_id)
+        color_index.remove(photo_id)
+    tag_index.remove_photos(photo_ids)
+    
+    # 数据库提交后再批量删除TOS文件，失败的key留给存储对账脚本清理
+    keys = [key for row in rows for key in storage_keys(row.filename, row.renditions)]
+    storage_errors = tos_client.delete_objects(keys)
+    
+    return jsonify({
+        'success': True,
+        'deleted': len(photo_ids),
+        'has_more': has_more,
+        'storage_errors': storage_errors
+    })
+
 @bp.route('/api/photos/<int:photo_id>', methods=['PUT'])
 def update_photo(photo_id):
     """更新图片信息"""
@@ -276,6 +936,7 @@ def update_photo(photo_id):
         photo.is_public = data['is_public']
     
     db.session.commit()
+    tag_index.set_visible(photo.id, bool(photo.is_public) and photo.status == 'ready')
     return jsonify(photo.to_dict())
 
 @bp.route('/api/generated-images/<int:result_id>', methods=['DELETE'])
@@ -315,7 +976,7 @@ def delete_generated_image(result_id):
                 if hasattr(tos_client, 'delete_file') and photo_to_delete.filename:
                     print(f"步骤5.1: 准备删除TOS文件: {photo_to_delete.filename}")
                     try:
-                        tos_client.delete_file(photo_to_delete.filename)
+                        tos_client.delete_file(photo_to_delete.filename, photo_to_delete.rendition_keys())
                         print(f"步骤5.2: TOS文件删除成功: {photo_to_delete.filename}")
                     except Exception as e:
                         # 记录错误但不中断流程
@@ -338,6 +999,10 @@ def delete_generated_image(result_id):
             print("步骤7: 提交数据库事务")
             db.session.commit()
             print("步骤7.1: 数据库事务提交成功")
+            if photo_id:
+                phash_index.remove(photo_id)
+                color_index.remove(photo_id)
+                tag_index.remove_photos([photo_id])
             
             # 验证删除是否成功
             print("步骤8: 验证删除结果")
@@ -564,40 +1229,34 @@ def generate_image():
         image_content = response.content
         file_size = len(image_content)
         
-        # 生成文件名并上传到TOS
-        filename = tos_client.generate_filename(f"generated_{int(time.time())}.jpg")
-        tos_url = tos_client.upload_file(image_content, filename, 'image/jpeg')
-        
-        # 创建并上传缩略图
-        thumbnail_content = tos_client.create_thumbnail(image_content)
-        thumbnail_url = None
-        if thumbnail_content:
-            thumbnail_url = tos_client.upload_thumbnail(thumbnail_content, filename)
-        
-        # 获取图片信息
-        img_info = tos_client.get_image_info(image_content)
-        
         # 计算文件哈希值
         file_hash = tos_client.calculate_file_hash(image_content)
         
+        # 生成文件名，与上传的图片一样生成并上传原图、缩略图和衍生图（内容寻址模式下相同图片不会重复上传）
+        filename = tos_client.generate_filename(f"generated_{int(time.time())}.jpg", file_hash)
+        try:
+            fields = upload_and_analyze(BytesIO(image_content), file_size, filename, 'image/jpeg')
+        except SimilarPhotoExists as e:
+            return jsonify({'error': str(e), 'photo_id': e.photo_id}), 409
+        except DecodeRejected:
+            return busy_response({})
+        
         # 保存到数据库
         photo = Photo(
             title=title,
             description=description,
             filename=filename,
             original_filename=f"generated_{int(time.time())}.jpg",
-            tos_url=tos_url,
-            thumbnail_url=thumbnail_url,
             file_size=file_size,
-            width=img_info.get('width', 0),
-            height=img_info.get('height', 0),
             mime_type='image/jpeg',
             hash_value=file_hash,
-            is_ai_generated=True
+            **fields
         )
         
         db.session.add(photo)
         db.session.commit()
+        phash_index.add(photo.id, photo.phash)
+        color_index.add(photo.id, photo.color_histogram)
         
         return jsonify({
             'success': True,
@@ -713,6 +1372,7 @@ def remove_favorite(image_id):
 
 
 @bp.route('/api/favorites', methods=['GET'])
+@query_budget(1)
 def get_favorites():
     """获取用户喜欢的图片ID列表"""
     try:
@@ -727,8 +1387,10 @@ def get_favorites():
             })
         
         # 查询喜欢的图片ID
-        favorites = Favorite.query.filter_by(session_id=session_id).all()
-        favorited_image_ids = [fav.generation_result_id for fav in favorites]
+        favorited_image_ids = [
+            row.generation_result_id for row in
+            db.session.query(Favorite.generation_result_id).filter_by(session_id=session_id)
+        ]
         
         return jsonify({
             'success': True,
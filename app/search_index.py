@@ -0,0 +1,260 @@
+import re
+from sqlalchemy import column, event, func, inspect, literal_column, or_, select, table, text
+from sqlalchemy.orm import Session
+from . import db
+
+# 全文索引表：SQLite为FTS5虚拟表（rowid即图片ID），MySQL为带ngram全文索引的普通表
+SEARCH_TABLE = 'photo_search'
+# SQLite相关度（bm25）中标题、描述、标签名的权重
+FIELD_WEIGHTS = (10.0, 1.0, 5.0)
+# FTS5前缀索引的最大长度（与建表语句的prefix选项一致）：不超过该长度的前缀查询与普通词一样快
+PREFIX_INDEX_MAX = 3
+# 游标分页时命中数不少于该值则沿排序索引逐行校验，否则先取出全部命中的ID
+SCAN_MIN_HITS = 20000
+# 一次查询最多使用的词数，避免超长输入生成过大的匹配表达式
+MAX_QUERY_TERMS = 16
+# 重建索引时每批读取的图片数量
+REBUILD_BATCH = 5000
+
+# 中日韩文字没有空格分词，连续的一段按相邻两字切分；其他文字按单词切分
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_RE = re.compile(f'(?P<cjk>[{CJK_CHARS}]+)|(?P<word>[^\\W_{CJK_CHARS}]+)')
+
+SQLITE_DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+    "USING fts5(title, description, tags, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')"
+)
+MYSQL_DDL = (
+    f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+    "photo_id INT PRIMARY KEY, title VARCHAR(200), description TEXT, tags TEXT, "
+    "FULLTEXT KEY ft_photo_search (title, description, tags) WITH PARSER ngram"
+    ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+)
+
+
+def tokenize(value: str) -> list:
+    """切分文本，返回 (是否中日韩文字, 片段) 列表，英文等单词转为小写"""
+    return [
+        (True, match.group()) if match.group('cjk') else (False, match.group().lower())
+        for match in TOKEN_RE.finditer(value or '')
+    ]
+
+
+def index_terms(value: str) -> str:
+    """生成写入FTS5的词：中日韩文字为相邻两字及末尾单字，如“春天花”为“春天 天花 花”"""
+    terms = []
+    for cjk, token in tokenize(value):
+        if cjk:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+            terms.append(token[-1])
+        else:
+            terms.append(token)
+    return ' '.join(terms)
+
+
+def fts5_query(value: str):
+    """生成FTS5的MATCH表达式，各词之间为AND；没有可检索的词时返回None"""
+    parts = []
+    for cjk, token in tokenize(value)[:MAX_QUERY_TERMS]:
+        if cjk and len(token) > 1:
+            # 多个汉字：相邻两字组成的短语，要求按顺序连续出现
+            parts.append('"' + ' '.join(token[i:i + 2] for i in range(len(token) - 1)) + '"')
+        else:
+            # 单个汉字或单词：前缀匹配，输入过程中即可检索
+            parts.append(f'"{token}"*')
+    return ' '.join(parts) or None
+
+
+def mysql_query(value: str):
+    """生成MySQL布尔模式的全文检索表达式，由ngram分词器切分中文"""
+    parts = []
+    for cjk, token in tokenize(value)[:MAX_QUERY_TERMS]:
+        parts.append(f'+"{token}"' if cjk else f'+{token}*')
+    return ' '.join(parts) or None
+
+
+class SearchIndex:
+    """图片标题、描述和标签名的全文索引，随ORM写入同步更新，数据库不支持时退化为LIKE查询"""
+
+    def __init__(self):
+        self.app = None
+        self.dialect = None  # sqlite、mysql；None表示不可用，使用LIKE查询
+        self.table = None
+
+    def init_app(self, app):
+        """创建索引表；首次创建且已有图片时立即建立索引"""
+        self.app = app
+        self.dialect = None
+        app.extensions['search_index'] = self
+        with app.app_context():
+            try:
+                dialect = db.engine.dialect.name
+                if dialect not in ('sqlite', 'mysql'):
+                    return
+                created = not inspect(db.engine).has_table(SEARCH_TABLE)
+                db.session.execute(text(SQLITE_DDL if dialect == 'sqlite' else MYSQL_DDL))
+                db.session.commit()
+                key = 'rowid' if dialect == 'sqlite' else 'photo_id'
+                self.table = table(SEARCH_TABLE, column(key), column('title'), column('description'), column('tags'))
+                self.dialect = dialect
+                if created:
+                    self.rebuild()
+            except Exception as e:
+                db.session.rollback()
+                self.dialect = None
+                print(f"全文索引不可用，搜索将使用LIKE查询: {e}")
+
+    @property
+    def key(self):
+        return self.table.c.rowid if self.dialect == 'sqlite' else self.table.c.photo_id
+
+    def _match(self, value: str):
+        """返回索引表上的匹配条件和相关度表达式（越大越相关），没有可检索的词时返回None"""
+        if self.dialect == 'sqlite':
+            expression = fts5_query(value)
+            if expression is None:
+                return None
+            name = literal_column(SEARCH_TABLE)
+            # bm25越小越相关，取负数
+            return name.op('MATCH')(expression), -func.bm25(name, *FIELD_WEIGHTS)
+        expression = mysql_query(value)
+        if expression is None:
+            return None
+        from sqlalchemy.dialects.mysql import match
+        condition = match(self.table.c.title, self.table.c.description, self.table.c.tags,
+                          against=expression).in_boolean_mode()
+        return condition, condition
+
+    def filter(self, query, value: str, ordered_scan: bool = False):
+        """按关键词筛选图片查询；ordered_scan表示调用方沿排序索引只取前几条（游标分页）"""
+        from .models import Photo, Tag
+        match = self._match(value) if self.dialect else None
+        if match is None:
+            return query.filter(or_(
+                Photo.title.contains(value),
+                Photo.description.contains(value),
+                Photo.tags.any(Tag.name.contains(value))
+            ))
+        condition = match[0]
+        # 命中很多时沿排序索引逐行到全文索引中校验，几十行内即可凑满一页；
+        # 命中较少时先取出全部命中的ID再回表，避免扫描整张图片表。
+        # 超过前缀索引长度的前缀词每次校验都要合并所有匹配词的列表，不适合逐行校验
+        long_prefix = any(not cjk and len(token) > PREFIX_INDEX_MAX for cjk, token in tokenize(value)[:MAX_QUERY_TERMS])
+        if ordered_scan and self.dialect == 'sqlite' and not long_prefix:
+            hits = db.session.execute(select(func.count()).select_from(self.table).where(condition)).scalar()
+            if hits >= SCAN_MIN_HITS:
+                return query.filter(select(self.key).where(condition, self.key == Photo.id).exists())
+        return query.filter(Photo.id.in_(select(self.key).where(condition)))
+
+    def scores(self, value: str):
+        """所有命中图片的相关度子查询（photo_id、score，越大越相关），由调用方连接后排序分页；索引不可用或没有可检索的词时返回None"""
+        match = self._match(value) if self.dialect else None
+        if match is None:
+            return None
+        condition, score = match
+        return select(self.key.label('photo_id'), score.label('score')).where(condition).subquery()
+
+    def _rows(self, connection, photo_ids: list) -> list:
+        """从数据库读取图片的标题、描述和标签名，生成索引行"""
+        from .models import Photo, Tag, photo_tag
+        photos = connection.execute(
+            select(Photo.id, Photo.title, Photo.description).where(Photo.id.in_(photo_ids))
+        ).all()
+        tags = {}
+        for photo_id, name in connection.execute(
+            select(photo_tag.c.photo_id, Tag.name).join(Tag, Tag.id == photo_tag.c.tag_id)
+            .where(photo_tag.c.photo_id.in_(photo_ids))
+        ):
+            tags.setdefault(photo_id, []).append(name)
+
+        prepare = index_terms if self.dialect == 'sqlite' else (lambda value: value or '')
+        return [
+            {self.key.name: photo_id, 'title': prepare(title), 'description': prepare(description),
+             'tags': prepare(' '.join(tags.get(photo_id, [])))}
+            for photo_id, title, description in photos
+        ]
+
+    def reindex(self, connection, photo_ids: list):
+        """重新写入指定图片的索引（图片已不存在时只删除）"""
+        if not self.dialect or not photo_ids:
+            return
+        photo_ids = list(photo_ids)
+        rows = self._rows(connection, photo_ids)
+        connection.execute(self.table.delete().where(self.key.in_(photo_ids)))
+        if rows:
+            connection.execute(self.table.insert(), rows)
+
+    def remove(self, photo_ids: list):
+        """删除指定图片的索引（用于绕过ORM的批量删除，随当前事务提交）"""
+        if self.dialect and photo_ids:
+            db.session.execute(self.table.delete().where(self.key.in_(photo_ids)))
+
+    def rebuild(self, batch_size: int = REBUILD_BATCH):
+        """清空并按ID顺序分批重建全部索引"""
+        from .models import Photo
+        if not self.dialect:
+            return 0
+        db.session.execute(self.table.delete())
+        last_id = 0
+        count = 0
+        while True:
+            photo_ids = db.session.scalars(
+                select(Photo.id).where(Photo.id > last_id).order_by(Photo.id).limit(batch_size)
+            ).all()
+            if not photo_ids:
+                break
+            self.reindex(db.session.connection(), photo_ids)
+            db.session.commit()
+            last_id = photo_ids[-1]
+            count += len(photo_ids)
+            if count % (batch_size * 20) == 0:
+                print(f'全文索引已重建 {count} 张图片')
+        if self.dialect == 'sqlite':
+            # 合并FTS5的索引段，减少查询时需要读取的b树数量
+            db.session.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES('optimize')"))
+            # 更新统计信息：没有统计时查询规划器会选用区分度很低的is_public/status索引，无法按排序索引提前结束
+            db.session.execute(text('ANALYZE photo'))
+        db.session.commit()
+        return count
+
+    def after_flush(self, session, flush_context):
+        """ORM写入后同步索引：新增或修改了标题、描述、标签的图片，以及改名标签下的图片"""
+        from .models import Photo, Tag, photo_tag
+        if not self.dialect or session.get_bind().dialect.name != self.dialect:
+            return
+        changed = set()
+        removed = set()
+        renamed_tags = []
+        for obj in session.new:
+            if isinstance(obj, Photo):
+                changed.add(obj.id)
+        for obj in session.dirty:
+            if isinstance(obj, Photo):
+                state = inspect(obj)
+                if any(state.attrs[name].history.has_changes() for name in ('title', 'description', 'tags')):
+                    changed.add(obj.id)
+            elif isinstance(obj, Tag) and inspect(obj).attrs.name.history.has_changes():
+                renamed_tags.append(obj.id)
+        for obj in session.deleted:
+            if isinstance(obj, Photo):
+                removed.add(obj.id)
+        if not (changed or removed or renamed_tags):
+            return
+
+        connection = session.connection()
+        if renamed_tags:
+            changed.update(connection.execute(
+                select(photo_tag.c.photo_id).where(photo_tag.c.tag_id.in_(renamed_tags))
+            ).scalars())
+        if removed:
+            connection.execute(self.table.delete().where(self.key.in_(list(removed))))
+        self.reindex(connection, changed - removed)
+
+
+# 全局全文索引
+search_index = SearchIndex()
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_search_index(session, flush_context):
+    search_index.after_flush(session, flush_context)
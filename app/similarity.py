@@ -0,0 +1,156 @@
+import threading
+from PIL import Image
+from . import db
+
+# dHash的采样尺寸：9x8灰度图，比较相邻像素得到64位
+DHASH_SIZE = (9, 8)
+# 置位数少于该值（或多于64减该值）的哈希信息量太少：纯色、平滑渐变等图片都会得到近似全0或全1的哈希
+MIN_HASH_BITS = 8
+
+
+def dhash_image(img: Image.Image) -> Image.Image:
+    """将图片缩放为计算dHash用的9x8灰度图"""
+    return img.convert('L').resize(DHASH_SIZE, Image.Resampling.BILINEAR)
+
+
+def dhash(img: Image.Image) -> str:
+    """计算64位差值哈希（按行比较右侧像素是否比左侧亮），返回16位十六进制字符串"""
+    small = dhash_image(img)
+    width, height = DHASH_SIZE
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(height):
+        for col in range(width - 1):
+            left = pixels[row * width + col]
+            right = pixels[row * width + col + 1]
+            value = (value << 1) | (1 if right > left else 0)
+    return f'{value:016x}'
+
+
+def informative_hash(phash: str) -> bool:
+    """哈希是否有足够的细节参与相似检测（低细节图片之间的哈希都很接近，不能据此判断相似）"""
+    if not phash:
+        return False
+    bits = int(phash, 16).bit_count()
+    return MIN_HASH_BITS <= bits <= 64 - MIN_HASH_BITS
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """计算两个哈希值的汉明距离"""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """按汉明距离组织的BK树，查询时利用三角不等式剪枝，只访问距离范围内的子树"""
+
+    def __init__(self):
+        self.root = None  # 节点结构: [哈希值, [图片ID...], {距离: 子节点}]
+        self.size = 0
+
+    def add(self, value: int, photo_id: int):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [photo_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(photo_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [photo_id], {}]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list:
+        """返回距离不超过max_distance的 (距离, 图片ID) 列表"""
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, photo_id) for photo_id in node[1])
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in node[2].items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+        return results
+
+
+class PhashIndex:
+    """进程内的感知哈希索引，启动时从数据库加载，上传和删除时增量更新"""
+
+    def __init__(self):
+        self.app = None
+        self.tree = BKTree()
+        self.removed = set()  # BK树不支持删除节点，已删除的图片ID在查询时过滤
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def init_app(self, app):
+        """启动时加载索引，数据库尚未升级（缺少phash列）时推迟到首次查询"""
+        self.app = app
+        app.extensions['phash_index'] = self
+        with app.app_context():
+            try:
+                self.load()
+            except Exception as e:
+                db.session.rollback()
+                print(f"相似图片索引加载失败，将在首次查询时重试: {e}")
+
+    def load(self):
+        """从数据库加载所有已入库图片的感知哈希"""
+        from .models import Photo
+        tree = BKTree()
+        rows = db.session.query(Photo.id, Photo.phash).filter(
+            Photo.phash.isnot(None), Photo.status == 'ready'
+        ).yield_per(10000)
+        for photo_id, phash in rows:
+            if informative_hash(phash):
+                tree.add(int(phash, 16), photo_id)
+        with self.lock:
+            self.tree = tree
+            self.removed = set()
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+
+    def add(self, photo_id: int, phash: str):
+        """添加一张图片（低细节的哈希不加入索引）"""
+        if not informative_hash(phash):
+            return
+        self._ensure_loaded()
+        with self.lock:
+            self.removed.discard(photo_id)
+            self.tree.add(int(phash, 16), photo_id)
+
+    def remove(self, photo_id: int):
+        """标记图片已删除"""
+        with self.lock:
+            self.removed.add(photo_id)
+
+    def find(self, phash: str, max_distance: int, exclude_id: int = None) -> list:
+        """查找相似图片，返回按距离排序的 (距离, 图片ID) 列表；低细节的哈希不做匹配"""
+        if not informative_hash(phash):
+            return []
+        self._ensure_loaded()
+        with self.lock:
+            matches = self.tree.search(int(phash, 16), max_distance)
+            removed = set(self.removed)
+        return sorted(
+            (distance, photo_id) for distance, photo_id in matches
+            if photo_id not in removed and photo_id != exclude_id
+        )
+
+
+# 全局感知哈希索引
+phash_index = PhashIndex()
@@ -0,0 +1,561 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from urllib.parse import urlencode
+import tos
+from flask import current_app, send_file, send_from_directory, abort, url_for
+
+# TOS分片上传的最小分片大小（最后一个分片除外）
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# TOS批量删除每次请求最多包含的key数量
+MAX_DELETE_BATCH = 1000
+
+
+def stream_length(content) -> int:
+    """获取bytes或文件对象的长度（文件对象从当前位置算起）"""
+    if isinstance(content, (bytes, bytearray)):
+        return len(content)
+    position = content.tell()
+    content.seek(0, os.SEEK_END)
+    length = content.tell() - position
+    content.seek(position)
+    return length
+
+
+@dataclass
+class StoredObject:
+    """列举得到的对象"""
+    key: str
+    size: int
+    last_modified: float  # Unix时间戳
+
+
+def upload_signature(secret: str, key: str, expires_at: int, content_md5: str, content_length: int) -> str:
+    """浏览器直传到本应用时的URL签名，绑定key、过期时间、内容MD5和大小"""
+    message = f"{key}\n{expires_at}\n{content_md5}\n{content_length}".encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def upload_signing_key(config):
+    """直传签名使用的密钥；未配置SECRET_KEY或仍为默认值时返回None（默认值是公开的，任何人都能伪造签名）"""
+    from . import DEFAULT_SECRET_KEY
+    secret = config.get('SECRET_KEY')
+    return secret if secret and secret != DEFAULT_SECRET_KEY else None
+
+
+def verify_upload_signature(secret: str, key: str, expires_at: int, content_md5: str,
+                            content_length: int, signature: str) -> bool:
+    if not secret or expires_at < time.time():
+        return False
+    expected = upload_signature(secret, key, expires_at, content_md5, content_length)
+    return hmac.compare_digest(expected, signature)
+
+
+class StorageBackend:
+    """对象存储接口：按key读写对象，key形如 photos/<文件名>、thumbnails/<文件名>"""
+
+    name = 'base'
+
+    def put(self, key: str, content, content_length: int, content_type: str):
+        """写入对象，content为bytes或文件对象"""
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        """读取对象内容，不存在时抛出KeyError"""
+        raise NotImplementedError
+
+    def iter_chunks(self, key: str, chunk_size: int):
+        """分块读取对象内容（生成bytes），不存在时抛出KeyError"""
+        data = self.get(key)
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, keys: list) -> list:
+        """批量删除对象，返回删除失败的key列表"""
+        raise NotImplementedError
+
+    def list_objects(self, prefix: str, page_size: int = 1000):
+        """按key字典序逐页列举前缀下的对象（生成StoredObject），内存占用与对象总数无关"""
+        raise NotImplementedError
+
+    def url(self, key: str) -> str:
+        """对象的访问URL"""
+        raise NotImplementedError
+
+    def serve(self, key: str):
+        """由Flask直接返回对象内容（仅本地和内存存储支持）"""
+        abort(404)
+
+    def presign_put(self, key: str, content_type: str, content_md5: str, content_length: int, expires: int) -> dict:
+        """生成浏览器直传用的PUT地址和必须携带的请求头；默认上传到本应用的 /storage/<key>，由签名校验"""
+        secret = upload_signing_key(current_app.config)
+        if secret is None:
+            raise RuntimeError('未配置SECRET_KEY，不能生成直传地址')
+        expires_at = int(time.time()) + expires
+        signature = upload_signature(secret, key, expires_at, content_md5, content_length)
+        query = urlencode({'expires': expires_at, 'size': content_length, 'signature': signature})
+        return {
+            'url': f"{url_for('api.get_stored_object', key=key)}?{query}",
+            'headers': {'Content-Type': content_type, 'Content-MD5': content_md5}
+        }
+
+    def stats(self) -> dict:
+        return {'backend': self.name}
+
+
+def tos_url_prefix(config) -> str:
+    """根据配置生成对象访问URL的前缀（CDN域名优先），使用正确的TOS域名格式"""
+    if config.get('TOS_CDN_DOMAIN'):
+        return f"https://{config['TOS_CDN_DOMAIN']}"
+
+    # 清理TOS_ENDPOINT，确保不包含https://前缀
+    tos_endpoint = config['TOS_ENDPOINT']
+    if tos_endpoint.startswith('https://'):
+        tos_endpoint = tos_endpoint[8:]
+    elif tos_endpoint.startswith('http://'):
+        tos_endpoint = tos_endpoint[7:]
+
+    return f"https://{config['TOS_BUCKET_NAME']}.{tos_endpoint}"
+
+
+class TOSStorage(StorageBackend):
+    """火山引擎TOS存储：每个进程只创建一个底层连接池，所有线程共享"""
+
+    name = 'tos'
+
+    def __init__(self, config):
+        self.config = config
+        self.bucket_name = config['TOS_BUCKET_NAME']
+        self.url_prefix = tos_url_prefix(config)
+        self.client = None
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+
+    def ensure_client(self):
+        """线程安全地创建底层客户端（只创建一次）"""
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self._init_client()
+
+    def _init_client(self):
+        """初始化TOS客户端（连接池大小、超时和重试次数由配置决定）"""
+        try:
+            self.client = tos.TosClientV2(
+                region=self.config['TOS_REGION'],
+                ak=self.config['TOS_ACCESS_KEY'],
+                sk=self.config['TOS_SECRET_KEY'],
+                endpoint=self.config['TOS_ENDPOINT'],
+                max_connections=self.config['TOS_MAX_CONNECTIONS'],
+                connection_time=self.config['TOS_CONNECT_TIMEOUT'],
+                request_timeout=self.config['TOS_REQUEST_TIMEOUT'],
+                socket_timeout=self.config['TOS_REQUEST_TIMEOUT'],
+                max_retry_count=self.config['TOS_MAX_RETRIES']
+            )
+        except Exception as e:
+            print(f"TOS客户端初始化失败: {e}")
+            raise e
+
+    def _request(self, operation: str, **kwargs):
+        """调用当前存储桶的TOS接口，同时统计正在进行和累计的请求数"""
+        with self.stats_lock:
+            self.in_flight += 1
+            self.requests += 1
+        try:
+            return getattr(self.client, operation)(bucket=self.bucket_name, **kwargs)
+        finally:
+            with self.stats_lock:
+                self.in_flight -= 1
+
+    def put(self, key: str, content, content_length: int, content_type: str):
+        """超过阈值的大文件分片并发上传，其余直接上传"""
+        self.ensure_client()
+        if content_length > self.config['TOS_MULTIPART_THRESHOLD']:
+            self._multipart_upload(key, content, content_length, content_type)
+        else:
+            self._request(
+                'put_object',
+                key=key,
+                content=content,
+                content_length=content_length,
+                content_type=content_type
+            )
+
+    def _multipart_upload(self, key: str, content, content_length: int, content_type: str):
+        """分片并发上传：每个分片独立重试，任一分片最终失败则中止整个上传"""
+        part_size = max(self.config['TOS_MULTIPART_PART_SIZE'], MIN_PART_SIZE)
+        concurrency = self.config['TOS_MULTIPART_CONCURRENCY']
+        retries = self.config['TOS_MULTIPART_RETRIES']
+        part_count = (content_length + part_size - 1) // part_size
+        read_lock = threading.Lock()
+
+        def read_part(part_number):
+            offset = (part_number - 1) * part_size
+            if isinstance(content, (bytes, bytearray)):
+                return content[offset:offset + part_size]
+            # 多个线程共用同一个文件对象，定位和读取需要加锁
+            with read_lock:
+                content.seek(offset)
+                return content.read(part_size)
+
+        def upload_part(part_number):
+            data = read_part(part_number)
+            for attempt in range(retries + 1):
+                try:
+                    return self._request(
+                        'upload_part',
+                        key=key,
+                        upload_id=upload_id,
+                        part_number=part_number,
+                        content=data
+                    )
+                except Exception as e:
+                    if attempt >= retries:
+                        raise
+                    print(f"分片{part_number}上传失败，第{attempt + 1}次重试: {e}")
+                    time.sleep(0.5 * (2 ** attempt))
+
+        upload_id = self._request(
+            'create_multipart_upload',
+            key=key,
+            content_type=content_type
+        ).upload_id
+
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, part_count), thread_name_prefix='tos-part')
+        try:
+            futures = [executor.submit(upload_part, number) for number in range(1, part_count + 1)]
+            parts = [future.result() for future in futures]
+            self._request(
+                'complete_multipart_upload',
+                key=key,
+                upload_id=upload_id,
+                parts=parts
+            )
+        except Exception:
+            # 取消尚未开始的分片并中止上传，释放已上传分片占用的空间
+            executor.shutdown(wait=True, cancel_futures=True)
+            try:
+                self._request('abort_multipart_upload', key=key, upload_id=upload_id)
+            except Exception as e:
+                print(f"中止分片上传失败: {e}")
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+    def get(self, key: str) -> bytes:
+        self.ensure_client()
+        try:
+            return self._request('get_object', key=key).read()
+        except tos.exceptions.TosServerError as e:
+            if e.status_code == 404:
+                raise KeyError(key)
+            raise
+
+    def iter_chunks(self, key: str, chunk_size: int):
+        self.ensure_client()
+        try:
+            output = self._request('get_object', key=key)
+        except tos.exceptions.TosServerError as e:
+            if e.status_code == 404:
+                raise KeyError(key)
+            raise
+        while True:
+            chunk = output.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def presign_put(self, key: str, content_type: str, content_md5: str, content_length: int, expires: int) -> dict:
+        """TOS预签名PUT地址：浏览器直接上传到TOS，TOS按Content-MD5校验上传内容"""
+        self.ensure_client()
+        headers = {'Content-Type': content_type, 'Content-MD5': content_md5}
+        result = self.client.pre_signed_url(
+            tos.HttpMethodType.Http_Method_Put,
+            bucket=self.bucket_name,
+            key=key,
+            expires=expires,
+            header=headers
+        )
+        return {'url': result.signed_url, 'headers': headers}
+
+    def exists(self, key: str) -> bool:
+        """HEAD请求检查对象是否已存在"""
+        self.ensure_client()
+        try:
+            self._request('head_object', key=key)
+            return True
+        except tos.exceptions.TosServerError as e:
+            if e.status_code == 404:
+                return False
+            raise
+
+    def delete(self, keys: list) -> list:
+        """每次请求最多MAX_DELETE_BATCH个key"""
+        self.ensure_client()
+        failed = []
+        for start in range(0, len(keys), MAX_DELETE_BATCH):
+            batch = keys[start:start + MAX_DELETE_BATCH]
+            try:
+                result = self._request(
+                    'delete_multi_objects',
+                    objects=[tos.models2.ObjectTobeDeleted(key=key) for key in batch],
+                    quiet=True
+                )
+                failed.extend(error.key for error in result.error)
+            except Exception as e:
+                print(f"批量删除文件失败: {e}")
+                failed.extend(batch)
+        return failed
+
+    def list_objects(self, prefix: str, page_size: int = 1000):
+        """ListObjectsV2分页列举，用continuation token逐页请求"""
+        self.ensure_client()
+        token = None
+        while True:
+            result = self._request(
+                'list_objects_type2',
+                prefix=prefix,
+                continuation_token=token,
+                max_keys=page_size,
+                list_only_once=True
+            )
+            for item in result.contents:
+                yield StoredObject(item.key, item.size, item.last_modified.timestamp())
+            if not result.is_truncated:
+                return
+            token = result.next_continuation_token
+
+    def url(self, key: str) -> str:
+        return f"{self.url_prefix}/{key}"
+
+    def stats(self) -> dict:
+        """请求统计（本类自行计数）和底层HTTP连接池的使用情况"""
+        with self.stats_lock:
+            in_flight, requests = self.in_flight, self.requests
+        return {
+            'backend': self.name,
+            'initialized': self.client is not None,
+            'max_connections': self.config['TOS_MAX_CONNECTIONS'],
+            'in_flight_requests': in_flight,
+            'requests': requests,
+            'pools': self._pool_stats()
+        }
+
+    def _pool_stats(self):
+        """尽力读取每个域名已创建的连接数、空闲连接数和请求数
+
+        依赖TOS SDK内部的requests会话和urllib3连接池，SDK实现变化时返回None而不影响其他统计。
+        """
+        session = getattr(self.client, 'session', None)
+        if session is None:
+            return []
+        try:
+            pools = []
+            for adapter in set(session.adapters.values()):
+                manager = getattr(adapter, 'poolmanager', None)
+                if manager is None:
+                    continue
+                for pool_key in list(manager.pools.keys()):
+                    pool = manager.pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+                    pools.append({
+                        'host': pool.host,
+                        'max_size': pool.pool.maxsize if pool.pool else 0,
+                        'connections_created': pool.num_connections,
+                        'idle_connections': idle,
+                        'requests': pool.num_requests
+                    })
+            return pools
+        except Exception as e:
+            print(f"读取TOS连接池统计失败: {e}")
+            return None
+
+
+class LocalStorage(StorageBackend):
+    """本地文件系统存储：对象保存在根目录下与key相同的路径，由Flask提供访问（支持Range请求）"""
+
+    name = 'local'
+
+    def __init__(self, root: str, url_prefix: str):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.rstrip('/')
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise KeyError(key)
+        return path
+
+    def put(self, key: str, content, content_length: int, content_type: str):
+        """先写入同目录下的临时文件再原子替换，读取方不会看到写了一半的文件"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(content, (bytes, bytearray)):
+                    f.write(content)
+                else:
+                    shutil.copyfileobj(content, f, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def iter_chunks(self, key: str, chunk_size: int):
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+        with f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def exists(self, key: str) -> bool:
+        try:
+            return os.path.isfile(self._path(key))
+        except KeyError:
+            return False
+
+    def delete(self, keys: list) -> list:
+        failed = []
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, KeyError):
+                failed.append(key)
+        return failed
+
+    def list_objects(self, prefix: str, page_size: int = 1000):
+        """逐层遍历目录，每层按名称排序（子目录名后加 / 参与排序），得到与对象存储一致的key顺序"""
+        base = prefix.rsplit('/', 1)[0] + '/' if '/' in prefix else ''
+        for item in self._walk(os.path.join(self.root, base), base):
+            if item.key.startswith(prefix):
+                yield item
+
+    def _walk(self, directory: str, key_prefix: str):
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        names = sorted(
+            (entry.name + '/' if entry.is_dir() else entry.name, entry)
+            for entry in entries if not entry.name.startswith('.tmp')
+        )
+        for name, entry in names:
+            if entry.is_dir():
+                yield from self._walk(entry.path, key_prefix + name)
+            else:
+                stat = entry.stat()
+                yield StoredObject(key_prefix + name, stat.st_size, stat.st_mtime)
+
+    def url(self, key: str) -> str:
+        return f"{self.url_prefix}/{key}"
+
+    def serve(self, key: str):
+        # send_from_directory会拒绝越出根目录的路径，并处理Range、ETag和If-Modified-Since
+        return send_from_directory(self.root, key, max_age=current_app.config['STORAGE_MAX_AGE'])
+
+    def stats(self) -> dict:
+        return {'backend': self.name, 'root': self.root}
+
+
+class MemoryStorage(StorageBackend):
+    """进程内存储，用于测试和离线压测"""
+
+    name = 'memory'
+
+    def __init__(self, url_prefix: str):
+        self.url_prefix = url_prefix.rstrip('/')
+        self.objects = {}  # key -> (内容, Content-Type, ETag, 写入时间)
+        self.lock = threading.Lock()
+
+    def put(self, key: str, content, content_length: int, content_type: str):
+        data = bytes(content) if isinstance(content, (bytes, bytearray)) else content.read()
+        with self.lock:
+            self.objects[key] = (data, content_type, hashlib.md5(data).hexdigest(), time.time())
+
+    def get(self, key: str) -> bytes:
+        with self.lock:
+            return self.objects[key][0]
+
+    def exists(self, key: str) -> bool:
+        with self.lock:
+            return key in self.objects
+
+    def delete(self, keys: list) -> list:
+        with self.lock:
+            for key in keys:
+                self.objects.pop(key, None)
+        return []
+
+    def list_objects(self, prefix: str, page_size: int = 1000):
+        with self.lock:
+            items = [
+                StoredObject(key, len(entry[0]), entry[3])
+                for key, entry in self.objects.items() if key.startswith(prefix)
+            ]
+        yield from sorted(items, key=lambda item: item.key)
+
+    def url(self, key: str) -> str:
+        return f"{self.url_prefix}/{key}"
+
+    def serve(self, key: str):
+        with self.lock:
+            entry = self.objects.get(key)
+        if entry is None:
+            abort(404)
+        data, content_type, etag, _ = entry
+        return send_file(
+            BytesIO(data),
+            mimetype=content_type or mimetypes.guess_type(key)[0] or 'application/octet-stream',
+            etag=etag,
+            conditional=True,
+            max_age=current_app.config['STORAGE_MAX_AGE']
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'backend': self.name, 'objects': len(self.objects),
+                    'bytes': sum(len(entry[0]) for entry in self.objects.values())}
+
+
+def create_storage(config) -> StorageBackend:
+    """按STORAGE_BACKEND配置创建存储后端：tos（默认）、local、memory"""
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(config['LOCAL_STORAGE_ROOT'], config['STORAGE_URL_PREFIX'])
+    if backend == 'memory':
+        return MemoryStorage(config['STORAGE_URL_PREFIX'])
+    if backend == 'tos':
+        return TOSStorage(config)
+    raise ValueError(f'不支持的存储后端: {backend}')
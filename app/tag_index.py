@@ -0,0 +1,362 @@
+import re
+import threading
+import numpy as np
+from sqlalchemy import and_, false, or_, select
+from . import db
+
+# 位图按图片ID的高位分块：每块覆盖 2**CHUNK_BITS 个ID，用Python整数按位存储，没有图片的块不占内存
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# 加载索引时每批读取的标签关联数量
+LOAD_BATCH = 100000
+# 一个表达式最多包含的标签数量
+MAX_EXPRESSION_TERMS = 32
+
+TOKEN_RE = re.compile(
+    r'\s*(?:(?P<op>[()&|!,-])|"(?P<quoted>[^"]*)"|#(?P<id>\d+)(?![^\s()&|!,"])|(?P<word>[^\s()&|!,"]+))'
+)
+OPERATORS = {'and': '&', 'or': '|', 'not': '!'}
+
+
+class TagExpressionError(ValueError):
+    """标签表达式格式错误"""
+
+
+class Bitmap:
+    """分块压缩的图片ID位图：{块号: 块内位图}，交、并、差按块计算，只处理双方都有的块"""
+
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks: dict = None):
+        self.chunks = chunks or {}
+
+    @classmethod
+    def from_ids(cls, ids) -> 'Bitmap':
+        """由图片ID批量构建（逐个add每次都要复制整块，加载大量关联时使用）"""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        chunks = {}
+        keys = ids >> CHUNK_BITS
+        for key in np.unique(keys).tolist():
+            flags = np.zeros(CHUNK_MASK + 1, dtype=np.uint8)
+            flags[ids[keys == key] & CHUNK_MASK] = 1
+            chunks[key] = int.from_bytes(np.packbits(flags, bitorder='little').tobytes(), 'little')
+        return cls(chunks)
+
+    def add(self, photo_id: int):
+        key = photo_id >> CHUNK_BITS
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << (photo_id & CHUNK_MASK))
+
+    def discard(self, photo_id: int):
+        key = photo_id >> CHUNK_BITS
+        bits = self.chunks.get(key, 0) & ~(1 << (photo_id & CHUNK_MASK))
+        if bits:
+            self.chunks[key] = bits
+        else:
+            self.chunks.pop(key, None)
+
+    def __contains__(self, photo_id: int) -> bool:
+        return bool(self.chunks.get(photo_id >> CHUNK_BITS, 0) >> (photo_id & CHUNK_MASK) & 1)
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        small, large = sorted((self.chunks, other.chunks), key=len)
+        chunks = {}
+        for key, bits in small.items():
+            bits &= large.get(key, 0)
+            if bits:
+                chunks[key] = bits
+        return Bitmap(chunks)
+
+    def __or__(self, other: 'Bitmap') -> 'Bitmap':
+        chunks = dict(self.chunks)
+        for key, bits in other.chunks.items():
+            chunks[key] = chunks.get(key, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other: 'Bitmap') -> 'Bitmap':
+        chunks = {}
+        for key, bits in self.chunks.items():
+            bits &= ~other.chunks.get(key, 0)
+            if bits:
+                chunks[key] = bits
+        return Bitmap(chunks)
+
+    def __len__(self) -> int:
+        return sum(bits.bit_count() for bits in self.chunks.values())
+
+    def copy(self) -> 'Bitmap':
+        return Bitmap(dict(self.chunks))
+
+    def ids(self, descending: bool = True, after: int = None):
+        """按ID升序或降序逐个生成图片ID；after为上一页最后一个ID（不含），逐块展开，只取一页时不展开全部"""
+        for key in sorted(self.chunks, reverse=descending):
+            base = key << CHUNK_BITS
+            if after is not None and (base > after if descending else base + CHUNK_MASK < after):
+                continue
+            bits = self.chunks[key]
+            data = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'), dtype=np.uint8)
+            positions = np.flatnonzero(np.unpackbits(data, bitorder='little')) + base
+            if descending:
+                positions = positions[::-1]
+                if after is not None:
+                    positions = positions[positions < after]
+            elif after is not None:
+                positions = positions[positions > after]
+            yield from positions.tolist()
+
+
+# 标签表达式语法：表达式 = 与项 (OR 与项)*；与项 = [NOT] 因子 (AND [NOT] 因子)*；因子 = (表达式) | 标签
+# 运算符可写作 AND/OR/NOT（不区分大小写）或 & | !，OR也可写作逗号，NOT也可写作减号；
+# 标签为名称、带双引号的名称（名称含空格或运算符时使用）或 #ID（如 #3，不带#的数字按名称查找）；
+# NOT只能与其他条件相与，如 猫 AND NOT 狗
+# 解析结果为语法树：('tag', 名称或整数ID)、('or', [子树...])、('and', [子树...], [排除的子树...])
+class _Parser:
+    """递归下降解析标签表达式，生成语法树，由位图索引或SQL分别计算"""
+
+    def __init__(self, expression: str):
+        self.tokens = self._tokenize(expression)
+        self.position = 0
+        self.terms = 0
+
+    @staticmethod
+    def _tokenize(expression: str) -> list:
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = TOKEN_RE.match(expression, position)
+            if not match or match.end() == position:
+                raise TagExpressionError(f'无法解析标签表达式: {expression[position:]}')
+            position = match.end()
+            if match.group('op'):
+                tokens.append(('op', {',': '|', '-': '!'}.get(match.group('op'), match.group('op'))))
+            elif match.group('quoted') is not None:
+                tokens.append(('tag', match.group('quoted')))
+            elif match.group('id'):
+                tokens.append(('tag', int(match.group('id'))))
+            elif match.group('word').lower() in OPERATORS:
+                tokens.append(('op', OPERATORS[match.group('word').lower()]))
+            else:
+                tokens.append(('tag', match.group('word')))
+        return tokens
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _accept(self, op: str) -> bool:
+        if self._peek() == ('op', op):
+            self.position += 1
+            return True
+        return False
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            raise TagExpressionError('标签表达式为空')
+        result = self._or()
+        if self.position != len(self.tokens):
+            raise TagExpressionError(f'标签表达式多余的内容: {self._peek()[1]}')
+        return result
+
+    def _or(self) -> tuple:
+        parts = [self._and()]
+        while self._accept('|'):
+            parts.append(self._and())
+        return parts[0] if len(parts) == 1 else ('or', parts)
+
+    def _and(self) -> tuple:
+        included, excluded = [], []
+        while True:
+            negated = self._accept('!')
+            (excluded if negated else included).append(self._factor())
+            if not self._accept('&'):
+                break
+        if not included:
+            raise TagExpressionError('NOT需要与其他条件一起使用，如 猫 AND NOT 狗')
+        return included[0] if len(included) == 1 and not excluded else ('and', included, excluded)
+
+    def _factor(self) -> tuple:
+        if self._accept('!'):
+            raise TagExpressionError('不支持连续的NOT')
+        if self._accept('('):
+            result = self._or()
+            if not self._accept(')'):
+                raise TagExpressionError('标签表达式缺少右括号')
+            return result
+        kind, value = self._peek()
+        if kind != 'tag':
+            raise TagExpressionError(f'标签表达式此处应为标签: {value or "结尾"}')
+        self.position += 1
+        self.terms += 1
+        if self.terms > MAX_EXPRESSION_TERMS:
+            raise TagExpressionError(f'标签表达式最多包含{MAX_EXPRESSION_TERMS}个标签')
+        return ('tag', value)
+
+
+def _tag_id(names: dict, value):
+    """语法树中的标签对应的标签ID：整数为 #ID 写法，字符串按名称查找"""
+    return value if isinstance(value, int) else names.get(value)
+
+
+def _evaluate(node: tuple, lookup) -> Bitmap:
+    """在位图上计算语法树"""
+    if node[0] == 'tag':
+        return lookup(node[1])
+    if node[0] == 'or':
+        result = Bitmap()
+        for child in node[1]:
+            result = result | _evaluate(child, lookup)
+        return result
+    # 从最小的位图开始求交，交集为空时提前结束
+    included = sorted((_evaluate(child, lookup) for child in node[1]), key=len)
+    result = included[0]
+    for bitmap in included[1:]:
+        if not result.chunks:
+            break
+        result = result & bitmap
+    for child in node[2]:
+        result = result - _evaluate(child, lookup)
+    return result
+
+
+def _condition(node: tuple, lookup):
+    """把语法树转为图片查询的SQL条件，每个标签为一个关联表子查询"""
+    from .models import Photo, photo_tag
+    if node[0] == 'tag':
+        tag_id = lookup(node[1])
+        if tag_id is None:
+            return false()
+        return Photo.id.in_(select(photo_tag.c.photo_id).where(photo_tag.c.tag_id == tag_id))
+    if node[0] == 'or':
+        return or_(*(_condition(child, lookup) for child in node[1]))
+    return and_(*(_condition(child, lookup) for child in node[1]),
+                *(~_condition(child, lookup) for child in node[2]))
+
+
+class TagIndex:
+    """进程内的标签位图索引：每个标签一个图片ID位图，按表达式筛选时只做位运算，不查询关联表"""
+
+    def __init__(self):
+        self.app = None
+        self.bitmaps = {}  # 标签ID -> Bitmap
+        self.names = {}  # 标签名 -> 标签ID
+        self.hidden = Bitmap()  # 未公开或尚未入库完成的图片，不出现在筛选结果中
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def init_app(self, app):
+        """启动时加载索引，失败时推迟到首次查询"""
+        self.app = app
+        app.extensions['tag_index'] = self
+        with app.app_context():
+            try:
+                self.load()
+            except Exception as e:
+                db.session.rollback()
+                print(f"标签索引加载失败，将在首次查询时重试: {e}")
+
+    def load(self):
+        """从数据库加载所有标签关联"""
+        from .models import Photo, Tag, photo_tag
+        # 关联分批读入数组，按标签排序后分组构建位图
+        result = db.session.connection().execute(select(photo_tag.c.tag_id, photo_tag.c.photo_id))
+        batches = []
+        while True:
+            rows = result.fetchmany(LOAD_BATCH)
+            if not rows:
+                break
+            batches.append(np.array([tuple(row) for row in rows], dtype=np.int64))
+        links = np.concatenate(batches) if batches else np.zeros((0, 2), dtype=np.int64)
+        links = links[np.argsort(links[:, 0], kind='stable')]
+        tag_ids, starts = np.unique(links[:, 0], return_index=True)
+        bitmaps = {
+            tag_id: Bitmap.from_ids(photo_ids)
+            for tag_id, photo_ids in zip(tag_ids.tolist(), np.split(links[:, 1], starts[1:]))
+        }
+        names = {name: tag_id for tag_id, name in db.session.query(Tag.id, Tag.name)}
+        hidden = Bitmap.from_ids([
+            photo_id for (photo_id,) in db.session.query(Photo.id).filter(
+                (Photo.is_public != True) | (Photo.status != 'ready')
+            ).yield_per(50000)
+        ])
+        with self.lock:
+            self.bitmaps = bitmaps
+            self.names = names
+            self.hidden = hidden
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+
+    def add(self, photo_id: int, tag_id: int, tag_name: str, visible: bool = True):
+        """为图片添加标签"""
+        self._ensure_loaded()
+        with self.lock:
+            bitmap = self.bitmaps.get(tag_id, Bitmap()).copy()
+            bitmap.add(photo_id)
+            self.bitmaps[tag_id] = bitmap
+            self.names[tag_name] = tag_id
+            self._set_visible(photo_id, visible)
+
+    def remove(self, photo_id: int, tag_id: int):
+        """移除图片的标签"""
+        with self.lock:
+            bitmap = self.bitmaps.get(tag_id)
+            if bitmap is not None and photo_id in bitmap:
+                bitmap = bitmap.copy()
+                bitmap.discard(photo_id)
+                self.bitmaps[tag_id] = bitmap
+
+    def remove_photos(self, photo_ids: list):
+        """删除图片后移除其所有标签"""
+        removed = Bitmap.from_ids(photo_ids)
+        with self.lock:
+            for tag_id, bitmap in list(self.bitmaps.items()):
+                if (bitmap & removed).chunks:
+                    self.bitmaps[tag_id] = bitmap - removed
+            if (self.hidden & removed).chunks:
+                self.hidden = self.hidden - removed
+
+    def set_visible(self, photo_id: int, visible: bool):
+        """图片公开状态或入库状态变化"""
+        with self.lock:
+            self._set_visible(photo_id, visible)
+
+    def _set_visible(self, photo_id: int, visible: bool):
+        # 位图在读取时可能被其他线程引用，修改时先复制
+        if visible != (photo_id not in self.hidden):
+            hidden = self.hidden.copy()
+            if visible:
+                hidden.discard(photo_id)
+            else:
+                hidden.add(photo_id)
+            self.hidden = hidden
+
+    def evaluate(self, expression: str) -> Bitmap:
+        """计算标签表达式，返回可见图片的ID位图；表达式错误时抛出TagExpressionError"""
+        tree = _Parser(expression).parse()
+        self._ensure_loaded()
+        # 位图修改时整体替换（写时复制），这里直接引用当前的字典和位图即可
+        bitmaps, names, hidden = self.bitmaps, self.names, self.hidden
+        return _evaluate(tree, lambda value: bitmaps.get(_tag_id(names, value), Bitmap())) - hidden
+
+    def filter(self, query, expression: str):
+        """按标签表达式筛选图片查询（与其他条件组合或按其他字段排序时使用，不受结果数量限制）；
+        单个标签时与tag_id参数一样连接关联表，否则每个标签生成一个子查询"""
+        from .models import Photo, photo_tag
+        tree = _Parser(expression).parse()
+        self._ensure_loaded()
+        names = self.names
+        if tree[0] == 'tag':
+            tag_id = _tag_id(names, tree[1])
+            if tag_id is None:
+                return query.filter(false())
+            # 使用别名，可与tag_id参数的连接同时存在
+            link = photo_tag.alias()
+            return query.join(link, link.c.photo_id == Photo.id).filter(link.c.tag_id == tag_id)
+        return query.filter(_condition(tree, lambda value: _tag_id(names, value)))
+
+
+# 全局标签索引
+tag_index = TagIndex()
@@ -1,47 +1,314 @@
-import os
+import re
+import json
+import base64
 import hashlib
 import uuid
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
 from PIL import Image, ImageOps
-import tos
 from flask import current_app
+from dataclasses import dataclass, field
+from typing import Optional
+from .similarity import dhash
+from .colors import color_histogram, dominant_colors
+from .storage import StorageBackend, TOSStorage, create_storage, stream_length
+
+# EXIF方向标签
+EXIF_ORIENTATION = 0x0112
+
+# 内容寻址文件名：<哈希前2位>/<哈希3-4位>/<哈希>.<扩展名>
+CONTENT_ADDRESSED_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32,64}\.')
+
+# 多尺寸图片支持的输出格式：格式名 -> (PIL格式, 扩展名, Content-Type)
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg')
+}
+
+
+@dataclass
+class Rendition:
+    """某一宽度、某一格式的衍生图片"""
+    width: int
+    height: int
+    format: str
+    content: bytes
+
+
+@dataclass
+class ImageAnalysis:
+    """图片分析结果"""
+    width: int
+    height: int
+    format: str
+    mode: str
+    thumbnail: Optional[bytes] = None
+    phash: Optional[str] = None  # 64位dHash（十六进制），用于相似图片检测
+    colors: Optional[str] = None  # 主色，逗号分隔的 #rrggbb
+    color_histogram: Optional[bytes] = None  # 64区间颜色直方图，用于按颜色搜索
+    placeholder: Optional[str] = None  # 极小尺寸的WebP占位图（data URI）
+    renditions: list = field(default_factory=list)
+
+
+def rendition_key(filename: str, width: int, fmt: str) -> str:
+    """衍生图片在TOS中的key，例如 renditions/<文件名>/400.webp"""
+    stem = filename.rsplit('.', 1)[0]
+    return f"renditions/{stem}/{width}.{RENDITION_FORMATS[fmt][1]}"
+
+
+def encode_renditions(renditions: list) -> Optional[str]:
+    """将衍生图片列表压缩为Photo.renditions中保存的JSON：{"s": [[宽, 高], ...], "f": [格式, ...]}"""
+    if not renditions:
+        return None
+    sizes = sorted({(r.width, r.height) for r in renditions})
+    formats = [fmt for fmt in RENDITION_FORMATS if any(r.format == fmt for r in renditions)]
+    return json.dumps({'s': [list(size) for size in sizes], 'f': formats}, separators=(',', ':'))
+
+
+def flatten_to_rgb(img: Image.Image) -> Image.Image:
+    """透明图片铺白色背景转换为RGB，其他模式直接转换"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        return background
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def placeholder_data_uri(img: Image.Image, size: int = 16) -> str:
+    """生成长边为size像素的低质量WebP，以data URI形式内联在列表数据中，图片加载前作为模糊占位"""
+    small = img.copy()
+    small.thumbnail((size, size), Image.Resampling.BILINEAR)
+    buffer = BytesIO()
+    small.save(buffer, format='WEBP', quality=30, method=6)
+    return 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def _as_file(file_content):
+    """bytes包装为BytesIO，文件对象重置到开头后直接使用"""
+    if isinstance(file_content, (bytes, bytearray)):
+        return BytesIO(file_content)
+    file_content.seek(0)
+    return file_content
+
+
+class DecodeRejected(Exception):
+    """内存预算不足，图片解码请求被拒绝（排队已满或等待超时）"""
+
+
+def estimate_decode_memory(img: Image.Image) -> int:
+    """根据文件头（及draft后的解码尺寸）估算解码所需内存
+
+    Pillow中多通道图片每像素占4字节；旋转、转RGB和第一次缩放还会各产生一份副本，按两份RGB副本估算。
+    """
+    pixels = img.width * img.height
+    depth = 4 if img.mode in ('I', 'F') else 2 if img.mode.startswith('I;16') else 1
+    decoded = pixels * (1 if len(img.getbands()) == 1 else 4) * depth
+    return decoded + pixels * 4 * 2
+
+
+class DecodeScheduler:
+    """图片解码的准入控制：所有线程共享一个内存预算，预算不足时按先来先服务排队，排队过多或等待超时则拒绝"""
+    
+    def __init__(self, budget_bytes: int = 1024 * 1024 * 1024, timeout: float = 30, max_queue: int = 64):
+        self.budget_bytes = budget_bytes
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.in_use_bytes = 0
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def configure(self, budget_bytes: int, timeout: float, max_queue: int):
+        with self.condition:
+            self.budget_bytes = budget_bytes
+            self.timeout = timeout
+            self.max_queue = max_queue
+            self.condition.notify_all()
+    
+    @contextmanager
+    def admit(self, estimated_bytes: int):
+        """预算有余量时进入，退出时归还；超过整个预算的图片需独占预算"""
+        needed = min(estimated_bytes, self.budget_bytes)
+        ticket = object()
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                raise DecodeRejected('图片处理繁忙，请稍后重试')
+            self.queue.append(ticket)
+            started = time.monotonic()
+            admitted = self.condition.wait_for(
+                lambda: self.queue[0] is ticket and self.in_use_bytes + needed <= self.budget_bytes,
+                timeout=self.timeout
+            )
+            self.queue.remove(ticket)
+            waited = time.monotonic() - started
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            if not admitted:
+                self.timeouts += 1
+                self.condition.notify_all()
+                raise DecodeRejected('等待图片解码超时，请稍后重试')
+            self.in_use_bytes += needed
+            self.admitted += 1
+            # 队首已出队，唤醒下一个等待者检查预算
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use_bytes -= needed
+                self.condition.notify_all()
+    
+    def metrics(self) -> dict:
+        with self.condition:
+            finished = self.admitted + self.timeouts
+            return {
+                'budget_bytes': self.budget_bytes,
+                'in_use_bytes': self.in_use_bytes,
+                'queue_depth': len(self.queue),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'avg_wait_seconds': self.total_wait / finished if finished else 0.0,
+                'max_wait_seconds': self.max_wait
+            }
+
 
 class TOSClient:
-    """火山引擎TOS客户端"""
+    """图片存储客户端：负责图片处理和上传流程，对象读写交给配置的存储后端（TOS、本地文件系统或内存）"""
     
     def __init__(self):
-        self.client = None
+        self.storage = None
+        self.lock = threading.Lock()
     
-    def _init_client(self):
-        """初始化TOS客户端"""
-        try:
-            self.client = tos.TosClientV2(
-                region=current_app.config['TOS_REGION'],
-                ak=current_app.config['TOS_ACCESS_KEY'],
-                sk=current_app.config['TOS_SECRET_KEY'],
-                endpoint=current_app.config['TOS_ENDPOINT']
-            )
-        except Exception as e:
-            print(f"TOS客户端初始化失败: {e}")
-            raise e
+    def init_app(self, app):
+        """按配置创建存储后端；TOS后端在启动时即创建共享的连接池，配置有误时启动即失败"""
+        self.storage = create_storage(app.config)
+        app.extensions['storage'] = self.storage
+        if isinstance(self.storage, TOSStorage):
+            self.storage.ensure_client()
+    
+    def _backend(self) -> StorageBackend:
+        """当前存储后端（未调用init_app时按当前应用配置创建）"""
+        if self.storage is None:
+            with self.lock:
+                if self.storage is None:
+                    self.storage = create_storage(current_app.config)
+        return self.storage
+    
+    def storage_stats(self) -> dict:
+        """存储后端的使用情况（TOS为连接池统计）"""
+        return self._backend().stats()
     
-    def generate_filename(self, original_filename: str) -> str:
-        """生成唯一文件名"""
+    def generate_filename(self, original_filename: str, content_hash: str = None, content_addressed: bool = None) -> str:
+        """生成唯一文件名；开启内容寻址且提供了内容哈希时，相同内容始终得到相同的文件名"""
         ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'jpg'
+        if content_addressed is None:
+            content_addressed = current_app.config['TOS_CONTENT_ADDRESSED']
+        if content_hash and content_addressed:
+            return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.{ext}"
         return f"{uuid.uuid4().hex}.{ext}"
     
+    def _already_uploaded(self, filename: str, key: str) -> bool:
+        """内容寻址的对象内容由key唯一确定，已存在时无需重复上传"""
+        return bool(CONTENT_ADDRESSED_RE.match(filename)) and self._backend().exists(key)
+    
     def calculate_file_hash(self, file_content: bytes) -> str:
         """计算文件MD5哈希值"""
         return hashlib.md5(file_content).hexdigest()
     
+    def analyze_image(self, file_content, thumbnail_size: tuple = (400, 400),
+                      rendition_widths: tuple = (), rendition_formats: tuple = ('webp', 'jpeg')) -> ImageAnalysis:
+        """分析图片：只打开一次，从文件头读取尺寸和格式，按目标尺寸缩小解码后生成缩略图和各尺寸衍生图
+        
+        file_content 可以是bytes，也可以是可seek的文件对象（按需读取，不整体载入内存）。
+        """
+        try:
+            img = Image.open(_as_file(file_content))
+        except Exception as e:
+            print(f"获取图片信息失败: {e}")
+            return ImageAnalysis(width=0, height=0, format='Unknown', mode='Unknown')
+        
+        with img:
+            # 尺寸、格式来自文件头，无需解码像素；EXIF方向为90/270度时交换宽高
+            width, height = img.size
+            rotated = img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+            if rotated:
+                width, height = height, width
+            analysis = ImageAnalysis(width=width, height=height, format=img.format, mode=img.mode)
+            
+            # JPEG按需要的最大尺寸缩小解码（DCT域缩放），避免解码全尺寸像素
+            decode_size = (max([thumbnail_size[0], *rendition_widths]), thumbnail_size[1])
+            img.draft('RGB', (decode_size[1], decode_size[0]) if rotated else decode_size)
+            
+            # 按缩小解码后的尺寸估算像素内存，内存预算不足时排队等待
+            with decode_scheduler.admit(estimate_decode_memory(img)):
+                try:
+                    # 自动旋转图片
+                    thumb = ImageOps.exif_transpose(img)
+                    
+                    # 如果是RGBA，转换为RGB
+                    thumb = flatten_to_rgb(thumb)
+                    
+                    # 从同一次解码的结果逐级缩小生成各尺寸衍生图
+                    if rendition_widths:
+                        analysis.renditions = self._build_renditions(thumb, rendition_widths, rendition_formats)
+                    
+                    # 创建缩略图
+                    thumb.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
+                    analysis.phash = dhash(thumb)
+                    analysis.colors = ','.join(dominant_colors(thumb))
+                    analysis.color_histogram = color_histogram(thumb)
+                    analysis.placeholder = placeholder_data_uri(thumb)
+                    
+                    # 保存为字节流
+                    thumbnail_buffer = BytesIO()
+                    thumb.save(thumbnail_buffer, format='JPEG', optimize=True, quality=85)
+                    analysis.thumbnail = thumbnail_buffer.getvalue()
+                except Exception as e:
+                    print(f"创建缩略图失败: {e}")
+            
+            return analysis
+    
+    def _build_renditions(self, img: Image.Image, widths: tuple, formats: tuple) -> list:
+        """按宽度从大到小逐级缩放并编码；不放大图片，原图比所有档位都窄时按原宽度输出一档"""
+        targets = sorted({w for w in widths if w < img.width}, reverse=True) or [img.width]
+        renditions = []
+        source = img
+        for width in targets:
+            height = max(1, round(img.height * width / img.width))
+            if source.width != width:
+                source = source.resize((width, height), Image.Resampling.LANCZOS)
+            for fmt in formats:
+                buffer = BytesIO()
+                if fmt == 'webp':
+                    source.save(buffer, format='WEBP', quality=80, method=4)
+                else:
+                    source.save(buffer, format='JPEG', quality=85, optimize=True, progressive=True)
+                renditions.append(Rendition(width=width, height=height, format=fmt, content=buffer.getvalue()))
+        renditions.sort(key=lambda r: r.width)
+        return renditions
+    
     def get_image_info(self, file_content: bytes) -> dict:
-        """获取图片信息"""
+        """获取图片信息（只读取文件头）"""
         try:
             with Image.open(BytesIO(file_content)) as img:
-                img = ImageOps.exif_transpose(img)
+                width, height = img.size
+                if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+                    width, height = height, width
                 return {
-                    'width': img.width,
-                    'height': img.height,
+                    'width': width,
+                    'height': height,
                     'format': img.format,
                     'mode': img.mode
                 }
@@ -51,120 +318,121 @@ class TOSClient:
     
     def create_thumbnail(self, file_content: bytes, size: tuple = (400, 400)) -> bytes:
         """创建缩略图"""
-        try:
-            with Image.open(BytesIO(file_content)) as img:
-                # 自动旋转图片
-                img = ImageOps.exif_transpose(img)
-                
-                # 如果是RGBA，转换为RGB
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = background
-                
-                # 创建缩略图
-                img.thumbnail(size, Image.Resampling.LANCZOS)
-                
-                # 保存为字节流
-                thumbnail_buffer = BytesIO()
-                img.save(thumbnail_buffer, format='JPEG', optimize=True, quality=85)
-                return thumbnail_buffer.getvalue()
+        return self.analyze_image(file_content, size).thumbnail
+    
+    def render_variant(self, file_content, size: tuple, fmt: str) -> bytes:
+        """按与缩略图相同的流程生成指定尺寸（等比缩放到size以内）和格式的图片"""
+        with Image.open(_as_file(file_content)) as img:
+            rotated = img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+            img.draft('RGB', (size[1], size[0]) if rotated else size)
+            with decode_scheduler.admit(estimate_decode_memory(img)):
+                variant = flatten_to_rgb(ImageOps.exif_transpose(img))
+                variant.thumbnail(size, Image.Resampling.LANCZOS)
                 
-        except Exception as e:
-            print(f"创建缩略图失败: {e}")
-            return None
+                buffer = BytesIO()
+                if fmt == 'webp':
+                    variant.save(buffer, format='WEBP', quality=80, method=4)
+                else:
+                    variant.save(buffer, format='JPEG', quality=85, optimize=True, progressive=True)
+                return buffer.getvalue()
     
-    def upload_file(self, file_content: bytes, filename: str, content_type: str) -> str:
-        """上传文件到TOS"""
-        if not self.client:
-            self._init_client()
-            
+    def upload_file(self, file_content, filename: str, content_type: str, content_length: int = None) -> str:
+        """上传原图（file_content为bytes或文件对象，文件对象按块流式读取）"""
         try:
-            bucket_name = current_app.config['TOS_BUCKET_NAME']
             key = f"photos/{filename}"
             
-            # 上传文件
-            result = self.client.put_object(
-                bucket=bucket_name,
-                key=key,
-                content=file_content,
-                content_type=content_type
-            )
+            if hasattr(file_content, 'seek'):
+                file_content.seek(0)
+            if content_length is None:
+                content_length = stream_length(file_content)
             
-            # 返回文件URL，使用正确的TOS域名格式
-            if current_app.config.get('TOS_CDN_DOMAIN'):
-                return f"https://{current_app.config['TOS_CDN_DOMAIN']}/{key}"
-            else:
-                # 清理TOS_ENDPOINT，确保不包含https://前缀
-                tos_endpoint = current_app.config['TOS_ENDPOINT']
-                if tos_endpoint.startswith('https://'):
-                    tos_endpoint = tos_endpoint[8:]
-                elif tos_endpoint.startswith('http://'):
-                    tos_endpoint = tos_endpoint[7:]
-                
-                # 使用正确的URL格式
-                return f"https://{bucket_name}.{tos_endpoint}/{key}"
+            if not self._already_uploaded(filename, key):
+                self._backend().put(key, file_content, content_length, content_type)
+            
+            # 返回文件URL
+            return self.object_url(key)
                 
         except Exception as e:
             print(f"上传文件失败: {e}")
             raise e
     
     def upload_thumbnail(self, thumbnail_content: bytes, filename: str) -> str:
-        """上传缩略图到TOS"""
-        if not self.client:
-            self._init_client()
-            
+        """上传缩略图"""
         try:
-            bucket_name = current_app.config['TOS_BUCKET_NAME']
             key = f"thumbnails/{filename}"
             
-            result = self.client.put_object(
-                bucket=bucket_name,
-                key=key,
-                content=thumbnail_content,
-                content_type='image/jpeg'
-            )
+            if not self._already_uploaded(filename, key):
+                self._backend().put(key, thumbnail_content, len(thumbnail_content), 'image/jpeg')
             
-            # 返回缩略图URL，使用正确的TOS域名格式
-            if current_app.config.get('TOS_CDN_DOMAIN'):
-                return f"https://{current_app.config['TOS_CDN_DOMAIN']}/{key}"
-            else:
-                # 清理TOS_ENDPOINT，确保不包含https://前缀
-                tos_endpoint = current_app.config['TOS_ENDPOINT']
-                if tos_endpoint.startswith('https://'):
-                    tos_endpoint = tos_endpoint[8:]
-                elif tos_endpoint.startswith('http://'):
-                    tos_endpoint = tos_endpoint[7:]
-                
-                # 使用正确的URL格式
-                return f"https://{bucket_name}.{tos_endpoint}/{key}"
+            # 返回缩略图URL
+            return self.object_url(key)
                 
         except Exception as e:
             print(f"上传缩略图失败: {e}")
             raise e
     
-    def delete_file(self, filename: str):
-        """删除文件"""
-        if not self.client:
-            self._init_client()
-            
+    def object_url(self, key: str) -> str:
+        """根据key生成对象的访问URL（由存储后端决定，TOS的URL前缀在创建时预先计算）"""
+        return self._backend().url(key)
+    
+    def media_url(self, key: str, stored_url: str = None) -> str:
+        """接口返回给前端的URL：开启媒体代理时指向 /media/<key>，否则为存储中的访问地址"""
+        if current_app.config['MEDIA_PROXY']:
+            return f"{current_app.config['MEDIA_URL_PREFIX']}/{key}"
+        return stored_url or self.object_url(key)
+    
+    def upload_renditions(self, renditions: list, filename: str):
+        """并发上传各尺寸衍生图片"""
+        if not renditions:
+            return
+        
+        app = current_app._get_current_object()
+        storage = self._backend()
+        
+        def upload(rendition):
+            key = rendition_key(filename, rendition.width, rendition.format)
+            with app.app_context():
+                if self._already_uploaded(filename, key):
+                    return
+                storage.put(key, rendition.content, len(rendition.content), RENDITION_FORMATS[rendition.format][2])
+        
+        workers = min(len(renditions), app.config['TOS_UPLOAD_CONCURRENCY'])
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tos-rendition') as executor:
+            for future in [executor.submit(upload, rendition) for rendition in renditions]:
+                future.result()
+    
+    def presign_upload(self, filename: str, content_type: str, file_hash: str, content_length: int, expires: int) -> dict:
+        """生成浏览器直传原图的预签名PUT地址，返回 {'url', 'headers'}"""
+        content_md5 = base64.b64encode(bytes.fromhex(file_hash)).decode('ascii')
+        return self._backend().presign_put(f"photos/{filename}", content_type, content_md5, content_length, expires)
+    
+    def download_chunks(self, key: str, chunk_size: int):
+        """分块下载对象内容，对象不存在时抛出KeyError"""
+        return self._backend().iter_chunks(key, chunk_size)
+    
+    def download_file(self, key: str) -> bytes:
+        """下载对象内容"""
         try:
-            bucket_name = current_app.config['TOS_BUCKET_NAME']
-            
-            # 删除原图和缩略图
-            try:
-                self.client.delete_object(bucket=bucket_name, key=f"photos/{filename}")
-            except:
-                pass
-            try:
-                self.client.delete_object(bucket=bucket_name, key=f"thumbnails/{filename}")
-            except:
-                pass
-                
+            return self._backend().get(key)
+        except Exception as e:
+            print(f"下载文件失败: {e}")
+            raise e
+    
+    def delete_file(self, filename: str, extra_keys: list = ()):
+        """删除文件（原图、缩略图以及extra_keys中的衍生图片），一次批量请求完成"""
+        try:
+            failed = self.delete_objects([f"photos/{filename}", f"thumbnails/{filename}", *extra_keys])
+            if failed:
+                print(f"删除文件失败: {failed}")
         except Exception as e:
             print(f"删除文件失败: {e}")
+    
+    def delete_objects(self, keys: list) -> list:
+        """批量删除对象（TOS每次请求最多1000个key），返回删除失败的key列表"""
+        return self._backend().delete(keys)
 
 # 全局TOS客户端实例
-tos_client = TOSClient()
\ No newline at end of file
+tos_client = TOSClient()
+
+# 全局图片解码调度器
+decode_scheduler = DecodeScheduler()
\ No newline at end of file
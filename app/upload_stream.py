@@ -0,0 +1,62 @@
+import hashlib
+import os
+import tempfile
+from flask import Request, current_app
+
+
+class HashingSpooledFile:
+    """边接收边计算MD5的上传缓冲：小文件留在内存，超过阈值后写入临时文件"""
+
+    def __init__(self, max_memory: int):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory, mode='w+b')
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self._md5.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._md5.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+
+class StreamingRequest(Request):
+    """上传文件写入HashingSpooledFile，解析表单时即完成哈希计算"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile(current_app.config['UPLOAD_SPOOL_MAX_MEMORY'])
+
+
+def spool_upload(stream, chunk_size: int) -> tuple:
+    """返回上传流的 (大小, MD5)，并将读取位置重置到开头
+
+    由StreamingRequest创建的流直接使用接收时算好的结果，其他流按固定块大小读取一遍。
+    """
+    if isinstance(stream, HashingSpooledFile):
+        stream.seek(0)
+        return stream.size, stream.hexdigest()
+
+    md5 = hashlib.md5()
+    size = 0
+    stream.seek(0)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        md5.update(chunk)
+        size += len(chunk)
+    stream.seek(0, os.SEEK_SET)
+    return size, md5.hexdigest()
@@ -0,0 +1,20 @@
+import argparse
+from app import create_app
+from app.backfill import backfill
+from app.colors import color_histogram, dominant_colors
+from app.models import Photo
+
+
+def compute_colors(images: list) -> list:
+    """计算主色和颜色直方图"""
+    return [{'colors': ','.join(dominant_colors(img)), 'color_histogram': color_histogram(img)} for img in images]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='为已有图片回填主色和颜色直方图')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批处理的图片数量')
+    parser.add_argument('--workers', type=int, default=16, help='并发下载线程数')
+    args = parser.parse_args()
+
+    updated = backfill(create_app(), Photo.color_histogram, compute_colors, args.batch_size, args.workers)
+    print(f'颜色直方图回填完成，共更新 {updated} 张图片（重启应用后生效）')
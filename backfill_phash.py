@@ -0,0 +1,25 @@
+import argparse
+import numpy as np
+from app import create_app
+from app.backfill import backfill
+from app.models import Photo
+from app.similarity import dhash_image
+
+
+def dhash_batch(images: list) -> list:
+    """批量计算dHash：缩放为9x8灰度图后用NumPy一次比较所有相邻像素并打包成64位"""
+    pixels = np.stack([np.asarray(dhash_image(img), dtype=np.int16) for img in images])  # (N, 8, 9)
+    bits = pixels[:, :, 1:] > pixels[:, :, :-1]  # (N, 8, 8)
+    packed = np.packbits(bits.reshape(len(images), 64), axis=1)  # (N, 8)，高位在前
+    return [row.tobytes().hex() for row in packed]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='为已有图片回填感知哈希（phash）')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批处理的图片数量')
+    parser.add_argument('--workers', type=int, default=16, help='并发下载线程数')
+    args = parser.parse_args()
+
+    updated = backfill(create_app(), Photo.phash, lambda images: [{'phash': phash} for phash in dhash_batch(images)],
+                       args.batch_size, args.workers)
+    print(f'感知哈希回填完成，共更新 {updated} 张图片（重启应用后生效）')
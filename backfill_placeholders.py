@@ -0,0 +1,17 @@
+import argparse
+from app import create_app
+from app.backfill import backfill
+from app.models import Photo
+from app.tos_client import placeholder_data_uri
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='为已有图片回填加载前显示的模糊占位图')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批处理的图片数量')
+    parser.add_argument('--workers', type=int, default=16, help='并发下载线程数')
+    args = parser.parse_args()
+
+    updated = backfill(create_app(), Photo.placeholder,
+                       lambda images: [{'placeholder': placeholder_data_uri(img)} for img in images],
+                       args.batch_size, args.workers)
+    print(f'占位图回填完成，共更新 {updated} 张图片')
@@ -0,0 +1,211 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import json
+import mimetypes
+import os
+from werkzeug.utils import secure_filename
+from app import create_app, db
+from app.ingest import save_photos, upload_analyzed, SimilarPhotoExists
+from app.models import Photo
+from app.tos_client import tos_client
+
+# 清单中视为已完成（恢复导入时跳过）的状态
+FINISHED_STATUSES = {'done', 'duplicate'}
+
+
+def analyze_path(path: str, rendition_widths: tuple, rendition_formats: tuple) -> dict:
+    """在子进程中计算文件哈希并解码生成缩略图和衍生图（不访问应用上下文）"""
+    try:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+            f.seek(0)
+            analysis = tos_client.analyze_image(
+                f, rendition_widths=rendition_widths, rendition_formats=rendition_formats
+            )
+        return {'path': path, 'hash': md5.hexdigest(), 'analysis': analysis}
+    except Exception as e:
+        return {'path': path, 'error': str(e)}
+
+
+class Manifest:
+    """JSONL格式的导入清单，按 (路径, 大小, 修改时间) 记录每个文件的处理结果"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 中断时最后一行可能不完整
+                    self.entries[entry['path']] = entry
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def is_finished(self, path: str, stat) -> bool:
+        entry = self.entries.get(path)
+        return (entry is not None and entry['status'] in FINISHED_STATUSES
+                and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime)
+
+    def known_hashes(self) -> set:
+        return {e['hash'] for e in self.entries.values() if e['status'] in FINISHED_STATUSES and e.get('hash')}
+
+    def record(self, entries: list):
+        """追加一批记录并落盘"""
+        for entry in entries:
+            self.entries[entry['path']] = entry
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def scan_directory(directory: str, extensions: set, manifest: Manifest) -> list:
+    """遍历目录，返回未完成导入的图片 (路径, stat) 列表"""
+    pending = []
+    skipped = 0
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if name.rsplit('.', 1)[-1].lower() not in extensions:
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            stat = os.stat(path)
+            if manifest.is_finished(path, stat):
+                skipped += 1
+            else:
+                pending.append((path, stat))
+    print(f'共找到 {len(pending) + skipped} 个图片文件，其中 {skipped} 个已导入，待处理 {len(pending)} 个')
+    return pending
+
+
+def upload_one(app, result: dict, stat) -> dict:
+    """上传单个文件的原图、缩略图和衍生图，返回Photo字段"""
+    path = result['path']
+    name = os.path.basename(path)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    with app.app_context():
+        filename = tos_client.generate_filename(name, result['hash'])
+        with open(path, 'rb') as stream:
+            fields = upload_analyzed(result['analysis'], stream, stat.st_size, filename, content_type)
+        fields.update({
+            'title': secure_filename(name).rsplit('.', 1)[0],
+            'filename': filename,
+            'original_filename': name,
+            'file_size': stat.st_size,
+            'mime_type': content_type,
+            'hash_value': result['hash']
+        })
+        return fields
+
+
+def import_batch(app, batch: list, results: list, seen_hashes: set, manifest: Manifest, upload_executor) -> int:
+    """对一批已分析的文件去重、并发上传并一次性写入数据库，返回导入数量"""
+    stats = {path: stat for path, stat in batch}
+    entries = []
+
+    def entry(result, status, **extra):
+        stat = stats[result['path']]
+        return dict(path=result['path'], size=stat.st_size, mtime=stat.st_mtime,
+                    hash=result.get('hash'), status=status, **extra)
+
+    analyzed = []
+    for result in results:
+        if 'error' in result:
+            print(f"{result['path']}: 读取失败 - {result['error']}")
+            entries.append(entry(result, 'failed', error=result['error']))
+        else:
+            analyzed.append(result)
+
+    # 批次内、清单中已导入的以及数据库中已存在的文件只记录为重复
+    batch_hashes = {result['hash'] for result in analyzed}
+    existing = {
+        row.hash_value for row in
+        db.session.query(Photo.hash_value).filter(Photo.hash_value.in_(list(batch_hashes)))
+    } if batch_hashes else set()
+    to_upload = []
+    for result in analyzed:
+        if result['hash'] in seen_hashes or result['hash'] in existing:
+            entries.append(entry(result, 'duplicate'))
+        else:
+            seen_hashes.add(result['hash'])
+            to_upload.append(result)
+
+    futures = [
+        (result, upload_executor.submit(upload_one, app, result, stats[result['path']]))
+        for result in to_upload
+    ]
+    uploaded = []
+    errors = []
+    for result, future in futures:
+        try:
+            uploaded.append((result['path'], future.result()))
+        except SimilarPhotoExists as e:
+            entries.append(entry(result, 'duplicate', similar_to=e.photo_id))
+        except Exception as e:
+            print(f"{result['path']}: 上传失败 - {e}")
+            seen_hashes.discard(result['hash'])
+            entries.append(entry(result, 'failed', error=str(e)))
+
+    saved = {photo.hash_value: photo.id for photo in save_photos(uploaded, errors)}
+    for message in errors:
+        print(message)
+    for path, fields in uploaded:
+        result = {'path': path, 'hash': fields['hash_value']}
+        if result['hash'] in saved:
+            entries.append(entry(result, 'done', photo_id=saved[result['hash']]))
+        else:
+            seen_hashes.discard(result['hash'])
+            entries.append(entry(result, 'failed', error='写入数据库失败'))
+
+    manifest.record(entries)
+    return len(saved)
+
+
+def run_import(app, directory: str, manifest_path: str, processes: int, upload_workers: int, batch_size: int):
+    """多进程解码、多线程上传，按批写入数据库并记录清单"""
+    manifest = Manifest(manifest_path)
+    imported = 0
+    with app.app_context():
+        pending = scan_directory(directory, app.config['ALLOWED_EXTENSIONS'], manifest)
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        seen_hashes = manifest.known_hashes()
+        widths = app.config['RENDITION_WIDTHS']
+        formats = app.config['RENDITION_FORMATS']
+
+        with ProcessPoolExecutor(max_workers=processes) as process_pool, \
+                ThreadPoolExecutor(max_workers=upload_workers) as upload_executor:
+
+            def submit(batch):
+                return [process_pool.submit(analyze_path, path, widths, formats) for path, _ in batch]
+
+            # 上传当前批次时，下一批次已在子进程中解码，同时最多保留两批结果在内存中
+            next_futures = submit(batches[0]) if batches else []
+            for index, batch in enumerate(batches):
+                futures = next_futures
+                next_futures = submit(batches[index + 1]) if index + 1 < len(batches) else []
+                results = [future.result() for future in futures]
+                imported += import_batch(app, batch, results, seen_hashes, manifest, upload_executor)
+                done = min((index + 1) * batch_size, len(pending))
+                print(f'已处理 {done}/{len(pending)} 个文件，累计导入 {imported} 张')
+
+    manifest.close()
+    print(f'导入完成，共导入 {imported} 张图片')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='从本地目录批量导入图片（可中断后继续）')
+    parser.add_argument('directory', help='图片所在目录（递归遍历）')
+    parser.add_argument('--manifest', default='import_manifest.jsonl', help='导入清单文件，用于中断后继续导入')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='解码和生成缩略图的进程数')
+    parser.add_argument('--upload-workers', type=int, default=16, help='并发上传线程数')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批写入数据库的图片数量')
+    args = parser.parse_args()
+
+    run_import(create_app(), args.directory, args.manifest, args.processes, args.upload_workers, args.batch_size)
@@ -0,0 +1,17 @@
+import argparse
+from app import create_app
+from app.search_index import search_index, REBUILD_BATCH
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='重建图片标题、描述和标签名的全文索引')
+    parser.add_argument('--batch-size', type=int, default=REBUILD_BATCH, help='每批写入索引的图片数量')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if not search_index.dialect:
+            print('当前数据库不支持全文索引，搜索使用LIKE查询')
+        else:
+            count = search_index.rebuild(args.batch_size)
+            print(f'全文索引重建完成，共 {count} 张图片')
@@ -0,0 +1,285 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import queue
+import threading
+import time
+from sqlalchemy import collate
+from app import create_app, db
+from app.models import Photo, storage_keys
+from app.photos import delete_photo_rows
+from app.storage import MAX_DELETE_BATCH
+from app.tos_client import tos_client
+
+# 参与核对的前缀：原图和缩略图的key都是 <前缀><Photo.filename>
+PREFIXES = ('photos/', 'thumbnails/')
+# 衍生图的key为 renditions/<文件名去掉扩展名>/<宽>.<格式>，按文件名主干分组核对
+RENDITION_PREFIX = 'renditions/'
+
+
+def prefetch(iterable, depth: int):
+    """在后台线程中提前读取后续元素（最多缓存depth个），列举下一页的同时处理当前页"""
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+            items.put(done)
+        except Exception as e:
+            items.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def photo_rows(batch_size: int):
+    """按文件名分页读取图片记录（二进制排序，与对象存储列举顺序一致）"""
+    column = Photo.filename
+    if db.engine.dialect.name == 'mysql':
+        column = collate(Photo.filename, 'utf8mb4_bin')
+    last = None
+    while True:
+        query = db.session.query(
+            Photo.filename, Photo.id, Photo.status, Photo.thumbnail_url, Photo.renditions, Photo.created_at
+        )
+        if last is not None:
+            query = query.filter(column > last)
+        rows = query.order_by(column).limit(batch_size).all()
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1].filename
+
+
+def merge(objects, rows, object_name, row_name):
+    """按名称有序归并对象和记录，生成 (对象或None, 记录或None)；任一侧顺序不一致时中止，避免误判"""
+    obj, row = next(objects, None), next(rows, None)
+    last_name = last_filename = None
+    while obj is not None or row is not None:
+        name = object_name(obj) if obj is not None else None
+        filename = row_name(row) if row is not None else None
+        if name is not None and last_name is not None and name <= last_name:
+            raise RuntimeError(f'对象列举顺序异常: {name}')
+        if filename is not None and last_filename is not None and filename <= last_filename:
+            raise RuntimeError(f'数据库排序与对象存储不一致: {filename}')
+
+        if row is None or (name is not None and name < filename):
+            yield obj, None
+            last_name, obj = name, next(objects, None)
+        elif name is None or filename < name:
+            yield None, row
+            last_filename, row = filename, next(rows, None)
+        else:
+            yield obj, row
+            last_name, obj = name, next(objects, None)
+            last_filename, row = filename, next(rows, None)
+
+
+def rendition_groups(objects):
+    """把按key顺序列举的衍生图对象按文件名主干分组，生成 (主干, [对象...])"""
+    stem, group = None, []
+    for obj in objects:
+        current = obj.key[len(RENDITION_PREFIX):].rsplit('/', 1)[0]
+        if current != stem and group:
+            yield stem, group
+            group = []
+        stem = current
+        group.append(obj)
+    if group:
+        yield stem, group
+
+
+class Report:
+    """将核对结果逐条写入JSONL报告并计数"""
+
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8') if path else None
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, kind: str, **fields):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            if self.file:
+                self.file.write(json.dumps(dict(type=kind, **fields), ensure_ascii=False) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class BatchDeleter:
+    """将待删除的key攒成批次交给线程池删除，在途批次数有上限，内存占用固定"""
+
+    def __init__(self, storage, workers: int, report: Report):
+        self.storage = storage
+        self.report = report
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile-delete')
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.batch = []
+        self.lock = threading.Lock()
+
+    def add(self, keys):
+        with self.lock:
+            self.batch.extend(keys)
+            if len(self.batch) < MAX_DELETE_BATCH:
+                return
+            batch, self.batch = self.batch, []
+        self._submit(batch)
+
+    def _submit(self, batch: list):
+        self.slots.acquire()
+        self.executor.submit(self._delete, batch)
+
+    def _delete(self, batch: list):
+        try:
+            failed = self.storage.delete(batch)
+        except Exception as e:
+            print(f'批量删除对象失败: {e}')
+            failed = batch
+        finally:
+            self.slots.release()
+        for key in failed:
+            self.report.add('delete_failed', key=key)
+
+    def close(self):
+        with self.lock:
+            batch, self.batch = self.batch, []
+        if batch:
+            self._submit(batch)
+        self.executor.shutdown(wait=True)
+
+
+def reconcile_prefix(app, prefix: str, options, report: Report, deleter: BatchDeleter):
+    """核对一个前缀：没有记录引用的对象为孤儿对象，对象缺失的记录为悬空记录"""
+    now = time.time()
+    cutoff = datetime.utcnow() - timedelta(seconds=options.min_age)
+    dangling_ids = []
+    checked = 0
+
+    def remove_dangling():
+        # 删除悬空记录，并清理这些图片残留的缩略图和衍生图
+        rows = dangling_ids[:]
+        dangling_ids.clear()
+        delete_photo_rows([row.id for row in rows])
+        db.session.commit()
+        for row in rows:
+            deleter.add(storage_keys(row.filename, row.renditions)[1:])
+
+    with app.app_context():
+        objects = prefetch(tos_client.storage.list_objects(prefix, options.page_size), options.page_size * 2)
+        for obj, row in merge(objects, photo_rows(options.page_size),
+                              lambda obj: obj.key[len(prefix):], lambda row: row.filename):
+            checked += 1
+            if checked % 100000 == 0:
+                print(f'{prefix} 已核对 {checked} 项')
+
+            if row is None:
+                # 刚上传、尚未写入数据库的对象不算孤儿
+                if now - obj.last_modified < options.min_age:
+                    continue
+                report.add('orphan', key=obj.key, size=obj.size)
+                if options.delete_orphans:
+                    deleter.add([obj.key])
+            elif obj is None:
+                # 异步入库中的记录尚未上传，只检查已就绪的记录
+                if row.status != 'ready' or (row.created_at and row.created_at > cutoff):
+                    continue
+                if prefix == 'thumbnails/':
+                    if row.thumbnail_url:
+                        report.add('missing_thumbnail', key=prefix + row.filename, photo_id=row.id)
+                    continue
+                report.add('dangling', key=prefix + row.filename, photo_id=row.id)
+                if options.delete_dangling:
+                    dangling_ids.append(row)
+                    if len(dangling_ids) >= options.page_size:
+                        remove_dangling()
+
+        if dangling_ids:
+            remove_dangling()
+    print(f'{prefix} 核对完成，共 {checked} 项')
+
+
+def reconcile_renditions(app, options, report: Report, deleter: BatchDeleter):
+    """核对衍生图：按 <主干>/ 与 Photo.filename 去掉扩展名后归并（与对象列举顺序一致），
+    没有记录的主干下的对象和记录中不存在的尺寸为孤儿对象，记录中有但对象缺失的尺寸为缺失衍生图"""
+    now = time.time()
+    cutoff = datetime.utcnow() - timedelta(seconds=options.min_age)
+    checked = 0
+
+    def orphans(objects):
+        # 刚上传、尚未写入数据库的对象不算孤儿
+        keys = []
+        for obj in objects:
+            if now - obj.last_modified < options.min_age:
+                continue
+            report.add('orphan', key=obj.key, size=obj.size)
+            keys.append(obj.key)
+        if keys and options.delete_orphans:
+            deleter.add(keys)
+
+    with app.app_context():
+        objects = prefetch(tos_client.storage.list_objects(RENDITION_PREFIX, options.page_size), options.page_size * 2)
+        for group, row in merge(rendition_groups(objects), photo_rows(options.page_size),
+                                lambda group: group[0] + '/', lambda row: row.filename.rsplit('.', 1)[0] + '/'):
+            checked += 1
+            if checked % 100000 == 0:
+                print(f'{RENDITION_PREFIX} 已核对 {checked} 项')
+
+            expected = set(storage_keys(row.filename, row.renditions)[2:]) if row is not None else set()
+            if group is not None:
+                orphans([obj for obj in group[1] if obj.key not in expected])
+            # 异步入库中的记录尚未上传，只检查已就绪的记录
+            if row is None or row.status != 'ready' or (row.created_at and row.created_at > cutoff):
+                continue
+            present = {obj.key for obj in group[1]} if group is not None else set()
+            for key in sorted(expected - present):
+                report.add('missing_rendition', key=key, photo_id=row.id)
+    print(f'{RENDITION_PREFIX} 核对完成，共 {checked} 项')
+
+
+def run(app, options):
+    report = Report(options.report)
+    deleter = BatchDeleter(tos_client.storage, options.workers, report)
+    try:
+        # 各前缀独立列举和归并，并发执行
+        with ThreadPoolExecutor(max_workers=len(PREFIXES) + 1) as executor:
+            futures = [
+                executor.submit(reconcile_prefix, app, prefix, options, report, deleter)
+                for prefix in PREFIXES
+            ]
+            futures.append(executor.submit(reconcile_renditions, app, options, report, deleter))
+            for future in futures:
+                future.result()
+    finally:
+        deleter.close()
+        report.close()
+
+    counts = report.counts
+    print(f"孤儿对象 {counts.get('orphan', 0)} 个，悬空记录 {counts.get('dangling', 0)} 条，"
+          f"缺失缩略图 {counts.get('missing_thumbnail', 0)} 个，缺失衍生图 {counts.get('missing_rendition', 0)} 个，"
+          f"删除失败 {counts.get('delete_failed', 0)} 个")
+    if options.report:
+        print(f'详细结果已写入 {options.report}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='核对对象存储与数据库：查找（并可删除）孤儿对象和悬空记录')
+    parser.add_argument('--delete-orphans', action='store_true', help='删除没有图片记录引用的对象')
+    parser.add_argument('--delete-dangling', action='store_true', help='删除原图已不存在的图片记录')
+    parser.add_argument('--min-age', type=int, default=3600, help='只处理早于该秒数的对象和记录，避免误删正在上传的图片')
+    parser.add_argument('--page-size', type=int, default=1000, help='每页列举的对象数量和每批读取的记录数量')
+    parser.add_argument('--workers', type=int, default=8, help='并发删除线程数')
+    parser.add_argument('--report', default='reconcile_report.jsonl', help='逐条记录核对结果的JSONL文件，为空则不写')
+    args = parser.parse_args()
+
+    run(create_app(), args)
@@ -1,5 +1,9 @@
+import os
 from app import create_app
 
+# Web服务进程负责执行异步入库任务（命令行脚本和测试创建应用时不启动）
+os.environ.setdefault('INGEST_WORKER_ENABLED', 'true')
+
 # 创建Flask应用实例
 app = create_app()
 
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+测试共用的应用和数据库夹具
+使用内存数据库和内存存储，不依赖运行中的服务
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ['SECRET_KEY'] = 'test-secret-key'
+# 磁盘缓存和暂存目录放在临时目录，不写入instance/
+_scratch = tempfile.mkdtemp(prefix='photo-gallery-test-')
+os.environ['IMAGE_CACHE_DIR'] = os.path.join(_scratch, 'image_cache')
+os.environ['MEDIA_CACHE_DIR'] = os.path.join(_scratch, 'media_cache')
+os.environ['INGEST_SPOOL_DIR'] = os.path.join(_scratch, 'ingest_spool')
+
+from app import create_app, db
+from app.models import Photo
+
+
+@pytest.fixture(scope='session')
+def app():
+    """整个测试过程共用一个应用（内存数据库在同一连接上保留）"""
+    app = create_app()
+    app.testing = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def reset_db(app):
+    """清空数据库、全文索引、各内存索引和内存存储，返回按序号构造Photo的函数（ID从1开始依次写入）"""
+    from app.colors import color_index
+    from app.similarity import phash_index
+    from app.tag_index import tag_index
+    from app.tos_client import tos_client
+    with app.app_context():
+        storage = tos_client.storage
+        storage.delete([item.key for item in storage.list_objects('')])
+        db.drop_all()
+        db.create_all()
+        db.session.execute(db.text('DELETE FROM photo_search'))
+        db.session.commit()
+        phash_index.load()
+        color_index.load()
+        tag_index.load()
+
+    def make_photo(i: int, **fields) -> Photo:
+        fields.setdefault('title', f'图片{i}')
+        return Photo(filename=f'{i}.jpg', original_filename=f'{i}.jpg', tos_url=f'/storage/photos/{i}.jpg', **fields)
+
+    return make_photo
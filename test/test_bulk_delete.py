@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量删除图片测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_bulk_delete.py
+"""
+
+import pytest
+
+from app import db, routes
+from app.models import Photo, Tag
+from app.tos_client import tos_client
+
+# 图片ID -> 标签
+PHOTO_TAGS = {1: ['猫', '户外'], 2: ['猫'], 3: ['狗'], 4: ['猫', '狗']}
+
+
+@pytest.fixture
+def photos(app, client, reset_db):
+    """写入图片及其存储对象，并通过接口添加标签（标签使用次数随之累加）"""
+    with app.app_context():
+        for i in PHOTO_TAGS:
+            db.session.add(reset_db(i, renditions='{"s":[[160,120]],"f":["webp"]}'))
+            for key in [f'photos/{i}.jpg', f'thumbnails/{i}.jpg', f'renditions/{i}/160.webp']:
+                tos_client.storage.put(key, b'x', 1, 'image/jpeg')
+        db.session.commit()
+    for photo_id, names in PHOTO_TAGS.items():
+        client.post(f'/api/photos/{photo_id}/tags', json=names)
+
+
+def usage_counts(app) -> dict:
+    with app.app_context():
+        return {tag.name: tag.usage_count for tag in Tag.query}
+
+
+def stored_keys(app) -> list:
+    with app.app_context():
+        return [item.key for item in tos_client.storage.list_objects('')]
+
+
+def test_delete_by_ids_updates_usage_counts_and_storage(app, client, photos):
+    assert usage_counts(app) == {'猫': 3, '户外': 1, '狗': 2}
+    result = client.post('/api/photos/bulk-delete', json={'ids': [1, 4, 99]}).get_json()
+    assert result == {'success': True, 'deleted': 2, 'has_more': False, 'storage_errors': []}
+    assert usage_counts(app) == {'猫': 1, '户外': 0, '狗': 1}
+    assert stored_keys(app) == ['photos/2.jpg', 'photos/3.jpg', 'renditions/2/160.webp', 'renditions/3/160.webp',
+                                'thumbnails/2.jpg', 'thumbnails/3.jpg']
+    with app.app_context():
+        assert sorted(photo.id for photo in Photo.query) == [2, 3]
+    # 标签索引和全文索引同步更新
+    assert [p['id'] for p in client.get('/api/photos?tags=猫').get_json()['photos']] == [2]
+    assert client.get('/api/photos?search=图片4').get_json()['photos'] == []
+
+
+def test_delete_by_filter_in_batches(app, client, photos, monkeypatch):
+    monkeypatch.setattr(routes, 'MAX_BULK_DELETE', 2)
+    cat = client.get('/api/tags').get_json()
+    cat_id = next(tag['id'] for tag in cat if tag['name'] == '猫')
+
+    first = client.post('/api/photos/bulk-delete', json={'filter': {'tag_id': cat_id}}).get_json()
+    assert first['deleted'] == 2 and first['has_more']
+    second = client.post('/api/photos/bulk-delete', json={'filter': {'tag_id': cat_id}}).get_json()
+    assert second['deleted'] == 1 and not second['has_more']
+    assert usage_counts(app) == {'猫': 0, '户外': 0, '狗': 1}
+
+    result = client.post('/api/photos/bulk-delete', json={'filter': {'search': '图片3'}}).get_json()
+    assert result['deleted'] == 1
+    with app.app_context():
+        assert Photo.query.count() == 0
+
+
+@pytest.mark.parametrize('body', [{}, {'ids': 'all'}, {'ids': [1, 'x']}, {'filter': {}}, {'ids': [1, 2, 3]}])
+def test_rejects_invalid_requests(client, photos, monkeypatch, body):
+    monkeypatch.setattr(routes, 'MAX_BULK_DELETE', 2)
+    assert client.post('/api/photos/bulk-delete', json=body).status_code == 400
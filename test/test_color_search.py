@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+主色提取和按颜色搜索测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_color_search.py
+"""
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from app.colors import HISTOGRAM_BINS, color_histogram, dominant_colors, parse_color
+
+
+def jpeg(img: Image.Image) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def split_image(left: str, right: str, left_width: int) -> Image.Image:
+    img = Image.new('RGB', (100, 100), right)
+    img.paste(Image.new('RGB', (left_width, 100), left), (0, 0))
+    return img
+
+
+def test_parse_color():
+    assert parse_color('#ff0000') == (255, 0, 0)
+    assert parse_color(' 00FF7f ') == (0, 255, 127)
+    assert parse_color('#fff') is None and parse_color('zzzzzz') is None
+
+
+def test_histogram_and_dominant_colors():
+    img = split_image('#ff0000', '#0000ff', 75)
+    histogram = np.frombuffer(color_histogram(img), dtype=np.uint8)
+    assert len(histogram) == HISTOGRAM_BINS
+    # 纯红和纯蓝分别落在 (3,0,0) 和 (0,0,3) 区间
+    assert (histogram[48], histogram[3]) == (191, 64) and histogram.sum() == 255
+    # 按占比降序
+    assert dominant_colors(img) == ['#ff0000', '#0000ff']
+
+
+def test_search_by_color(app, client, reset_db):
+    files = {
+        'red.jpg': jpeg(Image.new('RGB', (100, 100), '#e01010')),
+        'mostly-red.jpg': jpeg(split_image('#e01010', '#1010e0', 60)),
+        'blue.jpg': jpeg(Image.new('RGB', (100, 100), '#1010e0')),
+    }
+    client.post('/api/upload', data={'files': [(BytesIO(data), name) for name, data in files.items()]},
+                content_type='multipart/form-data')
+
+    data = client.get('/api/photos?color=%23ff0000').get_json()
+    assert [photo['original_filename'] for photo in data['photos']] == ['red.jpg', 'mostly-red.jpg']
+    scores = [photo['color_score'] for photo in data['photos']]
+    assert scores[0] > scores[1] > 0
+    red, green, blue = parse_color(data['photos'][0]['colors'][0])
+    assert red > 200 and green < 40 and blue < 40
+    assert data['pagination']['total'] == 2
+
+    data = client.get('/api/photos?color=1010e0&search=blue').get_json()
+    assert [photo['original_filename'] for photo in data['photos']] == ['blue.jpg']
+    assert client.get('/api/photos?color=red').status_code == 400
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片解码准入控制测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_decode_scheduler.py
+"""
+
+import threading
+from io import BytesIO
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from app.ingest import create_ingest_job, ingest_worker, BUSY_ERROR
+from app.models import IngestJobItem, Photo
+from app.tos_client import DecodeScheduler, DecodeRejected, decode_scheduler
+
+
+def png(name: str, color='red'):
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), color).save(buffer, 'PNG')
+    buffer.seek(0)
+    return buffer, name
+
+
+def test_admits_within_budget_and_returns_it():
+    scheduler = DecodeScheduler(budget_bytes=100, timeout=1, max_queue=4)
+    with scheduler.admit(60):
+        assert scheduler.in_use_bytes == 60
+        with scheduler.admit(40):
+            assert scheduler.in_use_bytes == 100
+    assert scheduler.in_use_bytes == 0
+    assert scheduler.metrics()['admitted'] == 2
+
+
+def test_oversized_image_takes_the_whole_budget():
+    """超过整个预算的图片按预算计，独占时仍可进入"""
+    scheduler = DecodeScheduler(budget_bytes=100, timeout=1, max_queue=4)
+    with scheduler.admit(1000):
+        assert scheduler.in_use_bytes == 100
+
+
+def test_waits_for_budget_then_times_out():
+    scheduler = DecodeScheduler(budget_bytes=100, timeout=0.05, max_queue=4)
+    with scheduler.admit(80):
+        with pytest.raises(DecodeRejected):
+            with scheduler.admit(40):
+                pass
+    metrics = scheduler.metrics()
+    assert metrics['timeouts'] == 1 and metrics['queue_depth'] == 0 and metrics['in_use_bytes'] == 0
+
+
+def test_waiter_is_admitted_when_budget_is_returned():
+    scheduler = DecodeScheduler(budget_bytes=100, timeout=5, max_queue=4)
+    admitted = threading.Event()
+
+    def waiter():
+        with scheduler.admit(40):
+            admitted.set()
+
+    with scheduler.admit(80):
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        assert not admitted.wait(0.05)
+    thread.join(5)
+    assert admitted.is_set()
+
+
+def test_rejects_when_queue_is_full():
+    scheduler = DecodeScheduler(budget_bytes=100, timeout=1, max_queue=0)
+    with pytest.raises(DecodeRejected):
+        with scheduler.admit(10):
+            pass
+    assert scheduler.metrics()['rejected'] == 1
+
+
+@pytest.fixture
+def busy(monkeypatch):
+    """解码队列长度为0，所有解码请求立即被拒绝"""
+    monkeypatch.setattr(decode_scheduler, 'max_queue', 0)
+
+
+def test_upload_all_busy_returns_503(client, reset_db, busy):
+    response = client.post('/api/upload', data={'files': [png('a.png')]}, content_type='multipart/form-data')
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    assert response.get_json()['errors'] == [f'a.png: {BUSY_ERROR}']
+
+
+def test_upload_partly_busy_reports_each_file(client, reset_db, busy):
+    """其他文件因别的原因失败时按普通结果返回，繁忙的文件有单独的错误信息"""
+    response = client.post('/api/upload', data={'files': [png('a.png'), png('a-copy.png')]},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.get_json()['errors'] == ['a-copy.png: 文件已存在', f'a.png: {BUSY_ERROR}']
+
+
+def test_async_item_is_retried_instead_of_failed(app, reset_db, busy, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'INGEST_SPOOL_DIR', str(tmp_path))
+    retried = []
+    monkeypatch.setattr(ingest_worker, 'retry_later', retried.append)
+
+    stream, name = png('a.png')
+    with app.app_context():
+        job, errors = create_ingest_job(app, [FileStorage(stream=stream, filename=name, content_type='image/png')],
+                                        100 * 1024 * 1024)
+        item_id = job.items[0].id
+    ingest_worker._run_item(item_id)
+
+    assert retried == [item_id]
+    with app.app_context():
+        item = db.session.get(IngestJobItem, item_id)
+        assert item.status == 'pending' and item.error_message == BUSY_ERROR
+        assert db.session.get(Photo, item.photo_id).status == 'pending'
+        assert item.job.status != 'completed'
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+浏览器直传测试（预签名 -> PUT -> finalize）
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_direct_upload.py
+"""
+
+import hashlib
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from app import DEFAULT_SECRET_KEY, db
+from app.models import Photo
+
+
+def jpeg(seed: int) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((320, 240), 40 + seed).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def describe(name: str, data: bytes) -> dict:
+    return {'name': name, 'type': 'image/jpeg', 'hash': hashlib.md5(data).hexdigest(), 'size': len(data)}
+
+
+def presign(client, *files) -> dict:
+    response = client.post('/api/upload/presign', json={'files': list(files)})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def put(client, upload: dict, data: bytes):
+    return client.put(upload['url'], data=data, headers=upload['headers'])
+
+
+def test_presign_put_finalize(app, client, reset_db):
+    data = jpeg(0)
+    upload, = presign(client, describe('a.jpg', data))['uploads']
+    assert upload['method'] == 'PUT' and upload['url'].startswith('/storage/photos/')
+    assert put(client, upload, data).status_code == 200
+    # 对象不能被覆盖
+    assert put(client, upload, data).status_code == 409
+
+    result = client.post('/api/upload/finalize', json={'files': [describe('a.jpg', data)]}).get_json()
+    assert result['count'] == 1 and result['errors'] == []
+    with app.app_context():
+        photo = db.session.query(Photo).one()
+        assert photo.hash_value == hashlib.md5(data).hexdigest() and photo.thumbnail_url and photo.width == 320
+
+    # 已入库的文件不再生成上传地址
+    again = presign(client, describe('a.jpg', data))
+    assert again['uploads'] == [] and again['existing'] == ['a.jpg']
+
+
+def test_put_rejects_unsigned_and_mismatched_uploads(client, reset_db):
+    data = jpeg(0)
+    upload, = presign(client, describe('a.jpg', data))['uploads']
+    key_url = upload['url'].split('?', 1)[0]
+    assert client.put(key_url, data=data, headers=upload['headers']).status_code == 403
+    assert client.put(upload['url'].replace('signature=', 'signature=0'), data=data,
+                      headers=upload['headers']).status_code == 403
+    # 签名正确但内容不同（长度相同）
+    tampered = bytes([data[0] ^ 1]) + data[1:]
+    assert put(client, upload, tampered).status_code == 400
+    # 签名只对内容寻址的原图key有效，不能写入其他路径
+    forged = upload['url'].replace('/storage/photos/', '/storage/thumbnails/')
+    assert client.put(forged, data=data, headers=upload['headers']).status_code == 403
+
+
+def test_presign_requires_secret_key(app, client, reset_db, monkeypatch):
+    """SECRET_KEY未配置或仍为公开的默认值时不生成直传地址"""
+    monkeypatch.setitem(app.config, 'SECRET_KEY', DEFAULT_SECRET_KEY)
+    result = presign(client, describe('a.jpg', jpeg(0)))
+    assert result['uploads'] == [] and '生成上传地址失败' in result['errors'][0]
+
+
+def test_finalize_reports_missing_and_invalid_files(client, reset_db):
+    data = jpeg(0)
+    result = client.post('/api/upload/finalize', json={'files': [
+        describe('missing.jpg', data),
+        dict(describe('bad.jpg', data), hash='xyz'),
+        dict(describe('a.txt', data), name='a.txt')
+    ]}).get_json()
+    assert result['count'] == 0
+    assert sorted(result['errors']) == ['a.txt: 不支持的文件类型', 'bad.jpg: 文件哈希无效', 'missing.jpg: 文件尚未上传']
+
+
+@pytest.mark.parametrize('size, error', [(0, '文件大小无效'), (10 ** 12, '文件大小超过限制')])
+def test_presign_checks_declared_size(client, reset_db, size, error):
+    result = presign(client, dict(describe('a.jpg', b'x'), size=size))
+    assert result['errors'] == [f'a.jpg: {error}']
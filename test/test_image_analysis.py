@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片分析测试（一次解码得到尺寸、缩略图和各项特征）
+不依赖运行中的服务：python -m pytest test/test_image_analysis.py
+"""
+
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+from app.tos_client import EXIF_ORIENTATION, tos_client
+
+
+def encode(img: Image.Image, fmt: str = 'JPEG', **params) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def test_reads_size_and_builds_thumbnail_in_one_pass():
+    analysis = tos_client.analyze_image(BytesIO(encode(Image.new('RGB', (1200, 900), 'navy'))))
+    assert (analysis.width, analysis.height, analysis.format, analysis.mode) == (1200, 900, 'JPEG', 'RGB')
+    thumbnail = Image.open(BytesIO(analysis.thumbnail))
+    assert thumbnail.format == 'JPEG' and thumbnail.size == (400, 300)
+    assert analysis.phash and analysis.colors and analysis.color_histogram
+
+
+def test_exif_orientation_swaps_dimensions():
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6  # 顺时针旋转90度
+    data = encode(Image.new('RGB', (800, 400), 'red'), exif=exif.tobytes())
+    analysis = tos_client.analyze_image(data)
+    assert (analysis.width, analysis.height) == (400, 800)
+    assert Image.open(BytesIO(analysis.thumbnail)).size == (200, 400)
+    assert tos_client.get_image_info(data)['width'] == 400
+
+
+def test_transparent_images_are_flattened():
+    analysis = tos_client.analyze_image(encode(Image.new('RGBA', (100, 100), (0, 0, 0, 0)), 'PNG'))
+    thumbnail = Image.open(BytesIO(analysis.thumbnail))
+    assert analysis.mode == 'RGBA' and thumbnail.mode == 'RGB'
+    assert thumbnail.getpixel((50, 50)) == (255, 255, 255)
+
+
+def test_unreadable_content_is_reported_as_unknown():
+    analysis = tos_client.analyze_image(b'not an image')
+    assert (analysis.width, analysis.height, analysis.format) == (0, 0, 'Unknown')
+    assert analysis.thumbnail is None
+
+
+def test_placeholder_is_tiny_inline_webp():
+    analysis = tos_client.analyze_image(encode(Image.new('RGB', (1200, 600), 'orange')))
+    prefix = 'data:image/webp;base64,'
+    assert analysis.placeholder.startswith(prefix) and len(analysis.placeholder) < 512
+    placeholder = Image.open(BytesIO(base64.b64decode(analysis.placeholder[len(prefix):])))
+    assert placeholder.format == 'WEBP' and placeholder.size == (16, 8)
+
+
+def test_rendition_ladder_never_upscales():
+    analysis = tos_client.analyze_image(encode(Image.new('RGB', (1000, 500), 'teal')),
+                                        rendition_widths=(160, 400, 800, 1600), rendition_formats=('webp', 'jpeg'))
+    assert [(r.width, r.height, r.format) for r in analysis.renditions] == [
+        (160, 80, 'webp'), (160, 80, 'jpeg'), (400, 200, 'webp'), (400, 200, 'jpeg'), (800, 400, 'webp'), (800, 400, 'jpeg')
+    ]
+    assert {Image.open(BytesIO(r.content)).format for r in analysis.renditions} == {'WEBP', 'JPEG'}
+
+    # 原图比所有档位都窄时按原宽度输出一档
+    small = tos_client.analyze_image(encode(Image.new('RGB', (100, 50), 'teal')), rendition_widths=(160, 400),
+                                     rendition_formats=('webp',))
+    assert [(r.width, r.format) for r in small.renditions] == [(100, 'webp')]
+
+
+def test_uploaded_photo_lists_srcset(app, client, reset_db):
+    data = encode(Image.effect_noise((900, 600), 30).convert('RGB'))
+    client.post('/api/upload', data={'files': [(BytesIO(data), 'a.jpg')]}, content_type='multipart/form-data')
+    photo = client.get('/api/photos').get_json()['photos'][0]
+    stem = photo['filename'].rsplit('.', 1)[0]
+    assert photo['placeholder'].startswith('data:image/webp;base64,')
+    assert [(r['width'], r['format']) for r in photo['renditions']] == [
+        (160, 'webp'), (160, 'jpeg'), (400, 'webp'), (400, 'jpeg'), (800, 'webp'), (800, 'jpeg')
+    ]
+    assert photo['srcset']['webp'] == ', '.join(
+        f'/storage/renditions/{stem}/{width}.webp {width}w' for width in (160, 400, 800)
+    )
+    with app.app_context():
+        assert tos_client.storage.exists(f'renditions/{stem}/800.jpg')
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按需缩放接口和磁盘LRU缓存测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_image_variants.py
+"""
+
+import os
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from app import db
+from app.disk_cache import DiskLRUCache, SingleFlight
+from app.models import Photo
+from app.tos_client import tos_client
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    assert cache.get('a') == b'1234'  # a变为最近访问
+    cache.put('c', b'90ab')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234' and cache.get('c') == b'90ab'
+    assert cache.stats() == {'entries': 2, 'bytes': 8, 'max_bytes': 10}
+
+
+def test_cache_skips_entries_larger_than_limit(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=10)
+    assert cache.put_chunks('big', [b'123456', b'789012']) is None
+    assert cache.get('big') is None and cache.stats()['bytes'] == 0
+    assert not [name for _, _, names in os.walk(tmp_path) for name in names]
+
+
+def test_cache_restores_access_order_on_restart(tmp_path):
+    """重启后按文件修改时间恢复访问顺序，并清理残留的临时文件"""
+    cache = DiskLRUCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    old = time.time() - 60
+    os.utime(cache._path('b'), (old, old))
+    (tmp_path / '.tmpleftover').write_bytes(b'x')
+
+    reloaded = DiskLRUCache(str(tmp_path), max_bytes=10)
+    assert not (tmp_path / '.tmpleftover').exists()
+    reloaded.put('c', b'90ab')
+    assert reloaded.get('b') is None and reloaded.get('a') == b'1234'
+
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow))) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1] and results == ['result'] * 4
+    assert flight.calls == {}
+
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+    with pytest.raises(KeyError):
+        flight.do('key', lambda: {}['missing'])
+    assert flight.do('key', lambda: 'retried') == 'retried'
+
+
+@pytest.fixture
+def photo(app, client, reset_db, tmp_path, monkeypatch):
+    """上传一张800x600的图片，并为测试换用空的缩放缓存"""
+    monkeypatch.setitem(app.extensions, 'image_cache', DiskLRUCache(str(tmp_path / 'cache'), 1024 * 1024))
+    buffer = BytesIO()
+    Image.effect_noise((800, 600), 40).convert('RGB').save(buffer, 'JPEG')
+    buffer.seek(0)
+    data = client.post('/api/upload', data={'files': [(buffer, 'noise.jpg')]}, content_type='multipart/form-data').get_json()
+    assert data['count'] == 1
+    with app.app_context():
+        return db.session.query(Photo).one()
+
+
+def test_variant_is_rendered_and_cached(app, client, photo):
+    response = client.get(f'/img/{photo.id}/200x200.jpg')
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    assert Image.open(BytesIO(response.data)).size == (200, 150)
+    assert 'immutable' in response.headers['Cache-Control']
+
+    # 命中缓存时不再读取原图
+    with app.app_context():
+        tos_client.storage.delete([f'photos/{photo.filename}'])
+    cached = client.get(f'/img/{photo.id}/200x200.jpg')
+    assert cached.status_code == 200 and cached.data == response.data
+    assert client.get(f'/img/{photo.id}/200x200.jpg', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_variant_formats_and_limits(client, photo):
+    webp = client.get(f'/img/{photo.id}/120x120.webp')
+    assert webp.mimetype == 'image/webp' and Image.open(BytesIO(webp.data)).size == (120, 90)
+    assert client.get(f'/img/{photo.id}/0x100.jpg').status_code == 400
+    assert client.get(f'/img/{photo.id}/100x100.gif').status_code == 400
+    assert client.get(f'/img/{photo.id}/100000x100.jpg').status_code == 400
+    assert client.get(f'/img/{photo.id + 1}/100x100.jpg').status_code == 404
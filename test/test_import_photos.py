@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地目录批量导入测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_import_photos.py
+"""
+
+import json
+from io import BytesIO
+
+from PIL import Image
+
+from app.models import Photo
+from app.tos_client import tos_client
+from import_photos import run_import
+
+
+def jpeg(seed: int) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((160, 120), 20 + seed).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def read_manifest(path) -> dict:
+    entries = {}
+    for line in path.read_text(encoding='utf-8').splitlines():
+        entry = json.loads(line)
+        entries[entry['path'].rsplit('/', 1)[1]] = entry
+    return entries
+
+
+def test_import_and_resume(app, reset_db, tmp_path):
+    photos_dir = tmp_path / 'photos'
+    (photos_dir / 'nested').mkdir(parents=True)
+    first = jpeg(1)
+    (photos_dir / 'a.jpg').write_bytes(first)
+    (photos_dir / 'nested' / 'b.jpg').write_bytes(jpeg(2))
+    (photos_dir / 'a-copy.jpg').write_bytes(first)
+    (photos_dir / 'notes.txt').write_text('skip me')
+    manifest = tmp_path / 'manifest.jsonl'
+
+    run_import(app, str(photos_dir), str(manifest), processes=1, upload_workers=2, batch_size=2)
+    entries = read_manifest(manifest)
+    # 按路径排序处理，同一内容只导入第一个
+    assert {name: entry['status'] for name, entry in entries.items()} == {
+        'a-copy.jpg': 'done', 'a.jpg': 'duplicate', 'b.jpg': 'done'
+    }
+    with app.app_context():
+        photos = Photo.query.all()
+        assert len(photos) == 2
+        for photo in photos:
+            assert photo.status == 'ready' and (photo.width, photo.height) == (160, 120)
+            assert tos_client.storage.exists(f'photos/{photo.filename}')
+            assert tos_client.storage.exists(f'thumbnails/{photo.filename}')
+
+    # 再次运行时跳过已完成的文件，只处理新增的文件
+    (photos_dir / 'c.jpg').write_bytes(jpeg(3))
+    lines = len(manifest.read_text(encoding='utf-8').splitlines())
+    run_import(app, str(photos_dir), str(manifest), processes=1, upload_workers=2, batch_size=2)
+    appended = manifest.read_text(encoding='utf-8').splitlines()[lines:]
+    assert [json.loads(line)['path'].rsplit('/', 1)[1] for line in appended] == ['c.jpg']
+    assert json.loads(appended[0])['status'] == 'done'
+    with app.app_context():
+        assert Photo.query.count() == 3
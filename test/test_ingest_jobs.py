@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步入库任务测试
+使用内存数据库和内存存储，工作池在当前线程内执行：python -m pytest test/test_ingest_jobs.py
+"""
+
+import os
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import db
+from app.ingest import ingest_worker
+from app.models import IngestJobItem, Photo
+
+
+def jpeg(img: Image.Image, name: str, quality: int = 90):
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=quality)
+    buffer.seek(0)
+    return buffer, name
+
+
+def noise(seed: int) -> Image.Image:
+    """由种子决定的随机色块图，重新编码后感知哈希保持稳定"""
+    blocks = np.random.default_rng(seed).integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize((640, 480), Image.Resampling.BILINEAR)
+
+
+@pytest.fixture
+def inline_worker(monkeypatch):
+    """提交的文件立即在当前线程处理"""
+    monkeypatch.setattr(ingest_worker, 'submit', ingest_worker._run_item)
+
+
+def upload_async(client, *files):
+    return client.post('/api/upload?async=1', data={'files': list(files)}, content_type='multipart/form-data')
+
+
+def test_async_upload_completes(app, client, reset_db, inline_worker):
+    response = upload_async(client, jpeg(noise(0), 'a.jpg'), jpeg(noise(1), 'b.jpg'))
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data['count'] == 2
+
+    job = client.get(data['status_url']).get_json()
+    assert job['status'] == 'completed' and job['finished_at']
+    assert job['progress'] == {'pending': 0, 'processing': 0, 'completed': 2, 'failed': 0}
+    with app.app_context():
+        photos = db.session.query(Photo).order_by(Photo.id).all()
+        assert [(p.original_filename, p.status) for p in photos] == [('a.jpg', 'ready'), ('b.jpg', 'ready')]
+        assert all(p.thumbnail_url and p.phash and p.width == 640 for p in photos)
+        assert not any(os.path.exists(item.spool_path) for item in IngestJobItem.query)
+    assert client.get('/api/photos').get_json()['pagination']['total'] == 2
+
+
+def test_async_failure_releases_the_pending_photo(app, client, reset_db, inline_worker, monkeypatch):
+    """处理失败的文件标记为failed，pending记录被删除，同一文件可以重新上传"""
+    monkeypatch.setitem(app.config, 'PHASH_DUPLICATE_DISTANCE', 4)
+    img = noise(0)
+    client.post('/api/upload', data={'files': [jpeg(img, 'a.jpg')]}, content_type='multipart/form-data')
+
+    data = upload_async(client, jpeg(img, 'b.jpg', 60), jpeg(noise(5), 'c.jpg')).get_json()
+    job = client.get(data['status_url']).get_json()
+    assert job['status'] == 'completed'
+    items = {item['original_filename']: item for item in job['items']}
+    assert items['b.jpg']['status'] == 'failed' and '相似图片已存在' in items['b.jpg']['error_message']
+    assert items['b.jpg']['photo_id'] is None
+    assert items['c.jpg']['status'] == 'completed'
+    with app.app_context():
+        assert sorted(p.original_filename for p in Photo.query) == ['a.jpg', 'c.jpg']
+
+    monkeypatch.setitem(app.config, 'PHASH_DUPLICATE_DISTANCE', -1)
+    retry = upload_async(client, jpeg(img, 'b.jpg', 60)).get_json()
+    assert client.get(retry['status_url']).get_json()['progress']['completed'] == 1
+
+
+def test_pending_photos_are_hidden_until_ready(app, client, reset_db, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(ingest_worker, 'submit', submitted.append)
+    img = noise(0)
+    data = upload_async(client, jpeg(img, 'a.jpg')).get_json()
+    assert client.get(data['status_url']).get_json()['status'] == 'pending'
+    assert client.get('/api/photos').get_json()['photos'] == []
+    # 同一文件处理完成前再次上传被视为重复
+    assert upload_async(client, jpeg(img, 'a.jpg')).get_json()['errors'] == ['a.jpg: 文件已存在']
+
+    ingest_worker._run_item(submitted[0])
+    assert client.get(data['status_url']).get_json()['status'] == 'completed'
+    assert len(client.get('/api/photos').get_json()['photos']) == 1
+
+
+def test_resume_requeues_stale_items(app, client, reset_db, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(ingest_worker, 'submit', submitted.append)
+    upload_async(client, jpeg(noise(0), 'a.jpg'), jpeg(noise(1), 'b.jpg'))
+    with app.app_context():
+        first, second = IngestJobItem.query.order_by(IngestJobItem.id).all()
+        first.status = 'processing'
+        first.updated_at = datetime.utcnow() - timedelta(seconds=app.config['INGEST_STALE_SECONDS'] + 1)
+        second.status = 'processing'
+        db.session.commit()
+        first_id = first.id
+
+    submitted.clear()
+    ingest_worker.resume()
+    assert submitted == [first_id]
+    assert client.get('/api/upload/jobs/missing').status_code == 404
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+读穿式媒体代理测试（Range、条件请求和WebP协商）
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_media_proxy.py
+"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from app import db
+from app.disk_cache import DiskLRUCache
+from app.models import Photo
+from app.tos_client import tos_client
+
+WEBP = {'Accept': 'image/webp,image/*'}
+
+
+@pytest.fixture
+def photo(app, client, reset_db, tmp_path, monkeypatch):
+    """上传一张800x600的图片（生成160和400宽的衍生图），并为测试换用空的媒体缓存"""
+    monkeypatch.setitem(app.extensions, 'media_cache', DiskLRUCache(str(tmp_path / 'media'), 1024 * 1024))
+    buffer = BytesIO()
+    Image.effect_noise((800, 600), 40).convert('RGB').save(buffer, 'JPEG')
+    buffer.seek(0)
+    data = client.post('/api/upload', data={'files': [(buffer, 'noise.jpg')]}, content_type='multipart/form-data').get_json()
+    assert data['count'] == 1
+    with app.app_context():
+        return db.session.query(Photo).one()
+
+
+def stored(app, key: str) -> bytes:
+    with app.app_context():
+        return tos_client.storage.get(key)
+
+
+def test_original_is_served_with_range_and_etag(app, client, photo):
+    key = f'photos/{photo.filename}'
+    response = client.get(f'/media/{key}', headers=WEBP)
+    assert response.status_code == 200 and response.data == stored(app, key)
+    assert response.mimetype == 'image/jpeg' and 'Accept' not in response.vary
+
+    partial = client.get(f'/media/{key}', headers={'Range': 'bytes=10-19'})
+    assert partial.status_code == 206 and partial.data == stored(app, key)[10:20]
+    assert client.get(f'/media/{key}', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    # 已进入缓存，存储中的对象删除后仍可返回
+    with app.app_context():
+        tos_client.storage.delete([key])
+    assert client.get(f'/media/{key}').data == response.data
+
+
+def test_renditions_negotiate_webp(client, photo):
+    stem = photo.filename.rsplit('.', 1)[0]
+    webp = client.get(f'/media/renditions/{stem}/400.jpg', headers=WEBP)
+    assert webp.mimetype == 'image/webp' and 'Accept' in webp.vary
+    jpeg = client.get(f'/media/renditions/{stem}/400.jpg')
+    assert jpeg.mimetype == 'image/jpeg' and 'Accept' in jpeg.vary
+    assert webp.headers['ETag'] != jpeg.headers['ETag']
+    assert Image.open(BytesIO(webp.data)).size == Image.open(BytesIO(jpeg.data)).size == (400, 300)
+
+
+def test_missing_webp_rendition_falls_back_to_requested_format(app, client, photo):
+    stem = photo.filename.rsplit('.', 1)[0]
+    with app.app_context():
+        tos_client.storage.delete([f'renditions/{stem}/160.webp'])
+    response = client.get(f'/media/renditions/{stem}/160.jpg', headers=WEBP)
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+
+
+def test_thumbnail_is_transcoded_to_webp(client, photo):
+    response = client.get(f'/media/thumbnails/{photo.filename}', headers=WEBP)
+    assert response.mimetype == 'image/webp'
+    assert Image.open(BytesIO(response.data)).format == 'WEBP'
+    assert client.get(f'/media/thumbnails/{photo.filename}').mimetype == 'image/jpeg'
+
+
+def test_rejects_other_keys(client, photo):
+    assert client.get('/media/photos/missing.jpg').status_code == 404
+    assert client.get('/media/secrets/key.txt').status_code == 404
+    assert client.get(f'/media/photos/../thumbnails/{photo.filename}').status_code == 404
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TOS分片上传测试
+用模拟的TOS客户端代替网络请求：python -m pytest test/test_multipart_upload.py
+"""
+
+import threading
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage as storage_module
+from app.storage import MIN_PART_SIZE, TOSStorage
+
+CONTENT = bytes(range(256)) * (MIN_PART_SIZE * 2 // 256) + b'tail'
+
+
+class FakeTOSClient:
+    """记录分片上传调用；failures为 {分片号: 失败次数}"""
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.puts = []
+        self.lock = threading.Lock()
+
+    def put_object(self, bucket, key, content, content_length, content_type):
+        self.puts.append(key)
+
+    def create_multipart_upload(self, bucket, key, content_type):
+        return SimpleNamespace(upload_id='upload-1')
+
+    def upload_part(self, bucket, key, upload_id, part_number, content):
+        with self.lock:
+            if self.failures.get(part_number, 0) > 0:
+                self.failures[part_number] -= 1
+                raise ConnectionError(f'分片{part_number}网络错误')
+            self.parts[part_number] = bytes(content)
+        return SimpleNamespace(part_number=part_number, etag=f'etag-{part_number}')
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        self.completed = [part.part_number for part in parts]
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self.aborted = True
+
+
+@pytest.fixture
+def make_storage(app, monkeypatch):
+    monkeypatch.setattr(storage_module.time, 'sleep', lambda seconds: None)
+
+    def make(client, retries=2):
+        config = dict(app.config, TOS_MULTIPART_THRESHOLD=MIN_PART_SIZE, TOS_MULTIPART_PART_SIZE=MIN_PART_SIZE,
+                      TOS_MULTIPART_CONCURRENCY=3, TOS_MULTIPART_RETRIES=retries,
+                      TOS_BUCKET_NAME='bucket', TOS_ENDPOINT='tos.example.com')
+        storage = TOSStorage(config)
+        storage.client = client
+        return storage
+
+    return make
+
+
+@pytest.mark.parametrize('content', [CONTENT, BytesIO(CONTENT)], ids=['bytes', 'file'])
+def test_large_object_is_uploaded_in_parts(make_storage, content):
+    client = FakeTOSClient()
+    make_storage(client).put('photos/big.jpg', content, len(CONTENT), 'image/jpeg')
+    assert client.completed == [1, 2, 3]
+    assert b''.join(client.parts[number] for number in client.completed) == CONTENT
+    assert not client.aborted and client.puts == []
+
+
+def test_small_object_uses_single_put(make_storage):
+    client = FakeTOSClient()
+    make_storage(client).put('photos/small.jpg', b'abc', 3, 'image/jpeg')
+    assert client.puts == ['photos/small.jpg'] and client.completed is None
+
+
+def test_failed_part_is_retried(make_storage):
+    client = FakeTOSClient(failures={2: 2})
+    storage = make_storage(client, retries=2)
+    storage.put('photos/big.jpg', CONTENT, len(CONTENT), 'image/jpeg')
+    assert client.completed == [1, 2, 3] and not client.aborted
+    # 创建、3个分片（分片2重试2次）、完成，共7次请求
+    assert storage.stats()['requests'] == 7 and storage.stats()['in_flight_requests'] == 0
+
+
+def test_upload_is_aborted_when_retries_run_out(make_storage):
+    client = FakeTOSClient(failures={3: 5})
+    with pytest.raises(ConnectionError):
+        make_storage(client, retries=1).put('photos/big.jpg', CONTENT, len(CONTENT), 'image/jpeg')
+    assert client.aborted and client.completed is None
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+列表接口SQL数量预算测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_query_budget.py
+"""
+
+from urllib.parse import quote
+
+from app import db
+from app.models import Tag
+from app.query_budget import count_queries
+
+
+def setup_photos(app, make_photo, count: int):
+    """写入count张图片，每张图片带0-3个标签"""
+    with app.app_context():
+        tags = [Tag(name=f'标签{i}', usage_count=0) for i in range(3)]
+        for i in range(count):
+            photo = make_photo(i)
+            photo.tags = tags[:i % 4]
+            db.session.add(photo)
+        db.session.commit()
+
+
+def query_count(client, url: str) -> int:
+    """请求接口并返回执行的SQL数量，超出预算时视图会抛出QueryBudgetExceeded"""
+    with count_queries() as counter:
+        response = client.get(url)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert int(response.headers['X-Query-Count']) == counter.count
+    return counter.count
+
+
+def test_photo_list_query_count_is_constant(app, client, reset_db):
+    """图片列表的SQL数量与每页数量无关（标签批量加载）"""
+    setup_photos(app, reset_db, 60)
+    small = query_count(client, '/api/photos?per_page=5')
+    large = query_count(client, '/api/photos?per_page=50')
+    assert small == large <= app.view_functions['api.get_photos'].query_budget
+    assert query_count(client, '/api/photos?tag_id=1&per_page=50') == large
+    assert query_count(client, '/api/photos?search=图片1&per_page=50') == large
+    assert query_count(client, '/api/photos?search=图片1&order_by=relevance&per_page=50') == large
+
+
+def test_every_photo_list_strategy_within_budget(app, client, reset_db):
+    """图片列表的每种分页方式（标签位图、标签SQL、相关度、颜色、游标、页码）都不超出预算"""
+    setup_photos(app, reset_db, 30)
+    budget = app.view_functions['api.get_photos'].query_budget
+    for params in ['tags=' + quote('#1 AND NOT #3'), 'tags=' + quote('#1 OR #2') + '&cursor=',
+                   'tags=' + quote('#2') + '&order_by=views', 'tags=' + quote('#1') + '&search=图片1',
+                   'search=图片1&order_by=relevance', 'color=' + quote('#ff0000') + '&search=图片',
+                   'cursor=&with_total=1&order_by=views', 'page=2&order_by=views&order_dir=asc']:
+        assert query_count(client, f'/api/photos?per_page=10&{params}') <= budget, params
+
+
+def test_list_endpoints_within_budget(app, client, reset_db):
+    """其他列表接口不超出预算"""
+    setup_photos(app, reset_db, 20)
+    for url, endpoint in [('/api/tags', 'api.get_tags'), ('/api/favorites', 'api.get_favorites'),
+                          ('/api/photos/1', 'api.get_photo'), ('/ai_create', 'api.ai_create')]:
+        assert query_count(client, url) <= app.view_functions[endpoint].query_budget
+
+
+def test_cursor_pagination_covers_all_photos(app, client, reset_db):
+    """游标分页逐页遍历不重复、不遗漏，每页SQL数量不变"""
+    setup_photos(app, reset_db, 45)
+    for order_by, order_dir in [('created_at', 'desc'), ('created_at', 'asc'), ('views', 'desc')]:
+        seen, cursor = [], ''
+        while True:
+            url = f'/api/photos?cursor={cursor}&per_page=10&order_by={order_by}&order_dir={order_dir}'
+            assert query_count(client, url) <= app.view_functions['api.get_photos'].query_budget
+            data = client.get(url).get_json()
+            seen += [photo['id'] for photo in data['photos']]
+            if not data['pagination']['has_next']:
+                break
+            cursor = data['pagination']['next_cursor']
+        assert sorted(seen) == list(range(1, 46))
+    assert client.get('/api/photos?cursor=abc').status_code == 400
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储对账脚本测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_reconcile_storage.py
+"""
+
+from argparse import Namespace
+
+import pytest
+
+from app import db
+from app.models import Photo
+from app.storage import StoredObject
+from app.tos_client import tos_client
+from reconcile_storage import BatchDeleter, Report, merge, reconcile_prefix, reconcile_renditions, rendition_groups
+
+RENDITIONS = '{"s":[[160,120]],"f":["webp"]}'
+
+
+def test_merge_pairs_sorted_names():
+    pairs = list(merge(iter('acdf'), iter('bcf'), str, str))
+    assert pairs == [('a', None), (None, 'b'), ('c', 'c'), ('d', None), ('f', 'f')]
+    assert list(merge(iter([]), iter('ab'), str, str)) == [(None, 'a'), (None, 'b')]
+
+
+def test_merge_stops_on_out_of_order_input():
+    """任一侧顺序不一致时中止，避免把存在的对象误判为孤儿"""
+    with pytest.raises(RuntimeError):
+        list(merge(iter('ba'), iter('ab'), str, str))
+    with pytest.raises(RuntimeError):
+        list(merge(iter('ab'), iter('ca'), str, str))
+
+
+def test_rendition_groups_by_stem():
+    objects = [StoredObject(key, 1, 0) for key in
+               ['renditions/a/160.webp', 'renditions/a/400.webp', 'renditions/ab/160.webp', 'renditions/b/160.webp']]
+    groups = [(stem, [obj.key.rsplit('/', 1)[1] for obj in group]) for stem, group in rendition_groups(iter(objects))]
+    assert groups == [('a', ['160.webp', '400.webp']), ('ab', ['160.webp']), ('b', ['160.webp'])]
+
+
+@pytest.fixture
+def setup(app, reset_db):
+    """图片1完整；图片2原图缺失；图片3衍生图缺失；另有没有记录引用的原图和衍生图"""
+    with app.app_context():
+        for i in (1, 2, 3):
+            db.session.add(reset_db(i, renditions=RENDITIONS, thumbnail_url=f'/storage/thumbnails/{i}.jpg'))
+        db.session.commit()
+        for key in ['photos/1.jpg', 'photos/3.jpg', 'photos/9.jpg',
+                    'thumbnails/1.jpg', 'thumbnails/2.jpg',
+                    'renditions/1/160.webp', 'renditions/1/800.webp', 'renditions/2/160.webp', 'renditions/9/160.webp']:
+            tos_client.storage.put(key, b'x', 1, 'image/jpeg')
+
+
+def reconcile(app, check, **flags):
+    options = Namespace(**dict(dict(min_age=0, page_size=2, workers=1, delete_orphans=False, delete_dangling=False),
+                               **flags))
+    report = Report('')
+    deleter = BatchDeleter(tos_client.storage, options.workers, report)
+    try:
+        check(app, options, report, deleter)
+    finally:
+        deleter.close()
+    return report.counts
+
+
+def prefix_check(prefix: str):
+    return lambda app, options, report, deleter: reconcile_prefix(app, prefix, options, report, deleter)
+
+
+def stored_keys(app) -> list:
+    with app.app_context():
+        return [item.key for item in tos_client.storage.list_objects('')]
+
+
+def test_report_only(app, setup):
+    assert reconcile(app, prefix_check('photos/')) == {'orphan': 1, 'dangling': 1}
+    assert reconcile(app, prefix_check('thumbnails/')) == {'missing_thumbnail': 1}
+    assert reconcile(app, reconcile_renditions) == {'orphan': 2, 'missing_rendition': 1}
+    assert len(stored_keys(app)) == 9
+
+
+def test_delete_orphans_and_dangling_rows(app, setup):
+    reconcile(app, prefix_check('photos/'),
+              delete_orphans=True, delete_dangling=True)
+    reconcile(app, reconcile_renditions, delete_orphans=True)
+    with app.app_context():
+        assert sorted(photo.id for photo in Photo.query) == [1, 3]
+    # 悬空记录的缩略图和衍生图随记录一并清理
+    assert stored_keys(app) == ['photos/1.jpg', 'photos/3.jpg', 'renditions/1/160.webp', 'thumbnails/1.jpg']
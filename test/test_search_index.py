@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全文索引测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_search_index.py
+"""
+
+from app import db
+from app.models import Tag
+from app.search_index import index_terms, fts5_query
+
+
+def setup_photos(app, make_photo, *titles):
+    """按顺序写入图片，ID从1开始"""
+    with app.app_context():
+        for i, (title, description) in enumerate(titles, 1):
+            db.session.add(make_photo(i, title=title, description=description))
+        db.session.commit()
+
+
+def search(client, keyword: str, extra: str = '') -> list:
+    response = client.get(f'/api/photos?search={keyword}{extra}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [photo['id'] for photo in response.get_json()['photos']]
+
+
+def test_cjk_bigram_terms():
+    """中文按相邻两字切分，英文转为小写单词"""
+    assert index_terms('春天花园 Sunset') == '春天 天花 花园 园 sunset'
+    assert fts5_query('花园 Sun') == '"花园" "sun"*'
+    assert fts5_query('!!') is None
+
+
+def test_search_matches_substrings_and_ranks_title_first(app, client, reset_db):
+    """任意连续的中文片段都能检索到；默认按上传时间排序，按相关度排序时标题命中的图片排在描述命中之前"""
+    setup_photos(app, reset_db, ('城市夜景', '远处的花园'), ('春天花园', '樱花'), ('Sunset Beach', '海边'), ('山间小屋', '屋后有花园'))
+    assert search(client, '花园') == [4, 2, 1]
+    assert search(client, '天花') == [2]
+    assert search(client, '园') == [4, 2, 1]
+    assert search(client, 'sun') == [3]
+    assert search(client, '不存在') == []
+    assert search(client, '花园', '&order_by=relevance') == [2, 4, 1]
+    # 相关度排序在数据库中分页，总数为全部命中的数量
+    data = client.get('/api/photos?search=花园&order_by=relevance&per_page=1&page=3').get_json()
+    assert [photo['id'] for photo in data['photos']] == [1]
+    assert data['pagination']['total'] == 3 and data['pagination']['pages'] == 3
+
+
+def test_index_follows_updates_tags_and_deletes(app, client, reset_db):
+    """修改标题、添加标签、删除图片后索引同步更新"""
+    setup_photos(app, reset_db, ('城市夜景', ''), ('春天花园', ''))
+    client.put('/api/photos/1', json={'title': '月亮'})
+    assert search(client, '夜景') == [] and search(client, '月亮') == [1]
+    client.post('/api/photos/2/tags', json=['风景'])
+    assert search(client, '风景') == [2]
+    with app.app_context():
+        Tag.query.filter_by(name='风景').first().name = '山水'
+        db.session.commit()
+    assert search(client, '风景') == [] and search(client, '山水') == [2]
+    client.delete('/api/photos/2')
+    assert search(client, '花园') == []
+    client.post('/api/photos/bulk-delete', json={'filter': {'search': '月亮'}})
+    with app.app_context():
+        assert db.session.execute(db.text('SELECT count(*) FROM photo_search')).scalar() == 0
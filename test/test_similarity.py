@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+相似图片检测测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_similarity.py
+"""
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from app.similarity import informative_hash
+
+
+def image_file(img: Image.Image, name: str, quality: int = 90):
+    buffer = BytesIO()
+    img.save(buffer, 'PNG' if name.endswith('.png') else 'JPEG', quality=quality)
+    buffer.seek(0)
+    return buffer, name
+
+
+def noise(seed: int) -> Image.Image:
+    """由种子决定的随机色块图，重新编码后感知哈希保持稳定"""
+    blocks = np.random.default_rng(seed).integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize((640, 480), Image.Resampling.BILINEAR)
+
+
+def upload(client, *files):
+    return client.post('/api/upload', data={'files': list(files)}, content_type='multipart/form-data').get_json()
+
+
+def test_low_detail_hashes_are_not_compared():
+    """纯色图片的哈希全0或全1，不参与相似检测"""
+    assert not informative_hash('0000000000000000')
+    assert not informative_hash('ffffffffffffffff')
+    assert not informative_hash(None)
+    assert informative_hash('a5a996bd1ab3636a')
+
+
+def test_similar_uploads_are_accepted_by_default(client, reset_db):
+    """默认不拒绝相似图片：纯色的红图和绿图、同一图片的重新编码都能入库"""
+    assert upload(client, image_file(Image.new('RGB', (300, 200), 'red'), 'red.png'))['count'] == 1
+    assert upload(client, image_file(Image.new('RGB', (300, 200), 'green'), 'green.png'))['count'] == 1
+    img = noise(0)
+    assert upload(client, image_file(img, 'a.jpg', 90), image_file(img, 'b.jpg', 60))['count'] == 2
+
+
+def test_rejects_similar_when_enabled(app, client, reset_db, monkeypatch):
+    """开启拒绝后，同一批和已入库的相似图片都被拒绝，低细节图片不受影响"""
+    monkeypatch.setitem(app.config, 'PHASH_DUPLICATE_DISTANCE', 4)
+    assert upload(client, image_file(Image.new('RGB', (300, 200), 'red'), 'red.png'))['count'] == 1
+    assert upload(client, image_file(Image.new('RGB', (300, 200), 'green'), 'green.png'))['count'] == 1
+
+    img = noise(0)
+    result = upload(client, image_file(img, 'a.jpg', 90), image_file(img, 'b.jpg', 60))
+    assert result['count'] == 1
+    assert result['errors'] == ['b.jpg: 与同批文件 a.jpg 相似']
+    result = upload(client, image_file(img, 'c.jpg', 75))
+    assert result['count'] == 0 and '相似图片已存在' in result['errors'][0]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储后端测试（本地文件系统和内存）
+不依赖运行中的服务和TOS：python -m pytest test/test_storage.py
+"""
+
+from io import BytesIO
+
+import pytest
+
+from app.storage import LocalStorage, MemoryStorage, create_storage
+from app.tos_client import tos_client
+
+
+@pytest.fixture(params=['local', 'memory'])
+def storage(request, tmp_path):
+    if request.param == 'local':
+        return LocalStorage(str(tmp_path / 'objects'), '/storage')
+    return MemoryStorage('/storage')
+
+
+def test_put_get_and_chunks(storage):
+    storage.put('photos/a.jpg', b'0123456789', 10, 'image/jpeg')
+    storage.put('photos/b.jpg', BytesIO(b'abc'), 3, 'image/jpeg')
+    assert storage.get('photos/a.jpg') == b'0123456789'
+    assert storage.get('photos/b.jpg') == b'abc'
+    assert list(storage.iter_chunks('photos/a.jpg', 4)) == [b'0123', b'4567', b'89']
+    assert storage.exists('photos/a.jpg') and not storage.exists('photos/c.jpg')
+    assert storage.url('photos/a.jpg') == '/storage/photos/a.jpg'
+    with pytest.raises(KeyError):
+        storage.get('photos/c.jpg')
+    with pytest.raises(KeyError):
+        list(storage.iter_chunks('photos/c.jpg', 4))
+
+
+def test_list_objects_in_key_order(storage):
+    """列举结果按key字典序，与对象存储的ListObjects一致"""
+    for key in ['thumbnails/x.jpg', 'photos/ab/c.jpg', 'photos/a.jpg', 'photos/b.jpg', 'photos/ab.jpg']:
+        storage.put(key, b'x' * len(key), len(key), 'image/jpeg')
+    listed = list(storage.list_objects('photos/'))
+    assert [item.key for item in listed] == ['photos/a.jpg', 'photos/ab.jpg', 'photos/ab/c.jpg', 'photos/b.jpg']
+    assert [item.size for item in listed] == [len(item.key) for item in listed]
+    assert [item.key for item in storage.list_objects('photos/ab')] == ['photos/ab.jpg', 'photos/ab/c.jpg']
+
+
+def test_delete_ignores_missing_keys(storage):
+    storage.put('photos/a.jpg', b'a', 1, 'image/jpeg')
+    assert storage.delete(['photos/a.jpg', 'photos/missing.jpg']) == []
+    assert not storage.exists('photos/a.jpg')
+    assert list(storage.list_objects('')) == []
+
+
+def test_local_storage_stays_inside_root(tmp_path):
+    storage = LocalStorage(str(tmp_path / 'objects'), '/storage')
+    with pytest.raises(KeyError):
+        storage.put('../escape.jpg', b'x', 1, 'image/jpeg')
+    assert not storage.exists('../../etc/passwd')
+    assert not (tmp_path / 'escape.jpg').exists()
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_storage({'STORAGE_BACKEND': 'ftp'})
+
+
+def test_storage_route_serves_memory_objects(app, client, reset_db):
+    """内存后端的对象由 /storage/<key> 提供，支持Range和ETag"""
+    with app.app_context():
+        tos_client.storage.put('photos/route.jpg', b'0123456789', 10, 'image/jpeg')
+    response = client.get('/storage/photos/route.jpg')
+    assert response.status_code == 200 and response.data == b'0123456789'
+    assert client.get('/storage/photos/route.jpg', headers={'Range': 'bytes=2-4'}).data == b'234'
+    assert client.get('/storage/photos/route.jpg', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/storage/photos/none.jpg').status_code == 404
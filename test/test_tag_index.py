@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+标签位图索引测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_tag_index.py
+"""
+
+from urllib.parse import quote
+
+import pytest
+
+from app import db
+from app.tag_index import Bitmap, TagExpressionError, tag_index
+
+# 图片ID -> 标签
+PHOTO_TAGS = {1: ['猫', '户外'], 2: ['猫'], 3: ['狗', '户外'], 4: ['猫', '狗'], 5: ['户外'], 6: ['猫', '户外']}
+
+
+@pytest.fixture
+def tagged_photos(app, client, reset_db):
+    """写入图片并通过接口添加标签，索引随接口增量更新"""
+    with app.app_context():
+        for i in PHOTO_TAGS:
+            db.session.add(reset_db(i))
+        db.session.commit()
+    for photo_id, names in PHOTO_TAGS.items():
+        client.post(f'/api/photos/{photo_id}/tags', json=names)
+
+
+def photo_ids(client, expression: str, extra: str = '') -> list:
+    response = client.get(f'/api/photos?tags={quote(expression)}{extra}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [photo['id'] for photo in response.get_json()['photos']]
+
+
+def test_bitmap_set_operations():
+    """跨块的交、并、差与按ID顺序遍历"""
+    a = Bitmap.from_ids([1, 5, 70000, 200000])
+    b = Bitmap.from_ids([5, 200000, 300000])
+    assert list((a & b).ids()) == [200000, 5]
+    assert list((a | b).ids(descending=False)) == [1, 5, 70000, 200000, 300000]
+    assert list((a - b).ids()) == [70000, 1]
+    assert list(a.ids(after=70000)) == [5, 1]
+    assert len(a | b) == 5
+
+
+def test_tag_expressions(client, tagged_photos):
+    """AND/OR/NOT和括号，标签可用名称或 #ID"""
+    assert photo_ids(client, '猫 AND 户外') == [6, 1]
+    assert photo_ids(client, '猫 OR 狗') == [6, 4, 3, 2, 1]
+    assert photo_ids(client, '猫 AND NOT 户外') == [4, 2]
+    assert photo_ids(client, '(猫 | 狗) & 户外', '&order_dir=asc') == [1, 3, 6]
+    # 按其他字段排序时由SQL筛选：单个标签连接关联表，多个标签为子查询
+    assert photo_ids(client, '猫 AND 户外', '&order_by=views') == [6, 1]
+    assert photo_ids(client, '猫 AND NOT 户外', '&order_by=views&cursor=') == [4, 2]
+    assert photo_ids(client, '狗', '&order_by=views&tag_id=1') == [4]
+    assert photo_ids(client, '不存在', '&order_by=views') == []
+    assert photo_ids(client, '不存在 OR 狗') == [4, 3]
+    assert photo_ids(client, '#1 AND NOT #2') == [4, 2]
+    assert photo_ids(client, '#3', '&order_by=views') == [4, 3]
+    for bad in ['NOT 猫', '猫 AND', '(猫', '猫 狗']:
+        assert client.get(f'/api/photos?tags={quote(bad)}').status_code == 400
+    with pytest.raises(TagExpressionError):
+        tag_index.evaluate('')
+
+
+def test_numeric_tag_name_is_not_an_id(client, tagged_photos):
+    """名为"3"的标签与ID为3的标签（狗）互不混淆"""
+    client.post('/api/photos/5/tags', json=['3'])
+    assert photo_ids(client, '3') == [5]
+    assert photo_ids(client, '3', '&order_by=views') == [5]
+    assert photo_ids(client, '#3') == [4, 3]
+    assert photo_ids(client, '"#3"') == []
+    assert photo_ids(client, '3 OR #3') == [5, 4, 3]
+
+
+def test_cursor_pages_and_incremental_updates(client, tagged_photos):
+    """游标逐页遍历；移除标签、隐藏和删除图片后结果随之更新"""
+    seen, cursor = [], ''
+    while True:
+        data = client.get(f'/api/photos?tags=猫&cursor={cursor}&per_page=2').get_json()
+        seen += [photo['id'] for photo in data['photos']]
+        if not data['pagination']['has_next']:
+            break
+        cursor = data['pagination']['next_cursor']
+    assert seen == [6, 4, 2, 1]
+    # 按ID定位的游标不能用于按created_at排序的游标分页
+    assert client.get(f'/api/photos?cursor={cursor}').status_code == 400
+
+    client.delete('/api/photos/6/tags/1')
+    client.put('/api/photos/4', json={'is_public': False})
+    client.delete('/api/photos/2')
+    assert photo_ids(client, '猫') == [1]
+    client.put('/api/photos/4', json={'is_public': True})
+    assert photo_ids(client, '猫') == [4, 1]
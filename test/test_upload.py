@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量上传测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_upload.py
+"""
+
+import hashlib
+from io import BytesIO
+
+from PIL import Image
+
+from app import db
+from app.models import Photo
+from app.tos_client import tos_client
+
+
+def jpeg(seed: int) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((160, 120), 20 + seed).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def upload(client, files: dict):
+    return client.post('/api/upload', data={'files': [(BytesIO(data), name) for name, data in files.items()]},
+                       content_type='multipart/form-data')
+
+
+def test_batch_is_processed_and_saved_together(app, client, reset_db):
+    files = {f'{i}.jpg': jpeg(i) for i in range(5)}
+    data = upload(client, files).get_json()
+    assert data == {'success': True, 'count': 5, 'errors': []}
+    with app.app_context():
+        photos = {photo.original_filename: photo for photo in Photo.query}
+        assert set(photos) == set(files)
+        for name, content in files.items():
+            photo = photos[name]
+            assert photo.hash_value == hashlib.md5(content).hexdigest() and photo.file_size == len(content)
+            assert (photo.width, photo.height, photo.title) == (160, 120, name.rsplit('.', 1)[0])
+            assert tos_client.storage.get(f'photos/{photo.filename}') == content
+            assert tos_client.storage.exists(f'thumbnails/{photo.filename}')
+
+
+def test_duplicates_in_batch_and_database(app, client, reset_db):
+    first = jpeg(1)
+    assert upload(client, {'a.jpg': first}).get_json()['count'] == 1
+    data = upload(client, {'b.jpg': jpeg(2), 'b-copy.jpg': first, 'c.jpg': jpeg(3)}).get_json()
+    assert data['count'] == 2 and data['errors'] == ['b-copy.jpg: 文件已存在']
+
+    data = upload(client, {'d.jpg': first, 'd-copy.jpg': first}).get_json()
+    assert data['count'] == 0 and sorted(data['errors']) == ['d-copy.jpg: 文件已存在', 'd.jpg: 文件已存在']
+    with app.app_context():
+        assert Photo.query.count() == 3
+
+
+def test_requires_files(client, reset_db):
+    assert client.post('/api/upload', data={}, content_type='multipart/form-data').status_code == 400
+    assert client.post('/api/upload', data={'files': [(BytesIO(b''), '')]},
+                       content_type='multipart/form-data').status_code == 400
+
+
+def test_check_hashes_reports_existing_files(client, reset_db):
+    first = jpeg(1)
+    upload(client, {'a.jpg': first})
+    known = hashlib.md5(first).hexdigest()
+    unknown = hashlib.md5(b'other').hexdigest()
+    data = client.post('/api/photos/check-hashes', json={'hashes': [known.upper(), unknown, ' ', known]}).get_json()
+    assert data == {'existing': [known], 'missing': [unknown]}
+    # 也接受直接传数组
+    assert client.post('/api/photos/check-hashes', json=[unknown]).get_json()['missing'] == [unknown]
+    assert client.post('/api/photos/check-hashes', json={'hashes': 'abc'}).status_code == 400
+
+
+def test_content_addressed_keys_skip_existing_objects(app, client, reset_db, monkeypatch):
+    """开启内容寻址后key由MD5决定，删除记录后重新上传同一文件不会再次写入已存在的对象"""
+    monkeypatch.setitem(app.config, 'TOS_CONTENT_ADDRESSED', True)
+    content = jpeg(1)
+    digest = hashlib.md5(content).hexdigest()
+    upload(client, {'a.jpg': content})
+    with app.app_context():
+        photo = Photo.query.one()
+        assert photo.filename == f'{digest[:2]}/{digest[2:4]}/{digest}.jpg'
+        db.session.delete(photo)
+        db.session.commit()
+
+    written = []
+    put = tos_client.storage.put
+    monkeypatch.setattr(tos_client.storage, 'put', lambda key, *args: written.append(key) or put(key, *args))
+    assert upload(client, {'again.jpg': content}).get_json()['count'] == 1
+    assert not [key for key in written if key.startswith(('photos/', 'thumbnails/'))]
+    with app.app_context():
+        assert Photo.query.one().filename == f'{digest[:2]}/{digest[2:4]}/{digest}.jpg'
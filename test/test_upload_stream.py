@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式上传缓冲测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_upload_stream.py
+"""
+
+import hashlib
+from io import BytesIO
+
+from flask import request
+
+from app.upload_stream import HashingSpooledFile, spool_upload
+
+CONTENT = bytes(range(256)) * 40
+
+
+def test_spool_hashes_while_writing_and_rolls_over_to_disk():
+    with HashingSpooledFile(max_memory=4096) as spool:
+        spool.write(CONTENT[:1000])
+        assert not spool._file._rolled
+        spool.write(CONTENT[1000:])
+        assert spool._file._rolled
+        assert (spool.size, spool.hexdigest()) == (len(CONTENT), hashlib.md5(CONTENT).hexdigest())
+        spool.seek(0)
+        assert spool.read() == CONTENT
+
+
+def test_spool_upload_reads_plain_streams_in_chunks():
+    stream = BytesIO(CONTENT)
+    stream.seek(100)
+    assert spool_upload(stream, 1000) == (len(CONTENT), hashlib.md5(CONTENT).hexdigest())
+    assert stream.tell() == 0
+
+
+def test_request_files_are_hashed_on_receipt(app, monkeypatch):
+    """表单解析时上传文件直接写入HashingSpooledFile，大于阈值的文件不留在内存中"""
+    monkeypatch.setitem(app.config, 'UPLOAD_SPOOL_MAX_MEMORY', 4096)
+    with app.test_request_context('/api/upload', method='POST', content_type='multipart/form-data',
+                                  data={'files': (BytesIO(CONTENT), 'a.jpg')}):
+        stream = request.files['files'].stream
+        assert isinstance(stream, HashingSpooledFile) and stream._file._rolled
+        assert spool_upload(stream, 1000) == (len(CONTENT), hashlib.md5(CONTENT).hexdigest())
+        assert stream.read() == CONTENT
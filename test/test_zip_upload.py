@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ZIP压缩包上传测试
+使用内存数据库和内存存储，不依赖运行中的服务：python -m pytest test/test_zip_upload.py
+"""
+
+import zipfile
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from app.ingest import MemberTooLarge, extract_member, ingest_zip
+
+
+def jpeg(seed: int) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((64, 48), 20 + seed).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def archive(members: dict) -> BytesIO:
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+def upload_zip(client, members: dict):
+    return client.post('/api/upload/zip', data={'archive': (archive(members), 'photos.zip')},
+                       content_type='multipart/form-data')
+
+
+def test_images_are_ingested_and_other_members_skipped(client, reset_db):
+    duplicate = jpeg(2)
+    response = upload_zip(client, {
+        'a.jpg': jpeg(1),
+        'album/b.JPG': duplicate,
+        'album/b-copy.jpg': duplicate,
+        '__MACOSX/album/._b.JPG': b'resource fork',
+        '.hidden.jpg': jpeg(3),
+        'notes.txt': b'text',
+        'empty/': b''
+    })
+    data = response.get_json()
+    assert response.status_code == 200 and data['count'] == 2
+    status = {member['name']: member['status'] for member in data['members']}
+    assert status == {
+        'a.jpg': 'uploaded', 'album/b.JPG': 'uploaded', 'album/b-copy.jpg': 'failed',
+        '__MACOSX/album/._b.JPG': 'skipped', '.hidden.jpg': 'skipped', 'notes.txt': 'skipped'
+    }
+    assert data['errors'] == ['album/b-copy.jpg: 文件已存在']
+
+
+def test_member_count_limit(app, client, reset_db, monkeypatch):
+    monkeypatch.setitem(app.config, 'ZIP_MAX_MEMBERS', 2)
+    data = upload_zip(client, {f'{i}.jpg': jpeg(i) for i in range(3)}).get_json()
+    assert data['count'] == 2
+    assert data['errors'] == ['2.jpg: 压缩包内图片数量超过限制']
+
+
+def test_member_size_limit(app, reset_db):
+    small = jpeg(1)
+    members = {'small.jpg': small, 'large.jpg': jpeg(2) + b'\0' * 4096}
+    with app.app_context():
+        photos, errors, _ = ingest_zip(app, archive(members), max_size=len(small) + 100)
+    assert [photo.original_filename for photo in photos] == ['small.jpg']
+    assert errors == ['large.jpg: 文件大小超过限制']
+
+    # 单独解压超限的成员时抛出MemberTooLarge
+    with zipfile.ZipFile(archive(members)) as zf:
+        with pytest.raises(MemberTooLarge):
+            extract_member(app, zf, zf.getinfo('large.jpg'), max_size=len(small) + 100)
+
+
+def test_invalid_archive(client, reset_db):
+    response = client.post('/api/upload/zip', data={'archive': (BytesIO(b'not a zip'), 'photos.zip')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert client.post('/api/upload/zip', data={}, content_type='multipart/form-data').status_code == 400
@@ -0,0 +1,42 @@
+from sqlalchemy import inspect, text
+from app import create_app, db
+
+# 创建Flask应用实例（会先执行db.create_all()创建新增的表）
+app = create_app()
+
+
+def column_ddl(column, dialect):
+    """生成ALTER TABLE ADD COLUMN使用的列定义"""
+    ddl = f'{column.name} {column.type.compile(dialect=dialect)}'
+    if column.server_default is not None:
+        ddl += f" DEFAULT '{column.server_default.arg}'"
+    if not column.nullable and column.server_default is not None:
+        ddl += ' NOT NULL'
+    return ddl
+
+
+# 为已存在的表补充模型中新增的列和索引
+# db.create_all()只会创建不存在的表，不会修改已有表结构
+with app.app_context():
+    try:
+        inspector = inspect(db.engine)
+        dialect = db.engine.dialect
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {col['name'] for col in inspector.get_columns(table.name)}
+            missing = [col for col in table.columns if col.name not in existing_columns]
+            for column in missing:
+                db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column_ddl(column, dialect)}'))
+                print(f'已添加列: {table.name}.{column.name}')
+            # 新增列上的索引和新增的复合索引
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(bind=db.session.connection())
+                    print(f'已创建索引: {index.name}')
+        db.session.commit()
+        print('数据库表结构升级完成')
+    except Exception as e:
+        db.session.rollback()
+        print(f'升级数据库表结构时出错: {str(e)}')